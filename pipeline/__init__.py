@@ -8,3 +8,6 @@ if 'custom' not in dj.config:
 
 intracellular_path = pathlib.Path(dj.config['custom'].get('intracellular_directory')).as_posix()
 extracellular_path = pathlib.Path(dj.config['custom'].get('extracellular_directory')).as_posix()
+# local directory for the pipeline's own bookkeeping files (e.g. file manifests)
+cache_path = pathlib.Path(dj.config['custom'].get('cache_directory',
+                                                  pathlib.Path.home() / '.inagaki2018')).as_posix()
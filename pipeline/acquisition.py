@@ -79,6 +79,13 @@ class TrialSet(dj.Imported):
         event_time = null: float   # (in second) event time with respect to this trial's start time
         """
 
+        # the event times of a session are memoized in analysis.get_session_event_times - invalidate on insert
+        #  (deletes and re-ingests are detected there, from a checksum of the Trial and EventTime rows of the session)
+        def insert(self, rows, **kwargs):
+            super().insert(rows, **kwargs)
+            from . import analysis
+            analysis.clear_session_event_times_cache()
+
     def make(self, key):
         # this function implements the ingestion of Trial data into the pipeline
         return NotImplementedError
@@ -4,10 +4,13 @@ Schema of analysis data.
 '''
 import re
 import os
+import sys
 from datetime import datetime
+from collections import namedtuple
 
 import numpy as np
 import scipy.io as sio
+from scipy.ndimage import uniform_filter1d
 import datajoint as dj
 import h5py as h5
 
@@ -29,6 +32,18 @@ class TrialSegmentationSetting(dj.Lookup):
                 [1, 'delay_start', 2, 4]]
 
 
+@schema
+class PSTHParamSet(dj.Lookup):
+    definition = """ # binning and smoothing parameters of PSTHs
+    psth_param_set: smallint
+    ---
+    psth_bin_size: decimal(5,3)  # (s) bin size
+    psth_smooth_window: smallint  # (bins) width of the boxcar smoothing window (1: no smoothing)
+    """
+    contents = [[0, 0.1, 1],
+                [1, 0.02, 5]]
+
+
 @schema
 class RealignedEvent(dj.Computed):
     definition = """
@@ -44,44 +59,279 @@ class RealignedEvent(dj.Computed):
         realigned_event_time = null: float   # (s) event time with respect to the event this trial-segmentation is time-locked to
         """
 
+    # computed for all trials of a session at once
+    key_source = acquisition.TrialSet * TrialSegmentationSetting
+
     def make(self, key):
-        self.insert1(key)
         # get event, pre/post stim duration
-        event_of_interest, pre_stim_dur, post_stim_dur = (TrialSegmentationSetting & key).fetch1(
-            'event', 'pre_stim_duration', 'post_stim_duration')
-        # get event time
-        try:
-            eoi_time_point = get_event_time(event_of_interest, key)
-        except EventChoiceError as e:
-            print(f'Event Choice error - Msg: {str(e)}')
+        event_of_interest = (TrialSegmentationSetting & key).fetch1('event')
+        # get all events of all trials of this session
+        session_event_times = get_session_event_times(key)
+        utilities.insert_in_batches(self, (dict(tr_key, trial_seg_setting=key['trial_seg_setting'])
+                                           for tr_key in session_event_times.trial_keys))
+
+        if event_of_interest not in session_event_times.events:
+            print(f'Event Choice error - Msg: {event_of_interest}: event not found', file=sys.stderr)
             return
-        # get all other events for this trial
-        events, event_times = (acquisition.TrialSet.EventTime & key).fetch('trial_event', 'event_time')
-        self.RealignedEventTime.insert(dict(key,
-                                            trial_event = eve,
-                                            realigned_event_time = event_times[e_idx] - eoi_time_point)
-                                       for e_idx, eve in enumerate(events))
-
-
-
-def get_event_time(event_name, key):
-    # get event time
-    try:
-        t = (acquisition.TrialSet.EventTime & key & {'trial_event': event_name}).fetch1('event_time')
-    except dj.DataJointError:
-        raise EventChoiceError(event_name, f'{event_name}: event not found')
-    if np.isnan(t):
-        raise EventChoiceError(event_name, msg = f'{event_name}: event_time is nan')
+        eoi_idx = session_event_times.events.index(event_of_interest)
+        is_valid = session_event_times.is_recorded[:, eoi_idx] & ~np.isnan(session_event_times.event_times[:, eoi_idx])
+        if not is_valid.all():
+            print(f'Event Choice error - Msg: {event_of_interest}: event not found or nan'
+                  f' for {(~is_valid).sum()} trial(s)', file=sys.stderr)
+
+        # realign all events of all trials in one subtraction: (trial x event) - (trial x 1)
+        realigned_event_times = (session_event_times.event_times
+                                 - session_event_times.event_times[:, eoi_idx:eoi_idx + 1])
+        trial_idx, event_idx = np.where(session_event_times.is_recorded & is_valid[:, None])
+        utilities.insert_in_batches(self.RealignedEventTime, (
+            dict(session_event_times.trial_keys[tr_idx], trial_seg_setting=key['trial_seg_setting'],
+                 trial_event=session_event_times.events[e_idx],
+                 realigned_event_time=realigned_event_times[tr_idx, e_idx])
+            for tr_idx, e_idx in zip(trial_idx, event_idx)))
+
+
+# ============== Session event times ==============
+# Event times of all trials of a session, fetched at once and memoized per session
+# A cached session is checked against a checksum of its Trial and EventTime rows, computed by the database server
+#  (2 queries) - so that a session deleted and re-ingested, in this or another process, is fetched again - and the
+#  cache is cleared on insert of acquisition.TrialSet.EventTime in this process
+SessionEventTimes = namedtuple('SessionEventTimes', ['trial_keys', 'trial_ids', 'events', 'event_times',
+                                                     'is_recorded', 'start_times', 'stop_times'])
+
+session_event_times_cache = utilities.LRUCache(256 * 1024 ** 2)
+
+
+def get_session_event_times_checksum(session_key):
+    """
+    Checksum of the Trial and EventTime rows of the session in "session_key": per table, the row count and the
+     XOR of the (64-bit) MD5 of each row, aggregated by the database server - one query per table
+    """
+    checksums = []
+    for table in (acquisition.TrialSet.Trial, acquisition.TrialSet.EventTime):
+        attributes = ', '.join(f"COALESCE(`{attr}`, 'NULL')" for attr in table.heading.names)
+        row_hash = f"CAST(CONV(LEFT(MD5(CONCAT_WS('|', {attributes})), 16), 16, 10) AS UNSIGNED)"
+        checksums.extend((acquisition.TrialSet & session_key).aggr(
+            table, keep_all_rows=True,
+            checksum=f"CONCAT(COUNT(`trial_id`), ':', COALESCE(BIT_XOR({row_hash}), 0))").fetch('checksum'))
+    return tuple(checksums)
+
+
+def get_session_event_times(key):
+    """
+    Get the event times of all trials of the session in "key" - 2 queries per session, then served from cache
+     (2 queries to validate the cached session, see get_session_event_times_checksum)
+    Return a SessionEventTimes of
+     + trial_keys, trial_ids: sorted by trial_id
+     + events: sorted event names
+     + event_times: (trial x event) array of event times, (s) with respect to the trial start - NaN if missing or nan
+     + is_recorded: (trial x event) boolean array, True where an EventTime entry exists
+     + start_times, stop_times: (s) start/stop time of each trial, with respect to the start of the session
+    """
+    session_key = {k: key[k] for k in acquisition.Session.primary_key}
+    cache_key = tuple(sorted(session_key.items()))
+    checksum = get_session_event_times_checksum(session_key)
+    cached = session_event_times_cache.get(cache_key)
+    if cached is not None and cached[0] == checksum:
+        return cached[1]
+
+    trial_ids, start_times, stop_times = (acquisition.TrialSet.Trial & session_key).fetch(
+        'trial_id', 'start_time', 'stop_time', order_by='trial_id')
+    event_trial_ids, trial_events, event_times = (acquisition.TrialSet.EventTime & session_key).fetch(
+        'trial_id', 'trial_event', 'event_time')
+
+    trial_ids = np.array(trial_ids, dtype=int)
+    events = sorted(set(trial_events))
+    trial_idx = np.searchsorted(trial_ids, np.array(event_trial_ids, dtype=int))
+    event_idx = np.searchsorted(events, trial_events).astype(int)
+    event_time_matrix = np.full((len(trial_ids), len(events)), np.nan)
+    event_time_matrix[trial_idx, event_idx] = np.array(event_times, dtype=float)
+    is_recorded = np.zeros(event_time_matrix.shape, dtype=bool)
+    is_recorded[trial_idx, event_idx] = True
+
+    session_event_times = SessionEventTimes(
+        trial_keys=[dict(session_key, trial_id=tr_id) for tr_id in trial_ids],
+        trial_ids=trial_ids,
+        events=events,
+        event_times=event_time_matrix,
+        is_recorded=is_recorded,
+        start_times=np.array(start_times, dtype=float),
+        stop_times=np.array(stop_times, dtype=float))
+    if len(trial_ids):  # do not memoize sessions whose trials are not ingested yet
+        session_event_times_cache.put(cache_key, (checksum, session_event_times))
+    return session_event_times
+
+
+def clear_session_event_times_cache():
+    session_event_times_cache.clear()
+
+
+def get_trials_event_time(event_name, key):
+    """
+    Get the keys, start/stop times and "event_name" time of all trials of the session in "key"
+     (restricted to key['trial_id'] if specified) - from the session event times cache
+     + start_times, stop_times: (s) with respect to the start of the session (NaN if not available)
+     + event_times: (s) with respect to the start of the trial (NaN if the event is not found or nan)
+    """
+    session_event_times = get_session_event_times(key)
+    trial_mask = (session_event_times.trial_ids == key['trial_id'] if 'trial_id' in key
+                  else np.ones(len(session_event_times.trial_ids), dtype=bool))
+    if event_name in session_event_times.events:
+        event_times = session_event_times.event_times[:, session_event_times.events.index(event_name)]
     else:
-        return t
+        event_times = np.full(len(session_event_times.trial_ids), np.nan)
+    return ([k for k, m in zip(session_event_times.trial_keys, trial_mask) if m],
+            session_event_times.start_times[trial_mask], session_event_times.stop_times[trial_mask],
+            event_times[trial_mask])
+
+
+def segment_signals(signals, fs, first_time_point, event_times, trial_starts, trial_stops,
+                    pre_stim_dur, post_stim_dur):
+    """
+    Trial-segment one or more continuous signals around an event, for all trials at once
+     + signals: list of 1D arrays sharing the same sampling rate "fs" and first time point
+     + event_times: (s) event time of each trial, with respect to the trial start
+     + trial_starts, trial_stops: (s) start/stop time of each trial, with respect to the start of the session
+    Samples out of the trial's start/stop times (or out of the recording) are NaN
+    Return a list of (trial x sample) arrays, one per signal
+    """
+    pre_stim_dur = float(pre_stim_dur)
+    post_stim_dur = float(post_stim_dur)
+    sample_total = int((post_stim_dur + pre_stim_dur) * fs) + 1
 
+    # sample indices of all trials: (trial x sample)
+    event_sample_points = (np.asarray(trial_starts) + np.asarray(event_times) - first_time_point) * fs
+    sample_points = ((event_sample_points - pre_stim_dur * fs).astype(int)[:, None]
+                     + np.arange(sample_total)[None, :])
+    # out-of-bound samples - comparisons with NaN start/stop times are False (i.e. not bounded)
+    with np.errstate(invalid='ignore'):
+        is_out_of_bound = np.logical_or(
+            sample_points < np.ceil((np.asarray(trial_starts) - first_time_point) * fs)[:, None],
+            sample_points > np.floor((np.asarray(trial_stops) - first_time_point) * fs)[:, None])
 
-class EventChoiceError(Exception):
-    '''Raise when "event" does not exist or "event_type" is invalid (e.g. nan)'''
+    segmented_signals = []
+    for signal in signals:
+        is_out = np.logical_or(is_out_of_bound, np.logical_or(sample_points < 0, sample_points >= len(signal)))
+        segmented = np.asarray(signal[np.clip(sample_points, 0, len(signal) - 1)], dtype=float)
+        segmented[is_out] = np.nan
+        segmented_signals.append(segmented)
+    return segmented_signals
 
-    def __init__(self, event_name, msg=None):
-        if msg is None:
-            msg = f'Invalid event type or time for: {event_name}'
-        super().__init__(msg)
-        self.event_name = event_name
-    pass
+
+def segment_session_signals(key, event_name, pre_stim_dur, post_stim_dur, signals, fs, first_time_point):
+    """
+    Trial-segment the continuous "signals" for all trials of the session in "key" (see segment_signals)
+    Trials without a valid "event_name" time are skipped
+    Return the keys of the segmented trials, followed by one (trial x sample) array per signal
+    """
+    trial_keys, trial_starts, trial_stops, event_times = get_trials_event_time(event_name, key)
+    is_valid = ~np.isnan(event_times)
+    if not is_valid.all():
+        print(f'Trial segmentation error - Msg: {event_name}: event not found or nan in '
+              f'{np.sum(~is_valid)} trial(s)', file=sys.stderr)
+
+    return ([trial_key for trial_key, valid in zip(trial_keys, is_valid) if valid],
+            *segment_signals(signals, fs, first_time_point, event_times[is_valid],
+                             trial_starts[is_valid], trial_stops[is_valid], pre_stim_dur, post_stim_dur))
+
+
+def get_trials_segmentation_window(event_times, trial_starts, trial_stops, pre_stim_dur, post_stim_dur):
+    """
+    Per trial (pre, post)-stimulus window around the event, bounded by the trial start/stop
+     (start and stop times of 0 or NaN leave the window unbounded)
+    Return the window start and stop times, in the same reference as event_times
+    """
+    window_starts = event_times - float(pre_stim_dur)
+    window_stops = event_times + float(post_stim_dur)
+    trial_starts = np.asarray(trial_starts, dtype=float)
+    trial_stops = np.asarray(trial_stops, dtype=float)
+    is_start_bounded = np.isfinite(trial_starts) & (trial_starts != 0)
+    is_stop_bounded = np.isfinite(trial_stops) & (trial_stops != 0)
+    window_starts = np.where(is_start_bounded & (window_starts < 0), 0, window_starts)
+    window_stops = np.where(is_stop_bounded & (window_stops > trial_stops), trial_stops, window_stops)
+    return window_starts, window_stops
+
+
+def segment_trial_spike_times(spike_times, spike_trial_ids, trial_ids, event_times, window_starts, window_stops):
+    """
+    Trial-segment the spike times of a unit for all trials at once, given the trial each spike belongs to
+     + spike_times, spike_trial_ids: per spike
+     + trial_ids, event_times, window_starts, window_stops: per trial, times in the same reference as spike_times
+    Spikes are grouped by trial with one sort (by trial, then time) and kept if within their trial's window
+    Return the segmented spike times (with respect to the event time), concatenated in the order of trial_ids,
+     and the (len(trial_ids) + 1) offsets of each trial in this array
+    """
+    spike_times = np.asarray(spike_times, dtype=float).flatten()
+    spike_trial_ids = np.asarray(spike_trial_ids).flatten()
+    trial_ids = np.asarray(trial_ids)
+    if trial_ids.size == 0:
+        return np.array([]), np.zeros(1, dtype=int)
+
+    # map each spike to the position of its trial in trial_ids (spikes out of trial_ids are dropped)
+    trial_order = np.argsort(trial_ids, kind='stable')
+    trial_pos = np.searchsorted(trial_ids[trial_order], spike_trial_ids)
+    trial_pos = np.clip(trial_pos, 0, len(trial_ids) - 1)
+    is_in_trials = trial_ids[trial_order][trial_pos] == spike_trial_ids
+    spike_pos = trial_order[trial_pos[is_in_trials]]
+    spike_times = spike_times[is_in_trials]
+
+    # sort by trial position, then by time
+    sort_idx = np.lexsort((spike_times, spike_pos))
+    spike_pos, spike_times = spike_pos[sort_idx], spike_times[sort_idx]
+
+    is_in_window = np.logical_and(spike_times >= window_starts[spike_pos], spike_times <= window_stops[spike_pos])
+    spike_pos = spike_pos[is_in_window]
+    segmented_spike_times = spike_times[is_in_window] - event_times[spike_pos]
+    offsets = np.searchsorted(spike_pos, np.arange(len(trial_ids) + 1))
+    return segmented_spike_times, offsets
+
+
+def segment_spike_times(spike_times, event_times, window_starts, window_stops):
+    """
+    Trial-segment a spike train for all trials at once (the trials' windows may overlap)
+     + event_times, window_starts, window_stops: per trial, times in the same reference as spike_times
+    Each trial's window is cut from the sorted spike train with searchsorted
+    Return the segmented spike times (with respect to the event time), concatenated in the order of the trials,
+     and the (trial count + 1) offsets of each trial in this array
+    """
+    spike_times = np.sort(np.asarray(spike_times, dtype=float).flatten())
+    first_spike_idx = np.searchsorted(spike_times, window_starts, side='left')
+    spike_counts = np.maximum(np.searchsorted(spike_times, window_stops, side='right') - first_spike_idx, 0)
+    offsets = np.concatenate([[0], np.cumsum(spike_counts)]).astype(int)
+
+    spike_idx = np.repeat(first_spike_idx - offsets[:-1], spike_counts) + np.arange(offsets[-1])
+    return spike_times[spike_idx] - np.repeat(event_times, spike_counts), offsets
+
+
+def get_psth_bin_edges(pre_stim_dur, post_stim_dur, bin_size):
+    """
+    Bin edges (s) spanning the (pre, post)-stimulus window with respect to the event, in bins of "bin_size"
+    """
+    bin_counts = int(round((float(pre_stim_dur) + float(post_stim_dur)) / float(bin_size)))
+    return np.linspace(-float(pre_stim_dur), -float(pre_stim_dur) + bin_counts * float(bin_size), bin_counts + 1)
+
+
+def bin_spike_times(spike_times, offsets, bin_edges):
+    """
+    Bin the spike times of many spike trains (e.g. all units x trials) at once
+     + spike_times, offsets: the spike trains, concatenated, and the (train count + 1) offsets of each train
+    Each spike is assigned to its bin with one searchsorted against the bin edges (as np.histogram,
+     the last bin includes its right edge) and counted per (train, bin) with one bincount
+    Return the (train x bin) spike counts
+    """
+    spike_times = np.asarray(spike_times, dtype=float)
+    train_counts, bin_counts = len(offsets) - 1, len(bin_edges) - 1
+    train_idx = np.repeat(np.arange(train_counts), np.diff(offsets))
+    bin_idx = np.searchsorted(bin_edges, spike_times, side='right') - 1
+    bin_idx[spike_times == bin_edges[-1]] = bin_counts - 1
+    is_in_bins = np.logical_and(bin_idx >= 0, bin_idx < bin_counts)
+    return np.bincount(train_idx[is_in_bins] * bin_counts + bin_idx[is_in_bins],
+                       minlength=train_counts * bin_counts).reshape(train_counts, bin_counts)
+
+
+def smooth_psth(psth, smooth_window):
+    """
+    Boxcar-smooth PSTH(s) along the last (time) axis, over "smooth_window" bins
+    """
+    if smooth_window <= 1:
+        return psth
+    return uniform_filter1d(np.asarray(psth, dtype=float), int(smooth_window), axis=-1, mode='nearest')
@@ -7,7 +7,6 @@ from datetime import datetime
 import sys
 
 import numpy as np
-import scipy.io as sio
 import datajoint as dj
 import h5py as h5
 
@@ -17,22 +16,30 @@ from . import intracellular_path
 schema = dj.schema(dj.config['custom'].get('database.prefix', '') + 'behavior')
 sess_data_dir = os.path.join(intracellular_path, 'Data')
 
+# attribute name: field name in "wholeCell.behavioral_data.behav_timing"
+lick_time_fields = {'lick_left_on': 'lickL_on_time',
+                    'lick_left_off': 'lickL_off_time',
+                    'lick_right_on': 'lickR_on_time',
+                    'lick_right_off': 'lickR_off_time'}
+
 
 @schema
-class TrialSegmentedLickTrace(dj.Imported):
-    definition = """
-    -> acquisition.TrialSet.Trial
-    -> analysis.TrialSegmentationSetting
+class LickTimes(dj.Imported):
+    definition = """ # lick times of all trials of this session, concatenated across trials
+    -> acquisition.TrialSet
     ---
-    segmented_lick_left_on: longblob  # (s), lick left onset times (based on contact of lick port)
-    segmented_lick_left_off: longblob  # (s), lick left offset times (based on contact of lick port)
-    segmented_lick_right_on: longblob  # (s), lick right onset times (based on contact of lick port)
-    segmented_lick_right_off: longblob  # (s), lick right offset times (based on contact of lick port)
+    lick_trial_ids: longblob  # trial_id of the trials, in the order of concatenation
+    lick_left_on: longblob  # (s), lick left onset times, with respect to the trial start (based on contact of lick port)
+    lick_left_on_offsets: longblob  # index of the first onset of each trial in "lick_left_on" (trial count + 1)
+    lick_left_off: longblob  # (s), lick left offset times, with respect to the trial start (based on contact of lick port)
+    lick_left_off_offsets: longblob  # index of the first offset of each trial in "lick_left_off" (trial count + 1)
+    lick_right_on: longblob  # (s), lick right onset times, with respect to the trial start (based on contact of lick port)
+    lick_right_on_offsets: longblob  # index of the first onset of each trial in "lick_right_on" (trial count + 1)
+    lick_right_off: longblob  # (s), lick right offset times, with respect to the trial start (based on contact of lick port)
+    lick_right_off_offsets: longblob  # index of the first offset of each trial in "lick_right_off" (trial count + 1)
     """
 
-    key_source = ((acquisition.TrialSet & (acquisition.Session.ExperimentType
-                                           & {'experiment_type': 'intracellular'}))
-                  * analysis.TrialSegmentationSetting)
+    key_source = acquisition.TrialSet & (acquisition.Session.ExperimentType & {'experiment_type': 'intracellular'})
 
     def make(self, key):
         # ============ Dataset ============
@@ -41,42 +48,85 @@ class TrialSegmentedLickTrace(dj.Imported):
             sess_data_dir, dict(key, cell_id=(intracellular.Cell & key).fetch1('cell_id')))
         if sess_data_file is None:
             raise FileNotFoundError(f'Intracellular import failed: ({key["subject_id"]} - {key["session_time"]})')
-        mat_data = sio.loadmat(sess_data_file, struct_as_record = False, squeeze_me = True)['wholeCell']
+        mat_lick_times = utilities.load_matfile_fields(
+            sess_data_file, 'wholeCell', ['behavioral_data.behav_timing.' + n for n in lick_time_fields.values()])
+        #  ============= Now read the data and start ingesting =============
+        lick_times = dict(key)
+        for attr_name, field_name in lick_time_fields.items():
+            # per trial lick times may be a float, an empty or a 1-D array
+            trial_lick_times = [np.array(v, dtype=float).flatten()
+                                for v in mat_lick_times['behavioral_data.behav_timing.' + field_name]]
+            lick_times[attr_name] = (np.concatenate(trial_lick_times) if trial_lick_times
+                                     else np.array([]))
+            lick_times[attr_name + '_offsets'] = np.concatenate(
+                [[0], np.cumsum([len(v) for v in trial_lick_times])]).astype(int)
+        lick_times['lick_trial_ids'] = np.arange(1, len(trial_lick_times) + 1)
+        self.insert1(lick_times)
+        print(f'Import lick times for session: {key["session_id"]}')
+
+
+@schema
+class TrialSegmentedLickTrace(dj.Computed):
+    definition = """ # trial-segmented lick times of all trials of this session, concatenated across trials
+    -> LickTimes
+    -> analysis.TrialSegmentationSetting
+    ---
+    trial_ids: longblob  # trial_id of the segmented trials, in the order of concatenation
+    segmented_lick_left_on: longblob  # (s), lick left onset times (based on contact of lick port)
+    segmented_lick_left_on_offsets: longblob  # index of the first onset of each trial in "segmented_lick_left_on" (trial count + 1)
+    segmented_lick_left_off: longblob  # (s), lick left offset times (based on contact of lick port)
+    segmented_lick_left_off_offsets: longblob  # index of the first offset of each trial in "segmented_lick_left_off" (trial count + 1)
+    segmented_lick_right_on: longblob  # (s), lick right onset times (based on contact of lick port)
+    segmented_lick_right_on_offsets: longblob  # index of the first onset of each trial in "segmented_lick_right_on" (trial count + 1)
+    segmented_lick_right_off: longblob  # (s), lick right offset times (based on contact of lick port)
+    segmented_lick_right_off_offsets: longblob  # index of the first offset of each trial in "segmented_lick_right_off" (trial count + 1)
+    """
+
+    def make(self, key):
         # get event, pre/post stim duration
         event_name, pre_stim_dur, post_stim_dur = (analysis.TrialSegmentationSetting & key).fetch1(
             'event', 'pre_stim_duration', 'post_stim_duration')
-        pre_stim_dur = float(pre_stim_dur)
-        post_stim_dur = float(post_stim_dur)
-        #  ============= Now read the data and start ingesting =============
-        self.insert({**key,
-                     **get_single_trial_lick_times(k, mat_data, event_name, pre_stim_dur, post_stim_dur)}
-                    for k in (acquisition.TrialSet.Trial & key).fetch('KEY'))
-        print(f'Perform trial-segmentation of lick traces for trial: {key["session_id"]}')
-
-
-def get_single_trial_lick_times(trial_key, mat_data, event_name, pre_stim_dur, post_stim_dur):
-    lick_times = {k_n: getattr(mat_data.behavioral_data.behav_timing[trial_key['trial_id'] - 1], n)
-                  for k_n, n in zip(['segmented_lick_left_on', 'segmented_lick_left_off',
-                                     'segmented_lick_right_on', 'segmented_lick_right_off'],
-                                    ['lickL_on_time', 'lickL_off_time',
-                                     'lickR_on_time', 'lickR_off_time'])}
-    # get event time
-    try:
-        event_time_point = analysis.get_event_time(event_name, trial_key)
-    except analysis.EventChoiceError as e:
-        raise e
-    # check if pre/post stim dur is within start/stop time
-    trial_start, trial_stop = (acquisition.TrialSet.Trial & trial_key).fetch1('start_time', 'stop_time')
-    if trial_start and event_time_point - pre_stim_dur < 0:
-        print('Warning: Out of bound pre-stim dur, select from start-time (t=0)')
-        pre_stim_dur = event_time_point
-    if trial_stop and event_time_point + post_stim_dur > trial_stop:
-        print('Warning: Out of bound post-stim dur, set to trial end time')
-        post_stim_dur = trial_stop - event_time_point
-
-    for k, v in lick_times.items():
-        v = np.array([v]) if isinstance(v, (float, int)) else v
-        trial_key[k] = v[np.logical_and((v >= (event_time_point - pre_stim_dur)),
-                                        (v <= (event_time_point + post_stim_dur)))] - event_time_point
-    return trial_key
+        segmented_lick_times = segment_lick_times(key, event_name, pre_stim_dur, post_stim_dur)
+        self.insert1(dict(key, **segmented_lick_times))
+        print(f'Perform trial-segmentation of lick traces for session: {key["session_id"]}')
+
+
+def segment_lick_times(key, event_name, pre_stim_dur, post_stim_dur):
+    """
+    Trial-segment the lick times of the session in "key" for all trials, around "event_name"
+    Trials without a valid event time are skipped
+    Return a dict of "trial_ids" and, per lick type, the concatenated segmented lick times and their trial offsets
+    """
+    lick_times = (LickTimes & key).fetch1()
+
+    # get event times and segmentation windows of all trials - skip trials with invalid event time
+    trial_keys, trial_starts, trial_stops, event_times = analysis.get_trials_event_time(event_name, key)
+    is_valid = ~np.isnan(event_times)
+    if not is_valid.all():
+        print(f'Event Choice error - Msg: {event_name}: event not found or nan'
+              f' for {(~is_valid).sum()} trial(s)', file=sys.stderr)
+    trial_ids = np.array([k['trial_id'] for k, v in zip(trial_keys, is_valid) if v], dtype=int)
+    event_times = event_times[is_valid]
+    window_starts, window_stops = analysis.get_trials_segmentation_window(
+        event_times, trial_starts[is_valid], trial_stops[is_valid], pre_stim_dur, post_stim_dur)
+
+    segmented_lick_times = dict(trial_ids=trial_ids)
+    for attr_name in lick_time_fields:
+        lick_trial_ids = np.repeat(lick_times['lick_trial_ids'], np.diff(lick_times[attr_name + '_offsets']))
+        (segmented_lick_times['segmented_' + attr_name],
+         segmented_lick_times['segmented_' + attr_name + '_offsets']) = analysis.segment_trial_spike_times(
+            lick_times[attr_name], lick_trial_ids, trial_ids, event_times, window_starts, window_stops)
+    return segmented_lick_times
 
+
+def fetch_segmented_lick_times(key):
+    """
+    Fetch the trial-segmented lick times of the session and trial-segmentation setting in "key" (one blob per lick type)
+    Return the trial_ids and a dict of lick type (e.g. "segmented_lick_left_on") to the list of per-trial arrays
+     (views into the concatenated array)
+    """
+    segmented_lick_times = (TrialSegmentedLickTrace & key).fetch1()
+    return segmented_lick_times['trial_ids'], {
+        'segmented_' + attr_name: utilities.split_by_offsets(segmented_lick_times['segmented_' + attr_name],
+                                                             segmented_lick_times['segmented_' + attr_name + '_offsets'])
+        for attr_name in lick_time_fields}
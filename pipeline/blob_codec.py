@@ -0,0 +1,264 @@
+'''
+Compact encodings of large numeric blobs (continuous signals and trial-segmented traces), applied per attribute.
+The codec of an attribute is set with dj.config['custom']['blob_codecs'], e.g.
+    "blob_codecs": {"membrane_potential": "int16+zstd", "segmented_mp": "float32"}
+ + a codec: "float32", or "int16" - quantized to 16 bit, with the gain and offset stored with the data
+    (NaN are kept, other non-finite values decode to NaN)
+ + optionally followed by a compression: "+zstd" (zstandard package) or "+blosc" (blosc package)
+Attributes without a codec are stored as is. An encoded value is stored as a uint8 array (see pack_envelope), which
+ the legacy (mYm) blob format of DataJoint supports.
+Encoded values are decoded (to float32) with decode(), and on fetch once a codec is configured - the fetch of DataJoint
+ is then wrapped (see enable_fetch_decoding), so encoded and plain values can be read alike.
+ Other references held in blobs are resolved on fetch the same way (e.g. the files of pipeline.signal_store).
+More codecs and compressions can be added with register_codec() and register_compressor(), more references to
+ resolve on fetch with register_fetch_resolver().
+'''
+import json
+from functools import wraps
+
+import numpy as np
+import datajoint as dj
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import blosc
+except ImportError:
+    blosc = None
+
+attribute_codecs = dj.config['custom'].get('blob_codecs', {})
+
+codecs = {}  # name: (encode, decode)
+compressors = {}  # name: (compress, decompress)
+fetch_resolvers = []  # (is_resolved, resolve)
+
+int16_max = np.iinfo(np.int16).max
+int16_nan = np.iinfo(np.int16).min  # NaN marker
+
+codec_magic = b'BLOBCDC1'
+
+
+def register_codec(name, encode, decode):
+    """
+    encode(array): return the encoded array and a dict of its parameters
+    decode(data, **parameters): return the decoded array
+    """
+    codecs[name] = (encode, decode)
+
+
+def register_compressor(name, compress, decompress):
+    """
+    compress(bytes), decompress(bytes): return bytes
+    """
+    compressors[name] = (compress, decompress)
+
+
+def register_fetch_resolver(is_resolved, resolve):
+    """
+    A fetched value for which is_resolved(value) is replaced with resolve(value)
+    """
+    fetch_resolvers.append((is_resolved, resolve))
+
+
+# ============== Codecs ==============
+def encode_float32(array):
+    return array.astype(np.float32), {}
+
+
+def decode_float32(data):
+    return data
+
+
+def encode_int16(array):
+    is_finite = np.isfinite(array)
+    low, high = (array[is_finite].min(), array[is_finite].max()) if is_finite.any() else (0., 0.)
+    offset = (float(high) + float(low)) / 2
+    gain = (float(high) - float(low)) / (2 * int16_max) or 1.
+    data = np.full(array.shape, int16_nan, dtype=np.int16)
+    data[is_finite] = np.round((array[is_finite] - offset) / gain)
+    return data, dict(gain=gain, offset=offset)
+
+
+def decode_int16(data, gain, offset):
+    decoded = data.astype(np.float32) * np.float32(gain) + np.float32(offset)
+    decoded[data == int16_nan] = np.nan
+    return decoded
+
+
+register_codec('float32', encode_float32, decode_float32)
+register_codec('int16', encode_int16, decode_int16)
+if zstandard is not None:
+    register_compressor('zstd', lambda b: zstandard.ZstdCompressor().compress(b),
+                        lambda b: zstandard.ZstdDecompressor().decompress(b))
+if blosc is not None:
+    register_compressor('blosc', blosc.compress, blosc.decompress)
+
+
+class ScaledArray:
+    """
+    Read-only array of int16 data (e.g. a np.memmap) - decoded (see decode_int16) only for the samples indexed
+    """
+
+    def __init__(self, data, gain, offset):
+        self.data = data
+        self.gain = gain
+        self.offset = offset
+        self.shape = data.shape
+        self.ndim = data.ndim
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        return decode_int16(np.asarray(self.data[index]), self.gain, self.offset)
+
+    def __array__(self, dtype=None):
+        decoded = decode_int16(np.asarray(self.data), self.gain, self.offset)
+        return decoded if dtype is None else decoded.astype(dtype)
+
+
+# ============== Envelope ==============
+def pack_envelope(magic, header, data=None):
+    """
+    A blob value holding a JSON-serializable header and an optional array, in a format the legacy (mYm) blob format
+     of DataJoint supports: a uint8 array of magic (8 bytes) + header size (uint32) + JSON header + raw data
+    """
+    header = json.dumps(header).encode()
+    prefix = np.frombuffer(magic + np.uint32(len(header)).tobytes() + header, dtype=np.uint8)
+    if data is None:
+        return prefix.copy()
+    return np.concatenate([prefix, np.ascontiguousarray(data).view(np.uint8).ravel()])
+
+
+def unpack_envelope(value, magic):
+    """
+    Return the header and the raw data (uint8) of a value packed with "magic" - None for any other value
+    """
+    if not (isinstance(value, np.ndarray) and value.dtype == np.uint8 and value.ndim == 1
+            and value[:len(magic)].tobytes() == magic):
+        return None
+    start = len(magic) + 4
+    header_size = int(np.frombuffer(value[len(magic):start].tobytes(), dtype=np.uint32)[0])
+    return json.loads(value[start:start + header_size].tobytes().decode()), value[start + header_size:]
+
+
+# ============== Encode / decode ==============
+def parse_codec(codec):
+    """
+    "int16+zstd" -> ("int16", "zstd"), "float32" -> ("float32", None)
+    """
+    name, _, compression = codec.partition('+')
+    if name not in codecs:
+        raise dj.DataJointError(f'Unknown blob codec: {name} - available: {", ".join(codecs)}')
+    if compression and compression not in compressors:
+        raise dj.DataJointError(f'Unavailable blob compression: {compression} - '
+                                f'available: {", ".join(compressors) or "none (install zstandard or blosc)"}')
+    return name, compression or None
+
+
+def is_encoded(value):
+    return unpack_envelope(value, codec_magic) is not None
+
+
+def encode(array, codec):
+    """
+    Return the value to insert into a longblob attribute for this array, encoded with "codec" (e.g. "int16+zstd")
+    """
+    name, compression = parse_codec(codec)
+    data, parameters = codecs[name][0](np.asarray(array))
+    header = dict(codec=name, compression=compression, shape=data.shape, dtype=data.dtype.str, parameters=parameters)
+    if compression is not None:
+        data = np.frombuffer(compressors[compression][0](np.ascontiguousarray(data).tobytes()), dtype=np.uint8)
+    return pack_envelope(codec_magic, header, data)
+
+
+def decode(value):
+    envelope = unpack_envelope(value, codec_magic)
+    if envelope is None:
+        return value
+    header, data = envelope
+    if header['compression']:
+        data = compressors[header['compression']][1](data.tobytes())
+    data = np.frombuffer(data, dtype=header['dtype']).reshape(header['shape'])
+    return codecs[header['codec']][1](data, **header['parameters'])
+
+
+def get_attribute_codec(attribute):
+    return attribute_codecs.get(attribute)
+
+
+def encode_attribute(attribute, value):
+    """
+    Encode the value of "attribute" with its codec in dj.config['custom']['blob_codecs'] - if any
+    """
+    codec = get_attribute_codec(attribute)
+    return value if codec is None or value is None else encode(value, codec)
+
+
+# ============== Decoding on fetch ==============
+register_fetch_resolver(is_encoded, decode)
+
+
+def resolve(value):
+    """
+    Decode an encoded value, or resolve a reference (see register_fetch_resolver) - anything else is returned as is
+    """
+    for is_resolved, resolve_value in fetch_resolvers:
+        if is_resolved(value):
+            return resolve_value(value)
+    return value
+
+
+def is_resolved(value):
+    return any(is_value_resolved(value) for is_value_resolved, _ in fetch_resolvers)
+
+
+def decode_fetched(fetched):
+    """
+    Decode the encoded values and resolve the references in the result of a fetch() or fetch1() - in place for arrays
+    """
+    if is_resolved(fetched):
+        return resolve(fetched)
+    if isinstance(fetched, np.ndarray):
+        columns = ([fetched[name] for name in fetched.dtype.names if fetched.dtype[name] == object]
+                   if fetched.dtype.names else [fetched] if fetched.dtype == object else [])
+        for column in columns:
+            for idx, value in enumerate(column.flat):
+                if is_resolved(value):
+                    column.flat[idx] = resolve(value)
+        return fetched
+    if isinstance(fetched, dict):
+        return {k: resolve(v) for k, v in fetched.items()}
+    if isinstance(fetched, (list, tuple)):
+        return type(fetched)(decode_fetched(v) for v in fetched)
+    if hasattr(fetched, 'columns'):  # pandas DataFrame
+        for column in fetched.columns[fetched.dtypes == object]:
+            fetched[column] = fetched[column].map(resolve)
+    return fetched
+
+
+def _decoded_fetch(fetch):
+    @wraps(fetch)
+    def wrapper(*args, **kwargs):
+        return decode_fetched(fetch(*args, **kwargs))
+    wrapper.decodes_blobs = True
+    return wrapper
+
+
+def enable_fetch_decoding():
+    """
+    Wrap fetch() and fetch1() of DataJoint to decode/resolve the fetched values (see decode_fetched), in this process
+     - on import, only if a codec (or the signal store) is configured: otherwise the fetches are left as they are,
+     and encoded values are decoded explicitly with decode()
+    """
+    if not getattr(dj.fetch.Fetch.__call__, 'decodes_blobs', False):  # once per process
+        dj.fetch.Fetch.__call__ = _decoded_fetch(dj.fetch.Fetch.__call__)
+        dj.fetch.Fetch1.__call__ = _decoded_fetch(dj.fetch.Fetch1.__call__)
+
+
+if attribute_codecs:
+    enable_fetch_decoding()
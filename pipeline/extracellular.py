@@ -7,11 +7,10 @@ import sys
 from datetime import datetime
 
 import numpy as np
-import scipy.io as sio
 import datajoint as dj
 import tqdm
 
-from . import reference, utilities, acquisition, analysis
+from . import reference, utilities, acquisition, analysis, blob_codec
 from . import extracellular_path
 
 schema = dj.schema(dj.config['custom'].get('database.prefix', '') + 'extracellular')
@@ -50,30 +49,58 @@ class UnitSpikeTimes(dj.Imported):
     ---
     -> reference.Probe.Channel
     spike_times: longblob  # (s) time of each spike, with respect to the start of session 
+    spike_trial_idx: longblob  # trial_id of the trial each spike belongs to
     unit_cell_type='N/A': varchar(32)  # e.g. cell-type of this unit (e.g. wide width, narrow width spiking)
     unit_spike_width: float  # (ms) spike width of this unit, from bottom peak to next positive peak or time point spike terminates
     unit_depth: float  # (um)
-    spike_waveform: longblob  # waveform(s) of each spike at each spike time (spike_time x waveform_timestamps)
+    waveform_mean: longblob  # mean waveform of the spikes of this unit (waveform_timestamps)
+    waveform_std: longblob  # standard deviation of the waveforms of the spikes of this unit (waveform_timestamps)
+    waveform_amplitude=null: float  # peak-to-trough amplitude of the mean waveform
     """
 
+    class Waveform(dj.Part):
+        definition = """ # waveform of each spike of this unit - only fetched when requested explicitly
+        -> master
+        ---
+        spike_waveform: longblob  # waveform(s) of each spike at each spike time (spike_time x waveform_timestamps)
+        spike_amplitudes: longblob  # peak-to-trough amplitude of the waveform of each spike
+        """
+
     def make(self, key):
         sess_data_file = utilities.find_session_matched_matfile(sess_data_dir, key)
 
         if sess_data_file is None:
             raise FileNotFoundError(f'Extracellular import failed: ({key["subject_id"]} - {key["session_time"]})')
 
-        mat_units = sio.loadmat(sess_data_file, struct_as_record=False, squeeze_me=True)['unit']
-        for unit_idx, unit in tqdm.tqdm(enumerate(mat_units)):
-            unit_key = dict(key,
-                            unit_id=unit_idx,
-                            channel_id=unit.channel,
-                            unit_spike_width=unit.SpikeWidth,
-                            unit_depth=unit.Depth,
-                            spike_times=unit.SpikeTimes,
-                            spike_waveform=unit.Spike_shpe_info.SpikeShape)
-            self.insert1(unit_key, allow_direct_insert = True)
+        mat_units = utilities.load_matfile_fields(sess_data_file, 'unit', [
+            'channel', 'SpikeWidth', 'Depth', 'SpikeTimes', 'Trial_idx_of_spike', 'Spike_shpe_info.SpikeShape'])
+        units, unit_waveforms = [], []
+        for unit_idx, (channel, spike_width, depth, spike_times, spike_trial_idx, spike_waveform) in tqdm.tqdm(
+                enumerate(zip(mat_units['channel'], mat_units['SpikeWidth'], mat_units['Depth'],
+                              mat_units['SpikeTimes'], mat_units['Trial_idx_of_spike'],
+                              mat_units['Spike_shpe_info.SpikeShape']))):
+            spike_waveform = get_spike_waveforms(spike_waveform)
+            waveform_mean, waveform_std, waveform_amplitude, spike_amplitudes = summarize_waveforms(spike_waveform)
+            units.append(dict(key,
+                              unit_id=unit_idx,
+                              channel_id=channel,
+                              unit_spike_width=spike_width,
+                              unit_depth=depth,
+                              spike_times=spike_times,
+                              spike_trial_idx=spike_trial_idx,
+                              waveform_mean=waveform_mean,
+                              waveform_std=waveform_std,
+                              waveform_amplitude=waveform_amplitude))
+            unit_waveforms.append(dict(key,
+                                       unit_id=unit_idx,
+                                       spike_waveform=blob_codec.encode_attribute('spike_waveform', spike_waveform),
+                                       spike_amplitudes=spike_amplitudes))
+        utilities.insert_in_batches(self, units, allow_direct_insert=True)
+        utilities.insert_in_batches(self.Waveform, unit_waveforms)
 
 
+# deprecated - one row per unit and trial, no longer populated by scripts/populate.py:
+#  use CompactTrialSegmentedUnitSpikeTimes, read per trial with fetch_trial_segmented_spike_times()
 @schema
 class TrialSegmentedUnitSpikeTimes(dj.Imported):
     definition = """
@@ -87,51 +114,192 @@ class TrialSegmentedUnitSpikeTimes(dj.Imported):
     key_source = ProbeInsertion * analysis.TrialSegmentationSetting
 
     def make(self, key):
-        # get data
-        sess_data_file = utilities.find_session_matched_matfile(sess_data_dir, key)
+        # get event, pre/post stim duration
+        event_name, pre_stim_dur, post_stim_dur = (analysis.TrialSegmentationSetting & key).fetch1(
+            'event', 'pre_stim_duration', 'post_stim_duration')
+        trial_keys, event_times, window_starts, window_stops, unit_ids, spike_times, spike_trial_idx = \
+            get_units_segmentation_inputs(key, event_name, pre_stim_dur, post_stim_dur)
+        trial_ids = np.array([k['trial_id'] for k in trial_keys])
 
-        if sess_data_file is None:
-            raise FileNotFoundError(f'Extracellular import failed: ({key["subject_id"]} - {key["session_time"]})')
+        # batched across units
+        with utilities.BatchInserter(self) as inserter:
+            for unit_id, spk, spk_trial_idx in tqdm.tqdm(zip(unit_ids, spike_times, spike_trial_idx)):
+                seg_spike_times, trial_offsets = analysis.segment_trial_spike_times(
+                    spk, spk_trial_idx, trial_ids, event_times, window_starts, window_stops)
+                inserter.extend(dict({**key, **trial_key},
+                                     unit_id=unit_id,
+                                     segmented_spike_times=seg_spike_times[
+                                         trial_offsets[tr_idx]:trial_offsets[tr_idx + 1]])
+                                for tr_idx, trial_key in enumerate(trial_keys))
 
-        mat_units = sio.loadmat(sess_data_file, struct_as_record = False, squeeze_me = True)['unit']
 
-        unit_ids, spike_times = (UnitSpikeTimes & key).fetch('unit_id', 'spike_times')  # spike_times from all units
-        trial_idx_of_spike = [mat_units[unit_id].Trial_idx_of_spike for unit_id in unit_ids]
+@schema
+class CompactTrialSegmentedUnitSpikeTimes(dj.Imported):
+    definition = """ # trial-segmented spike times of all trials of this unit, concatenated across trials
+    -> UnitSpikeTimes
+    -> analysis.TrialSegmentationSetting
+    ---
+    trial_ids: longblob  # trial_id of the segmented trials, in the order of concatenation
+    segmented_spike_times: longblob  # (s) float32, with respect to the event, concatenated across trials
+    trial_offsets: longblob  # index of the first spike of each trial in "segmented_spike_times" (trial count + 1)
+    """
 
-        trial_keys = (acquisition.TrialSet.Trial & key).fetch('KEY')
+    key_source = ProbeInsertion * analysis.TrialSegmentationSetting
 
+    def make(self, key):
         # get event, pre/post stim duration
         event_name, pre_stim_dur, post_stim_dur = (analysis.TrialSegmentationSetting & key).fetch1(
             'event', 'pre_stim_duration', 'post_stim_duration')
+        trial_keys, event_times, window_starts, window_stops, unit_ids, spike_times, spike_trial_idx = \
+            get_units_segmentation_inputs(key, event_name, pre_stim_dur, post_stim_dur)
+        trial_ids = np.array([k['trial_id'] for k in trial_keys], dtype=int)
+
+        seg_units = []
+        for unit_id, spk, spk_trial_idx in zip(unit_ids, spike_times, spike_trial_idx):
+            seg_spike_times, trial_offsets = analysis.segment_trial_spike_times(
+                spk, spk_trial_idx, trial_ids, event_times, window_starts, window_stops)
+            seg_units.append(dict(key, unit_id=unit_id,
+                                  trial_ids=trial_ids,
+                                  segmented_spike_times=seg_spike_times.astype(np.float32),
+                                  trial_offsets=trial_offsets))
+        utilities.insert_in_batches(self, seg_units)
+
+
+@schema
+class UnitPSTH(dj.Computed):
+    definition = """ # trial-averaged firing rate of this unit, per trial condition
+    -> UnitSpikeTimes
+    -> analysis.TrialSegmentationSetting
+    -> analysis.PSTHParamSet
+    ---
+    psth_time: longblob  # (s) center of each bin, with respect to the event
+    """
+
+    class Condition(dj.Part):
+        definition = """ # PSTH over the good trials of this trial type, response and stim condition
+        -> master
+        -> reference.TrialType
+        -> reference.TrialResponse
+        trial_stim_present: bool  # stim or no-stim trials
+        ---
+        trial_count: int  # number of trials averaged
+        psth: longblob  # (Hz) mean firing rate across trials
+        psth_sem: longblob  # (Hz) standard error of the mean firing rate across trials (NaN for a single trial)
+        """
+
+    key_source = ProbeInsertion * analysis.TrialSegmentationSetting * analysis.PSTHParamSet
+
+    def make(self, key):
+        # get event, pre/post stim duration and binning parameters
+        event_name, pre_stim_dur, post_stim_dur = (analysis.TrialSegmentationSetting & key).fetch1(
+            'event', 'pre_stim_duration', 'post_stim_duration')
+        bin_size, smooth_window = (analysis.PSTHParamSet & key).fetch1('psth_bin_size', 'psth_smooth_window')
+        bin_edges = analysis.get_psth_bin_edges(pre_stim_dur, post_stim_dur, bin_size)
+
+        trial_keys, event_times, window_starts, window_stops, unit_ids, spike_times, spike_trial_idx = \
+            get_units_segmentation_inputs(key, event_name, pre_stim_dur, post_stim_dur)
+
+        # trial conditions, good trials only
+        trial_ids = np.array([k['trial_id'] for k in trial_keys], dtype=int)
+        good_trial_ids, trial_types, trial_responses, trial_stims = (
+                acquisition.TrialSet.Trial & key & 'trial_is_good').fetch(
+            'trial_id', 'trial_type', 'trial_response', 'trial_stim_present')
+        is_good = np.isin(trial_ids, good_trial_ids)
+        trial_ids, event_times = trial_ids[is_good], event_times[is_good]
+        window_starts, window_stops = window_starts[is_good], window_stops[is_good]
+        trial_conditions = dict(zip(good_trial_ids, zip(trial_types, trial_responses, trial_stims)))
+        conditions = {}
+        for tr_idx, tr_id in enumerate(trial_ids):
+            conditions.setdefault(trial_conditions[tr_id], []).append(tr_idx)
+
+        # segment all units, then bin all units x trials in one pass
+        seg_spike_times, seg_offsets, spike_counts = [], [], 0
+        for spk, spk_trial_idx in zip(spike_times, spike_trial_idx):
+            unit_seg_spike_times, unit_offsets = analysis.segment_trial_spike_times(
+                spk, spk_trial_idx, trial_ids, event_times, window_starts, window_stops)
+            seg_spike_times.append(unit_seg_spike_times)
+            seg_offsets.append(unit_offsets[:-1] + spike_counts)
+            spike_counts += len(unit_seg_spike_times)
+        seg_spike_times = np.concatenate(seg_spike_times) if seg_spike_times else np.array([])
+        seg_offsets = np.concatenate(seg_offsets + [[spike_counts]]).astype(int)
+        spike_counts = analysis.bin_spike_times(seg_spike_times, seg_offsets, bin_edges)
+        firing_rates = analysis.smooth_psth(
+            spike_counts.reshape(len(unit_ids), len(trial_ids), len(bin_edges) - 1) / float(bin_size), smooth_window)
+
+        psth_time = (bin_edges[:-1] + bin_edges[1:]) / 2
+        utilities.insert_in_batches(self, (dict(key, unit_id=unit_id, psth_time=psth_time) for unit_id in unit_ids))
+        psth_conditions = []
+        for (trial_type, trial_response, trial_stim), tr_idx in conditions.items():
+            cond_rates = firing_rates[:, tr_idx, :]
+            psth = cond_rates.mean(axis=1)
+            psth_sem = (cond_rates.std(axis=1, ddof=1) / np.sqrt(len(tr_idx)) if len(tr_idx) > 1
+                        else np.full_like(psth, np.nan))
+            psth_conditions.extend(dict(key, unit_id=unit_id,
+                                        trial_type=trial_type, trial_response=trial_response,
+                                        trial_stim_present=trial_stim,
+                                        trial_count=len(tr_idx),
+                                        psth=psth[u_idx], psth_sem=psth_sem[u_idx])
+                                   for u_idx, unit_id in enumerate(unit_ids))
+        utilities.insert_in_batches(self.Condition, psth_conditions)
+        print(f'Compute PSTH of {len(unit_ids)} units - {len(conditions)} trial conditions')
+
+
+def fetch_trial_segmented_spike_times(key):
+    """
+    Fetch the trial-segmented spike times of the unit(s) and trial-segmentation setting(s) in "key"
+     from CompactTrialSegmentedUnitSpikeTimes - one blob read per unit
+    Return a list (one per unit and setting) of dict with the primary key, "trial_ids"
+     and "segmented_spike_times" - the list of per-trial spike times (views into the concatenated array)
+    """
+    seg_units = (CompactTrialSegmentedUnitSpikeTimes & key).fetch(as_dict=True)
+    for seg_unit in seg_units:
+        seg_unit['segmented_spike_times'] = utilities.split_by_offsets(seg_unit['segmented_spike_times'],
+                                                                       seg_unit.pop('trial_offsets'))
+    return seg_units
+
+
+def get_spike_waveforms(spike_waveform):
+    """
+    The waveforms of the spikes of a unit as a (spike x sample) array - a single spike may be read as a 1-D array
+    """
+    spike_waveform = np.asarray(spike_waveform)
+    if spike_waveform.ndim == 1:  # a single spike, or none
+        spike_waveform = spike_waveform[None, :] if spike_waveform.size else np.zeros((0, 0))
+    return spike_waveform
+
+
+def summarize_waveforms(spike_waveform):
+    """
+    Mean and standard deviation of the (spike x sample) waveforms of a unit, the peak-to-trough amplitude
+     of the mean waveform (None without spikes) and the peak-to-trough amplitude of each spike
+    """
+    if not spike_waveform.size:
+        return np.array([]), np.array([]), None, np.zeros(len(spike_waveform))
+    waveform_mean = spike_waveform.mean(axis=0)
+    return (waveform_mean, spike_waveform.std(axis=0), float(np.ptp(waveform_mean)),
+            np.ptp(spike_waveform, axis=1))
+
+
+def get_units_segmentation_inputs(key, event_name, pre_stim_dur, post_stim_dur):
+    """
+    Get the inputs to trial-segment all units in "key" around "event_name"
+     + trial_keys, event_times, window_starts, window_stops: per trial - trials without a valid event time are skipped
+     + unit_ids, spike_times, spike_trial_idx: per unit
+    """
+    # get event time and segmentation window of all trials - trials without a valid event time are skipped
+    trial_keys, trial_starts, trial_stops, event_times = analysis.get_trials_event_time(event_name, key)
+    is_valid = ~np.isnan(event_times)
+    if not is_valid.all():
+        print(f'Trial segmentation error - Msg: {event_name}: event not found or nan in '
+              f'{np.sum(~is_valid)} trial(s)', file=sys.stderr)
+    trial_keys = [k for k, valid in zip(trial_keys, is_valid) if valid]
+    event_times = event_times[is_valid]
+    # spike times and event times here are both with respect to the start of the trial
+    window_starts, window_stops = analysis.get_trials_segmentation_window(
+        event_times, trial_starts[is_valid], trial_stops[is_valid], pre_stim_dur, post_stim_dur)
+
+    # get data - spike times and the trial of each spike, from all units
+    unit_ids, spike_times, spike_trial_idx = (UnitSpikeTimes & key).fetch(
+        'unit_id', 'spike_times', 'spike_trial_idx')
 
-        for trial_key in tqdm.tqdm(trial_keys):
-            # get event time - this is done per trial
-            try:
-                event_time_point = analysis.get_event_time(event_name, trial_key)
-            except analysis.EventChoiceError as e:
-                print(f'Trial segmentation error - Msg: {str(e)}', file=sys.stderr)
-                continue
-
-            pre_stim_dur = float(pre_stim_dur)
-            post_stim_dur = float(post_stim_dur)
-            # check if pre/post stim dur is within start/stop time
-            trial_start, trial_stop = (acquisition.TrialSet.Trial & trial_key).fetch1('start_time', 'stop_time')
-            if trial_start and event_time_point - pre_stim_dur < 0:
-                print('Warning: Out of bound prestimulus duration, select spikes from start-time (t=0)')
-                pre_stim_dur = event_time_point
-            if trial_stop and event_time_point + post_stim_dur > trial_stop:
-                print('Warning: Out of bound poststimulus duration, set to trial end time')
-                post_stim_dur = trial_stop - event_time_point
-
-            # get spike times of each unit for this trial
-            trial_spike_times = [spk[tr_spk_idx == trial_key['trial_id']]
-                                 for spk, tr_spk_idx in zip(spike_times, trial_idx_of_spike)]
-            # further segment based on pre/post stimulus duration
-            seg_trial_spike_times = [spk[np.logical_and((spk >= (event_time_point - pre_stim_dur)),
-                                                        (spk <= (event_time_point + post_stim_dur)))] - event_time_point
-                                     for spk in trial_spike_times]
-
-            self.insert(dict({**key, **trial_key},
-                             unit_id=u_id,
-                             segmented_spike_times=spk)
-                        for u_id, spk in zip(unit_ids, seg_trial_spike_times))
+    return trial_keys, event_times, window_starts, window_stops, unit_ids, spike_times, spike_trial_idx
@@ -7,10 +7,9 @@ import sys
 from datetime import datetime
 
 import numpy as np
-import scipy.io as sio
 import datajoint as dj
 
-from . import reference, utilities, acquisition, analysis
+from . import reference, utilities, acquisition, analysis, signal_store, blob_codec
 from . import intracellular_path
 
 schema = dj.schema(dj.config['custom'].get('database.prefix', '') + 'intracellular')
@@ -36,7 +35,7 @@ class MembranePotential(dj.Imported):
     -> Cell
     ---
     membrane_potential: longblob  # (mV) membrane potential recording at this cell
-    membrane_potential_wo_spike: longblob # (mV) membrane potential without spike data, derived from membrane potential recording    
+    membrane_potential_wo_spike: longblob # (mV) membrane potential without spike data, derived from membrane potential recording
     membrane_potential_start_time: float # (s) first timepoint of membrane potential recording
     membrane_potential_sampling_rate: float # (Hz) sampling rate of membrane potential recording
     """
@@ -48,17 +47,19 @@ class MembranePotential(dj.Imported):
         if sess_data_file is None:
             raise FileNotFoundError(f'Intracellular import failed: ({key["subject_id"]} - {key["session_time"]})')
 
-        mat_data = sio.loadmat(sess_data_file, struct_as_record = False, squeeze_me = True)['wholeCell']
+        mat_data = utilities.load_matfile_fields(sess_data_file, 'wholeCell', [
+            'recording_data.Vm', 'recording_data.Vm_wo_spike', 'recording_data.sample_rate'])
 
         #  ============= Now read the data and start ingesting =============
         print(f'Insert membrane potential data for: {key["cell_id"]}')
         # -- MembranePotential
         self.insert1(dict(
             key,
-            membrane_potential=mat_data.recording_data.Vm,
-            membrane_potential_wo_spike=mat_data.recording_data.Vm_wo_spike,
+            membrane_potential=signal_store.put(mat_data['recording_data.Vm'], 'membrane_potential'),
+            membrane_potential_wo_spike=signal_store.put(mat_data['recording_data.Vm_wo_spike'],
+                                                        'membrane_potential_wo_spike'),
             membrane_potential_start_time=0,
-            membrane_potential_sampling_rate=mat_data.recording_data.sample_rate))
+            membrane_potential_sampling_rate=mat_data['recording_data.sample_rate']))
 
 
 @schema
@@ -82,16 +83,17 @@ class CurrentInjection(dj.Imported):
         if sess_data_file is None:
             raise FileNotFoundError(f'Intracellular import failed: ({key["subject_id"]} - {key["session_time"]})')
 
-        mat_data = sio.loadmat(sess_data_file, struct_as_record = False, squeeze_me = True)['wholeCell']
+        mat_data = utilities.load_matfile_fields(sess_data_file, 'wholeCell', [
+            'meta_data.injected_current', 'recording_data.Output_700B', 'recording_data.sample_rate'])
 
         #  ============= Now read the data and start ingesting =============
         print(f'Insert current injection data for: {key["cell_id"]}')
         self.insert1(dict(
             key,
-            injected_current=mat_data.meta_data.injected_current,
-            current_injection=mat_data.recording_data.Output_700B,
+            injected_current=mat_data['meta_data.injected_current'],
+            current_injection=signal_store.put(mat_data['recording_data.Output_700B'], 'current_injection'),
             current_injection_start_time=0,
-            current_injection_sampling_rate=mat_data.recording_data.sample_rate))
+            current_injection_sampling_rate=mat_data['recording_data.sample_rate']))
 
 
 @schema
@@ -109,14 +111,15 @@ class CellSpikeTimes(dj.Imported):
         if sess_data_file is None:
             raise FileNotFoundError(f'Intracellular import failed: ({key["subject_id"]} - {key["session_time"]})')
 
-        mat_data = sio.loadmat(sess_data_file, struct_as_record = False, squeeze_me = True)['wholeCell']
+        mat_data = utilities.load_matfile_fields(sess_data_file, 'wholeCell', [
+            'recording_data.spike_peak_bin', 'recording_data.sample_rate'])
 
         #  ============= Now read the data and start ingesting =============
         print(f'Insert spikes data for: {key["cell_id"]}')
         # -- Spike
         self.insert1(dict(
             key,
-            spike_times=mat_data.recording_data.spike_peak_bin / mat_data.recording_data.sample_rate))
+            spike_times=mat_data['recording_data.spike_peak_bin'] / mat_data['recording_data.sample_rate']))
 
 
 @schema
@@ -140,20 +143,18 @@ class TrialSegmentedMembranePotential(dj.Computed):
         fs, first_time_point, Vm_wo_spike, Vm_w_spike = (MembranePotential & key).fetch1(
             'membrane_potential_sampling_rate', 'membrane_potential_start_time', 'membrane_potential_wo_spike',
             'membrane_potential')
+        Vm_wo_spike, Vm_w_spike = signal_store.get(Vm_wo_spike), signal_store.get(Vm_w_spike)
 
-        # Limit to insert size of 15 per insert
-        insert_size = 15
-        trial_lists = utilities.split_list((acquisition.TrialSet.Trial & key).fetch('KEY'), insert_size)
+        # segment all trials at once
+        trial_keys, segmented_mp, segmented_mp_wo_spike = analysis.segment_session_signals(
+            key, event_name, pre_stim_dur, post_stim_dur, [Vm_w_spike, Vm_wo_spike], fs, first_time_point)
 
-        for b_idx, trials in enumerate(trial_lists):
-            self.insert(dict({**key, **trial_key},
-                             segmented_mp = perform_trial_segmentation(trial_key, event_name,
-                                                                        pre_stim_dur, post_stim_dur,
-                                                                        Vm_w_spike, fs, first_time_point),
-                             segmented_mp_wo_spike = perform_trial_segmentation(trial_key, event_name,
-                                                                                 pre_stim_dur, post_stim_dur,
-                                                                                 Vm_wo_spike, fs, first_time_point))
-                        for trial_key in trials)
+        utilities.insert_in_batches(self, (dict({**key, **trial_key},
+                                                segmented_mp=blob_codec.encode_attribute('segmented_mp', mp),
+                                                segmented_mp_wo_spike=blob_codec.encode_attribute(
+                                                    'segmented_mp_wo_spike', mp_wo_spike))
+                                           for trial_key, mp, mp_wo_spike in zip(trial_keys, segmented_mp,
+                                                                                 segmented_mp_wo_spike)))
 
 
 @schema
@@ -175,12 +176,16 @@ class TrialSegmentedCurrentInjection(dj.Computed):
         # get raw
         fs, first_time_point, current_injection = (CurrentInjection & key).fetch1(
             'current_injection_sampling_rate', 'current_injection_start_time', 'current_injection')
-        self.insert(dict({**key, **trial_key},
-                         segmented_current_injection = perform_trial_segmentation(trial_key, event_name,
-                                                                                  pre_stim_dur, post_stim_dur,
-                                                                                  current_injection, fs,
-                                                                                  first_time_point))
-                    for trial_key in (acquisition.TrialSet.Trial & key).fetch('KEY'))
+        current_injection = signal_store.get(current_injection)
+
+        # segment all trials at once
+        trial_keys, segmented_current_injection = analysis.segment_session_signals(
+            key, event_name, pre_stim_dur, post_stim_dur, [current_injection], fs, first_time_point)
+
+        utilities.insert_in_batches(self, (dict({**key, **trial_key},
+                                                segmented_current_injection=blob_codec.encode_attribute(
+                                                    'segmented_current_injection', current))
+                                           for trial_key, current in zip(trial_keys, segmented_current_injection)))
 
 
 @schema
@@ -193,71 +198,43 @@ class TrialSegmentedCellSpikeTimes(dj.Computed):
     segmented_spike_times: longblob
     """
 
+    key_source = CellSpikeTimes * analysis.TrialSegmentationSetting
+
     def make(self, key):
         # get event, pre/post stim duration
         event_name, pre_stim_dur, post_stim_dur = (analysis.TrialSegmentationSetting & key).fetch1(
             'event', 'pre_stim_duration', 'post_stim_duration')
-        # get event time
-        try:
-            event_time_point = analysis.get_event_time(event_name, key)
-        except analysis.EventChoiceError as e:
-            raise e
-
-        pre_stim_dur = float(pre_stim_dur)
-        post_stim_dur = float(post_stim_dur)
-        # check if pre/post stim dur is within start/stop time
-        trial_start, trial_stop = (acquisition.TrialSet.Trial & key).fetch1('start_time', 'stop_time')
-        event_time_point = event_time_point + trial_start
-
-        if trial_start and event_time_point - pre_stim_dur < 0:
-            print('Warning: Out of bound pre-stim dur, select spikes from start-time (t=0)')
-            pre_stim_dur = event_time_point - trial_start
-        if event_time_point + post_stim_dur > trial_stop:
-            print('Warning: Out of bound post-stim dur, set to trial end time')
-            post_stim_dur = trial_stop - event_time_point
-
-        # get raw & segment
-        spike_times = (CellSpikeTimes & key).fetch1('spike_times')
-        key['segmented_spike_times'] = spike_times[np.logical_and(
-            (spike_times >= (event_time_point - pre_stim_dur)),
-            (spike_times <= (event_time_point + post_stim_dur)))] - event_time_point
-
-        self.insert1(key)
-        print(f'Perform trial-seg spike times for cell: {key["cell_id"]} - trial: {key["trial_id"]}')
-
-
-def perform_trial_segmentation(trial_key, event_name, pre_stim_dur, post_stim_dur, data, fs, first_time_point):
-    # get event time
-    try:
-        event_time_point = analysis.get_event_time(event_name, trial_key)
-    except analysis.EventChoiceError as e:
-        raise e
-    #
-    pre_stim_dur = float(pre_stim_dur)
-    post_stim_dur = float(post_stim_dur)
-    sample_total = int((post_stim_dur + pre_stim_dur)*fs) + 1
-    # check if pre/post stim dur is within start/stop time, if not, pad with NaNs
-    trial_start, trial_stop = (acquisition.TrialSet.Trial & trial_key).fetch1('start_time', 'stop_time')
-    event_time_point = event_time_point + trial_start
-
-    pre_stim_nan_count = 0
-    post_stim_nan_count = 0
-    if trial_start and event_time_point - pre_stim_dur < trial_start:
-        pre_stim_nan_count = int(np.ceil((trial_start - (event_time_point - pre_stim_dur)) * fs))
-        pre_stim_dur = event_time_point - trial_start
-        print(f'Warning: Out-of-bound pre-stim dur, pad {pre_stim_nan_count} NaNs')
-    if trial_stop and event_time_point + post_stim_dur > trial_stop:
-        post_stim_nan_count = int(np.ceil((event_time_point + post_stim_dur - trial_stop) * fs))
-        post_stim_dur = trial_stop - event_time_point
-        print(f'Warning: Out-of-bound post-stim dur, pad {post_stim_nan_count} NaNs')
-
-    event_sample_point = (event_time_point - first_time_point) * fs
-    sample_points_to_extract = range((event_sample_point - pre_stim_dur * fs).astype(int),
-                                     (event_sample_point + post_stim_dur * fs + 1).astype(int))
-    segmented_data = data[sample_points_to_extract]
-    # pad with NaNs
-    segmented_data = np.hstack((np.full(pre_stim_nan_count, np.nan), segmented_data,
-                                np.full(post_stim_nan_count, np.nan)))
-    return segmented_data[:sample_total]
+        trial_keys, seg_spike_times, trial_offsets = segment_cell_spike_times(
+            key, event_name, pre_stim_dur, post_stim_dur)
 
+        utilities.insert_in_batches(self, (dict({**key, **trial_key},
+                                                segmented_spike_times=seg_spike_times[
+                                                    trial_offsets[tr_idx]:trial_offsets[tr_idx + 1]])
+                                           for tr_idx, trial_key in enumerate(trial_keys)))
+        print(f'Perform trial-seg spike times for cell: {key["cell_id"]} - {len(trial_keys)} trials')
 
+
+def segment_cell_spike_times(key, event_name, pre_stim_dur, post_stim_dur):
+    """
+    Trial-segment the spike times of the cell in "key" for all trials, around "event_name"
+    Trials without a valid event time are skipped
+    Return the keys of the segmented trials, the concatenated segmented spike times and the trial offsets
+    """
+    # get event time of all trials - trials without a valid event time are skipped
+    trial_keys, trial_starts, trial_stops, event_times = analysis.get_trials_event_time(event_name, key)
+    is_valid = ~np.isnan(event_times)
+    if not is_valid.all():
+        print(f'Trial segmentation error - Msg: {event_name}: event not found or nan in '
+              f'{np.sum(~is_valid)} trial(s)', file=sys.stderr)
+    trial_keys = [k for k, valid in zip(trial_keys, is_valid) if valid]
+    trial_starts, trial_stops = trial_starts[is_valid], trial_stops[is_valid]
+    # spike times, event times and trial stop times here are all with respect to the start of the session
+    event_times = event_times[is_valid] + trial_starts
+    window_starts, window_stops = analysis.get_trials_segmentation_window(
+        event_times, trial_starts, trial_stops, pre_stim_dur, post_stim_dur)
+
+    # get raw & segment
+    spike_times = (CellSpikeTimes & key).fetch1('spike_times')
+    seg_spike_times, trial_offsets = analysis.segment_spike_times(
+        spike_times, event_times, window_starts, window_stops)
+    return trial_keys, seg_spike_times, trial_offsets
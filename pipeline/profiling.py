@@ -0,0 +1,201 @@
+'''
+Opt-in profiling of the make() calls of all imported/computed tables of the pipeline.
+profiling.enable(profile_dir) patches make(), fetch/fetch1, insert and the MAT-file loaders, so that each make() call
+ records its wall time per phase:
+ + file_load: utilities.load_matfile_fields
+ + fetch: DataJoint fetch() and fetch1()
+ + insert: DataJoint insert() and insert1() - with the number of rows and an estimate of the bytes inserted
+ + compute: the rest of the make() time
+ and the peak RSS of the process during the make() (on Linux, the peak is reset at the start of each make(); elsewhere
+ it is only known if the lifetime peak of the process rose during the make()).
+Each process appends its records to "profile_<pid>.jsonl" in profile_dir (works across populate worker processes),
+ profiling.write_report(profile_dir) aggregates them into per-table percentiles (report.json) and all records (report.csv)
+enable() removes the records and reports of previous runs from profile_dir.
+e.g.
+    profiling.enable('profile')
+    intracellular.MembranePotential.populate()
+    profiling.write_report('profile')
+'''
+import os
+import csv
+import glob
+import json
+import time
+import resource
+from functools import wraps
+
+import numpy as np
+import datajoint as dj
+
+from . import utilities, reference, subject, acquisition, analysis, behavior, extracellular, intracellular, stimulation
+
+phases = ('file_load', 'fetch', 'insert', 'compute')
+metrics = ('duration',) + phases + ('rows_inserted', 'bytes_inserted', 'peak_rss_mb')
+percentiles = (50, 90, 99, 100)
+
+_profile_dir = None
+_current = None  # record of the make() being profiled
+_patched = {}  # (owner, attribute name): original
+
+
+def _timed_phase(phase, func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        # only time the outermost phase (e.g. a fetch in an insert)
+        if _current is None or _current['_phase'] is not None:
+            return func(*args, **kwargs)
+        _current['_phase'] = phase
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current[phase] += time.perf_counter() - start
+            _current['_phase'] = None
+    return wrapper
+
+
+def _counted_insert(func):
+    timed_insert = _timed_phase('insert', func)
+
+    @wraps(func)
+    def wrapper(self, rows, *args, **kwargs):
+        if _current is None or _current['_phase'] is not None:
+            return func(self, rows, *args, **kwargs)
+        if not isinstance(rows, (list, tuple, np.ndarray)) and not hasattr(rows, 'fetch'):
+            rows = list(rows)  # count the rows of a generator
+        if not hasattr(rows, 'fetch'):  # insert from a query runs on the server
+            _current['rows_inserted'] += len(rows)
+            _current['bytes_inserted'] += utilities.get_nbytes(rows)
+        return timed_insert(self, rows, *args, **kwargs)
+    return wrapper
+
+
+def _reset_peak_rss():
+    """
+    Reset the peak RSS of this process to its current RSS - Linux only, return False if not supported
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _get_peak_rss_mb(is_reset, start_maxrss):
+    if is_reset:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    # the lifetime peak of the process - that of this make() only if it rose during it
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 1024 if maxrss > start_maxrss else None
+
+
+def _profiled_make(table_name, make):
+    @wraps(make)
+    def wrapper(self, key):
+        global _current
+        if _current is not None:  # a make() calling another make() is part of the outer one
+            return make(self, key)
+        _current = dict({p: 0. for p in phases}, _phase=None, rows_inserted=0, bytes_inserted=0)
+        is_rss_reset = _reset_peak_rss()
+        start_maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        try:
+            return make(self, key)
+        finally:
+            record, _current = _current, None
+            record.pop('_phase')
+            record['duration'] = time.perf_counter() - start
+            record['compute'] = max(record['duration'] - sum(record[p] for p in phases if p != 'compute'), 0.)
+            record['peak_rss_mb'] = _get_peak_rss_mb(is_rss_reset, start_maxrss)
+            record.update(table=table_name, key=json.dumps(key, default=str, sort_keys=True))
+            with open(os.path.join(_profile_dir, f'profile_{os.getpid()}.jsonl'), 'a') as f:
+                f.write(json.dumps(record) + '\n')
+    return wrapper
+
+
+def _patch(owner, name, wrapper):
+    if (owner, name) not in _patched:
+        _patched[(owner, name)] = getattr(owner, name)
+        setattr(owner, name, wrapper(getattr(owner, name)))
+
+
+def get_profiled_tables():
+    """
+    All imported/computed tables of the pipeline that implement make()
+    """
+    tables = []
+    for module in (reference, subject, acquisition, analysis, behavior, extracellular, intracellular, stimulation):
+        for obj in vars(module).values():
+            if (isinstance(obj, type) and issubclass(obj, (dj.Imported, dj.Computed))
+                    and obj.__module__ == module.__name__ and 'make' in vars(obj)):
+                tables.append((f'{module.__name__.split(".")[-1]}.{obj.__name__}', obj))
+    return tables
+
+
+def enable(profile_dir):
+    """
+    Start profiling the make() calls of this process (and of the processes forked from it) into "profile_dir"
+     - the records and reports of previous runs in "profile_dir" are removed
+    """
+    global _profile_dir
+    os.makedirs(profile_dir, exist_ok=True)
+    _profile_dir = os.path.abspath(profile_dir)
+    for fpath in glob.glob(os.path.join(_profile_dir, 'profile_*.jsonl')) + [
+            os.path.join(_profile_dir, f) for f in ('report.json', 'report.csv')]:
+        if os.path.exists(fpath):
+            os.remove(fpath)
+
+    for table_name, table in get_profiled_tables():
+        _patch(table, 'make', lambda make, table_name=table_name: _profiled_make(table_name, make))
+    _patch(dj.table.Table, 'insert', _counted_insert)
+    _patch(dj.fetch.Fetch, '__call__', lambda func: _timed_phase('fetch', func))
+    _patch(dj.fetch.Fetch1, '__call__', lambda func: _timed_phase('fetch', func))
+    _patch(utilities, 'load_matfile_fields', lambda func: _timed_phase('file_load', func))
+
+
+def disable():
+    """
+    Stop profiling - restore all patched functions
+    """
+    for (owner, name), original in _patched.items():
+        setattr(owner, name, original)
+    _patched.clear()
+
+
+def read_records(profile_dir):
+    records = []
+    for fpath in sorted(glob.glob(os.path.join(profile_dir, 'profile_*.jsonl'))):
+        with open(fpath) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+
+def write_report(profile_dir):
+    """
+    Aggregate the records of all processes in "profile_dir" into:
+     + report.json: per table, the number of make() calls, the total and the percentiles of each metric
+     + report.csv: one row per make() call
+    Return the per-table report
+    """
+    records = read_records(profile_dir)
+    report = {}
+    for table_name in sorted({r['table'] for r in records}):
+        table_records = [r for r in records if r['table'] == table_name]
+        report[table_name] = {'make_calls': len(table_records)}
+        for metric in metrics:
+            values = np.array([r[metric] for r in table_records], dtype=float)  # None (unknown) -> NaN
+            values = values[~np.isnan(values)]
+            report[table_name][metric] = dict(total=values.sum(), **{
+                f'p{p}': np.percentile(values, p) if values.size else None for p in percentiles})
+
+    with open(os.path.join(profile_dir, 'report.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    with open(os.path.join(profile_dir, 'report.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=('table', 'key') + metrics)
+        writer.writeheader()
+        writer.writerows(records)
+    return report
@@ -0,0 +1,167 @@
+'''
+On-demand trial-segmentation, for any alignment (event, pre/post-stimulus duration) - not only the ones
+ in analysis.TrialSegmentationSetting. The raw data are segmented at fetch time and nothing is stored.
+Results are memoized per recording and alignment in an LRU cache
+ (in MB, set with dj.config['custom']['segmentation_cache_size'] - 0 disables caching), keyed on the content hash
+ of the recording and of the trials and event times of its session (see utilities.get_content_hash) - data deleted
+ and re-ingested, in this or another process, are segmented again.
+Cached arrays are shared between calls and should not be modified in place.
+e.g.
+    segmentation.segment_membrane_potential({'cell_id': 'cell_96'}, 'delay_start', 2, 4)
+'''
+import numpy as np
+import datajoint as dj
+
+from . import utilities, acquisition, analysis, intracellular, extracellular, stimulation, behavior, signal_store
+
+segmentation_cache_size = dj.config['custom'].get('segmentation_cache_size', 1024)
+segmentation_cache = utilities.LRUCache(segmentation_cache_size * 1024 ** 2)
+
+
+def clear_segmentation_cache():
+    segmentation_cache.clear()
+
+
+def _get_or_segment(table, key, event_name, pre_stim_dur, post_stim_dur, segment):
+    session_key = {k: key[k] for k in acquisition.Session.primary_key}
+    content_hash = utilities.get_content_hash([table & key, acquisition.TrialSet.Trial & session_key,
+                                               acquisition.TrialSet.EventTime & session_key])
+    cache_key = (table.full_table_name, tuple(sorted(key.items())), event_name, float(pre_stim_dur),
+                 float(post_stim_dur), content_hash)
+    segmented = segmentation_cache.get(cache_key)
+    if segmented is None:
+        segmented = segment()
+        segmentation_cache.put(cache_key, segmented)
+    return segmented
+
+
+def _get_trial_ids(trial_keys):
+    return np.array([k['trial_id'] for k in trial_keys], dtype=int)
+
+
+def segment_membrane_potential(restriction, event_name, pre_stim_dur, post_stim_dur):
+    """
+    Trial-segment the membrane potential of the cell(s) in "restriction", around "event_name"
+    Return a list (one per cell) of dict with the primary key of MembranePotential, "trial_ids",
+     "segmented_mp" and "segmented_mp_wo_spike" - one array per trial
+    """
+    def segment(key):
+        fs, first_time_point, Vm_wo_spike, Vm_w_spike = (intracellular.MembranePotential & key).fetch1(
+            'membrane_potential_sampling_rate', 'membrane_potential_start_time', 'membrane_potential_wo_spike',
+            'membrane_potential')
+        trial_keys, segmented_mp, segmented_mp_wo_spike = analysis.segment_session_signals(
+            key, event_name, pre_stim_dur, post_stim_dur,
+            [signal_store.get(Vm_w_spike), signal_store.get(Vm_wo_spike)], fs, first_time_point)
+        return dict(key, trial_ids=_get_trial_ids(trial_keys),
+                    segmented_mp=segmented_mp, segmented_mp_wo_spike=segmented_mp_wo_spike)
+
+    return [_get_or_segment(intracellular.MembranePotential, key, event_name, pre_stim_dur, post_stim_dur,
+                            lambda: segment(key))
+            for key in (intracellular.MembranePotential & restriction).fetch('KEY')]
+
+
+def segment_current_injection(restriction, event_name, pre_stim_dur, post_stim_dur):
+    """
+    Trial-segment the current injection of the cell(s) in "restriction", around "event_name"
+    Return a list (one per cell) of dict with the primary key of CurrentInjection, "trial_ids"
+     and "segmented_current_injection" - one array per trial
+    """
+    def segment(key):
+        fs, first_time_point, current_injection = (intracellular.CurrentInjection & key).fetch1(
+            'current_injection_sampling_rate', 'current_injection_start_time', 'current_injection')
+        trial_keys, segmented_current_injection = analysis.segment_session_signals(
+            key, event_name, pre_stim_dur, post_stim_dur,
+            [signal_store.get(current_injection)], fs, first_time_point)
+        return dict(key, trial_ids=_get_trial_ids(trial_keys),
+                    segmented_current_injection=segmented_current_injection)
+
+    return [_get_or_segment(intracellular.CurrentInjection, key, event_name, pre_stim_dur, post_stim_dur,
+                            lambda: segment(key))
+            for key in (intracellular.CurrentInjection & restriction).fetch('KEY')]
+
+
+def segment_photostim(restriction, event_name, pre_stim_dur, post_stim_dur):
+    """
+    Trial-segment the photostim timeseries of the session(s) in "restriction", around "event_name"
+    Return a list (one per photostimulation) of dict with the primary key of PhotoStimulation, "trial_ids"
+     and "segmented_photostim" - one array per trial
+    """
+    def segment(key):
+        fs, first_time_point, photostim_timeseries = (stimulation.PhotoStimulation & key).fetch1(
+            'photostim_sampling_rate', 'photostim_start_time', 'photostim_timeseries')
+        trial_keys, segmented_photostim = analysis.segment_session_signals(
+            key, event_name, pre_stim_dur, post_stim_dur,
+            [signal_store.get(photostim_timeseries)], fs, first_time_point)
+        return dict(key, trial_ids=_get_trial_ids(trial_keys), segmented_photostim=segmented_photostim)
+
+    return [_get_or_segment(stimulation.PhotoStimulation, key, event_name, pre_stim_dur, post_stim_dur,
+                            lambda: segment(key))
+            for key in ((stimulation.PhotoStimulation - 'photostim_timeseries is NULL')
+                        & restriction).fetch('KEY')]
+
+
+def segment_cell_spike_times(restriction, event_name, pre_stim_dur, post_stim_dur):
+    """
+    Trial-segment the spike times of the cell(s) in "restriction", around "event_name"
+    Return a list (one per cell) of dict with the primary key of CellSpikeTimes, "trial_ids"
+     and "segmented_spike_times" - one array per trial
+    """
+    def segment(key):
+        trial_keys, seg_spike_times, trial_offsets = intracellular.segment_cell_spike_times(
+            key, event_name, pre_stim_dur, post_stim_dur)
+        return dict(key, trial_ids=_get_trial_ids(trial_keys),
+                    segmented_spike_times=utilities.split_by_offsets(seg_spike_times, trial_offsets))
+
+    return [_get_or_segment(intracellular.CellSpikeTimes, key, event_name, pre_stim_dur, post_stim_dur,
+                            lambda: segment(key))
+            for key in (intracellular.CellSpikeTimes & restriction).fetch('KEY')]
+
+
+def segment_unit_spike_times(restriction, event_name, pre_stim_dur, post_stim_dur):
+    """
+    Trial-segment the spike times of the unit(s) in "restriction", around "event_name"
+     (all units of a probe insertion are segmented and cached together)
+    Return a list (one per unit) of dict with the primary key of UnitSpikeTimes, "trial_ids"
+     and "segmented_spike_times" - one array per trial
+    """
+    def segment(key):
+        trial_keys, event_times, window_starts, window_stops, unit_ids, spike_times, spike_trial_idx = \
+            extracellular.get_units_segmentation_inputs(key, event_name, pre_stim_dur, post_stim_dur)
+        trial_ids = _get_trial_ids(trial_keys)
+        seg_units = {}
+        for unit_id, spk, spk_trial_idx in zip(unit_ids, spike_times, spike_trial_idx):
+            seg_spike_times, trial_offsets = analysis.segment_trial_spike_times(
+                spk, spk_trial_idx, trial_ids, event_times, window_starts, window_stops)
+            seg_units[unit_id] = dict(key, unit_id=unit_id, trial_ids=trial_ids,
+                                      segmented_spike_times=utilities.split_by_offsets(seg_spike_times,
+                                                                                       trial_offsets))
+        return seg_units
+
+    seg_units, seg_probes = [], {}
+    for unit_key in (extracellular.UnitSpikeTimes & restriction).fetch('KEY'):
+        probe_key = {k: unit_key[k] for k in extracellular.ProbeInsertion.primary_key}
+        probe_cache_key = tuple(sorted(probe_key.items()))
+        if probe_cache_key not in seg_probes:
+            seg_probes[probe_cache_key] = _get_or_segment(extracellular.UnitSpikeTimes, probe_key, event_name,
+                                                          pre_stim_dur, post_stim_dur, lambda: segment(probe_key))
+        seg_units.append(seg_probes[probe_cache_key][unit_key['unit_id']])
+    return seg_units
+
+
+def segment_lick_times(restriction, event_name, pre_stim_dur, post_stim_dur):
+    """
+    Trial-segment the lick times of the session(s) in "restriction", around "event_name"
+    Return a list (one per session) of dict with the primary key of LickTimes, "trial_ids"
+     and, per lick type (e.g. "segmented_lick_left_on"), one array per trial
+    """
+    def segment(key):
+        segmented_lick_times = behavior.segment_lick_times(key, event_name, pre_stim_dur, post_stim_dur)
+        return dict(key, trial_ids=segmented_lick_times['trial_ids'],
+                    **{'segmented_' + attr_name: utilities.split_by_offsets(
+                        segmented_lick_times['segmented_' + attr_name],
+                        segmented_lick_times['segmented_' + attr_name + '_offsets'])
+                       for attr_name in behavior.lick_time_fields})
+
+    return [_get_or_segment(behavior.LickTimes, key, event_name, pre_stim_dur, post_stim_dur,
+                            lambda: segment(key))
+            for key in (behavior.LickTimes & restriction).fetch('KEY')]
@@ -0,0 +1,89 @@
+'''
+Optional file-system store for the raw continuous signals (membrane potential, current injection, photostim).
+When dj.config['custom']['signal_store_directory'] is set, the signals are written to this directory as
+ memory-mappable .npy files and the longblob attribute only holds a reference to the file.
+Otherwise, the signals are stored in the longblob as usual.
+Either way, a signal is encoded with the codec of its attribute, if any (see pipeline.blob_codec) - in the store,
+ without compression, so that the files stay memory-mappable.
+A reference is stored as a uint8 array (see blob_codec.pack_envelope), which the legacy (mYm) blob format of DataJoint
+ supports. With the store configured, references are resolved on fetch (see get() and pipeline.blob_codec), so a
+ fetched signal attribute is a lazily read array.
+'''
+import os
+import hashlib
+
+import numpy as np
+import datajoint as dj
+
+from . import blob_codec
+
+store_path = dj.config['custom'].get('signal_store_directory')
+
+reference_magic = b'SIGSTORE'
+
+
+def is_stored(value):
+    return blob_codec.unpack_envelope(value, reference_magic) is not None
+
+
+def put(signal, attribute=None):
+    """
+    Return the value to insert into the longblob attribute "attribute" for this signal:
+     + no store configured: the signal itself - encoded with the codec of "attribute", if any
+     + otherwise: a reference to the .npy file of this signal in the store (named by the hash of its content)
+    """
+    codec = blob_codec.get_attribute_codec(attribute)
+    if store_path is None or signal is None:
+        return blob_codec.encode_attribute(attribute, signal)
+
+    signal = np.ascontiguousarray(signal)
+    reference = dict(codec=None)
+    if codec is not None:
+        name = blob_codec.parse_codec(codec)[0]
+        signal, parameters = blob_codec.codecs[name][0](signal)
+        signal = np.ascontiguousarray(signal)
+        reference['codec'] = dict(name=name, parameters=parameters)
+    digest = hashlib.sha1(signal.tobytes()).hexdigest()
+    relative_path = os.path.join(digest[:2], f'{digest}.npy')
+    fpath = os.path.join(store_path, relative_path)
+    if not os.path.exists(fpath):
+        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        tmp_fpath = f'{fpath}.{os.getpid()}.tmp'
+        with open(tmp_fpath, 'wb') as f:
+            np.save(f, signal)
+        os.replace(tmp_fpath, fpath)
+    return blob_codec.pack_envelope(reference_magic, dict(reference,
+                                                          signal_store=relative_path.replace(os.sep, '/'),
+                                                          shape=signal.shape,
+                                                          dtype=signal.dtype.str))
+
+
+def get(value):
+    """
+    Resolve a longblob value of a signal attribute (done on fetch):
+     + a reference to the store: a read-only np.memmap, samples are only read from disk when sliced
+        (an int16-encoded signal is decoded as it is sliced, see blob_codec.ScaledArray)
+     + an encoded signal: the decoded signal
+     + anything else is returned as is
+    """
+    if blob_codec.is_encoded(value):
+        return blob_codec.decode(value)
+    envelope = blob_codec.unpack_envelope(value, reference_magic)
+    if envelope is None:
+        return value
+    reference, _ = envelope
+    if store_path is None:
+        raise dj.DataJointError('"signal_store_directory" is not set in dj.config["custom"], '
+                                f'cannot read stored signal: {reference["signal_store"]}')
+    signal = np.load(os.path.join(store_path, reference['signal_store']), mmap_mode='r')
+    codec = reference['codec']
+    if codec is None or codec['name'] == 'float32':
+        return signal
+    if codec['name'] == 'int16':
+        return blob_codec.ScaledArray(signal, **codec['parameters'])
+    return blob_codec.codecs[codec['name']][1](np.asarray(signal), **codec['parameters'])
+
+
+blob_codec.register_fetch_resolver(is_stored, get)
+if store_path is not None:
+    blob_codec.enable_fetch_decoding()
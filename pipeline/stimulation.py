@@ -10,7 +10,7 @@ import scipy.io as sio
 import datajoint as dj
 import h5py as h5
 
-from . import reference, subject, utilities, stimulation, acquisition, analysis
+from . import reference, subject, utilities, stimulation, acquisition, analysis, signal_store, blob_codec
 
 schema = dj.schema(dj.config['custom'].get('database.prefix', '') + 'stimulation')
 
@@ -78,7 +78,7 @@ class TrialSegmentedPhotoStimulus(dj.Computed):
     """
 
     # custom key_source where acquisition.PhotoStimulation.photostim_timeseries exist
-    key_source = acquisition.TrialSet.Trial * analysis.TrialSegmentationSetting * (
+    key_source = acquisition.TrialSet * analysis.TrialSegmentationSetting * (
                 PhotoStimulation - 'photostim_timeseries is NULL')
 
     def make(self, key):
@@ -88,14 +88,14 @@ class TrialSegmentedPhotoStimulus(dj.Computed):
         # get raw
         fs, first_time_point, photostim_timeseries = (PhotoStimulation & key).fetch1(
             'photostim_sampling_rate', 'photostim_start_time', 'photostim_timeseries')
-        # segmentation
-        try:
-            key['segmented_photostim'] = analysis.perform_trial_segmentation(key, event_name, pre_stim_dur,
-                                                                             post_stim_dur, photostim_timeseries,
-                                                                             fs, first_time_point)
-        except analysis.EventChoiceError as e:
-            print(f'Trial segmentation error - Msg: {str(e)}')
-            return
-
-        self.insert1(key)
-        print(f'Perform trial-segmentation of photostim for trial: {key["trial_id"]}')
+        photostim_timeseries = signal_store.get(photostim_timeseries)
+
+        # segment all trials at once
+        trial_keys, segmented_photostim = analysis.segment_session_signals(
+            key, event_name, pre_stim_dur, post_stim_dur, [photostim_timeseries], fs, first_time_point)
+
+        utilities.insert_in_batches(self, (dict({**key, **trial_key},
+                                                segmented_photostim=blob_codec.encode_attribute(
+                                                    'segmented_photostim', photostim))
+                                           for trial_key, photostim in zip(trial_keys, segmented_photostim)))
+        print(f'Perform trial-segmentation of photostim for session: {key["session_id"]}')
@@ -1,11 +1,21 @@
 import os
 from datetime import datetime
 import re
+import sys
+import threading
+import json
+import hashlib
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-import glob
 import numpy as np
+import scipy.io as sio
+import h5py as h5
+import datajoint as dj
 
 from . import reference, acquisition
+from . import cache_path
 
 
 # datetime format - should probably read this from a config file and not hard coded here
@@ -23,33 +33,212 @@ def parse_date(text):
 
 
 def find_session_matched_matfile(sess_data_dir, key):
-        ############## Dataset #################
-        sess_data_file = None
-        which_data = re.search('Probe|WholeCell', sess_data_dir).group()
-
-        # Search the filenames to find a match for "this" session (based on key)
-        if which_data == 'WholeCell':
-            cell_id = key['cell_id']
-            exp_type = re.search('regular|EPSP',
-                                 ';'.join((acquisition.Session.ExperimentType & key).fetch(
-                                     'experiment_type'))).group()
-            for f in (f for f in glob.glob(os.path.join(sess_data_dir, '*.mat'))):
-                if f.find(f'{cell_id}_{exp_type}') != -1:
-                    sess_data_file = f
-                    break
-        elif which_data == 'Probe':
-            for f in np.hstack(glob.glob(os.path.join(dir_files[0], '*.mat'))
-                               for dir_files in os.walk(sess_data_dir) if len(dir_files[1]) == 0):
-                if f.find(key['session_id']) != -1:
-                    sess_data_file = f
-                    break
-
-        if sess_data_file is None:
-            return None
-        else:
-            return sess_data_file
+    ############## Dataset #################
+    manifest = get_matfile_manifest(sess_data_dir)
+
+    # Look up the file of "this" session (based on key) in the manifest of the data directory
+    if manifest.which_data == 'WholeCell':
+        exp_type = re.search('regular|EPSP',
+                             ';'.join((acquisition.Session.ExperimentType & key).fetch(
+                                 'experiment_type'))).group()
+        return manifest.lookup(('cell', key['cell_id'], exp_type))
+    elif manifest.which_data == 'Probe':
+        return manifest.lookup(('session', key['session_id']))
+
+
+class MatFileManifest:
+    """
+    Persistent index of the .mat files of a data directory, mapping
+        + ('session', session_id) to a file path - both datasets
+        + ('cell', cell_id, experiment_type) to a file path - WholeCell dataset only
+    The directory listing is saved to a manifest file; after the first full scan only
+     directories whose mtime changed are listed again
+    """
+
+    def __init__(self, data_dir, manifest_file):
+        self.data_dir = os.path.abspath(data_dir)
+        self.which_data = re.search('Probe|WholeCell', data_dir).group()
+        self.manifest_file = manifest_file
+        self._dirs = {}  # directory: dict(mtime, subdirs, files)
+        self._index = {}
+        self._lock = threading.RLock()
+
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as f:
+                manifest = json.load(f)
+            if manifest.get('data_dir') == self.data_dir:
+                self._dirs = manifest['dirs']
+                self._build_index()
+
+    def lookup(self, index_key):
+        with self._lock:
+            fpath = self._index.get(index_key)
+            # refresh on miss or when the indexed file is gone
+            if (fpath is None or not os.path.exists(fpath)) and self.refresh():
+                fpath = self._index.get(index_key)
+            return fpath
+
+    def refresh(self):
+        """
+        Re-list the directories whose mtime changed - return True if the manifest changed
+        """
+        with self._lock:
+            changed = False
+            visited = set()
+            to_visit = [self.data_dir]
+            while to_visit:
+                dir_path = to_visit.pop()
+                try:
+                    mtime = os.stat(dir_path).st_mtime_ns
+                except FileNotFoundError:
+                    continue
+                visited.add(dir_path)
+                entry = self._dirs.get(dir_path)
+                if entry is None or entry['mtime'] != mtime:
+                    with os.scandir(dir_path) as it:
+                        dir_entries = sorted(it, key=lambda e: e.name)
+                    entry = dict(mtime=mtime,
+                                 subdirs=[e.path for e in dir_entries if e.is_dir()],
+                                 files=[e.name for e in dir_entries if e.is_file() and e.name.endswith('.mat')])
+                    self._dirs[dir_path] = entry
+                    changed = True
+                to_visit.extend(entry['subdirs'])
+
+            for dir_path in set(self._dirs) - visited:  # removed directories
+                self._dirs.pop(dir_path)
+                changed = True
+
+            if changed:
+                self._build_index()
+                self._save()
+            return changed
+
+    def _build_index(self):
+        self._index = {}
+        for dir_path, entry in sorted(self._dirs.items()):
+            for fname in entry['files']:
+                fpath = os.path.join(dir_path, fname)
+                if self.which_data == 'WholeCell':
+                    self._index.setdefault(('session', fname.replace('.mat', '')), fpath)
+                    match = re.search(r'(cell_\d+)_(regular|EPSP)', fname)
+                    if match:
+                        self._index.setdefault(('cell',) + match.groups(), fpath)
+                elif self.which_data == 'Probe' and len(entry['subdirs']) == 0:  # only the leaf directories
+                    sess_id = '_'.join(re.sub('_units.mat|_JRC_units', '', fname).split('_')[:2])
+                    self._index.setdefault(('session', sess_id), fpath)
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.manifest_file), exist_ok=True)
+        tmp_file = f'{self.manifest_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(dict(data_dir=self.data_dir, dirs=self._dirs), f)
+        os.replace(tmp_file, self.manifest_file)
+
+
+_matfile_manifests = {}
+
+
+def get_matfile_manifest(data_dir):
+    data_dir = os.path.abspath(data_dir)
+    if data_dir not in _matfile_manifests:
+        manifest_file = os.path.join(
+            cache_path, f'matfile_manifest_{hashlib.md5(data_dir.encode()).hexdigest()}.json')
+        _matfile_manifests[data_dir] = MatFileManifest(data_dir, manifest_file)
+    return _matfile_manifests[data_dir]
+
  
-       
+# ============== Incremental ingestion ==============
+def get_file_checksum(fpath, block_size=2 ** 20):
+    file_hash = hashlib.md5()
+    with open(fpath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+class IngestState:
+    """
+    Persistent record of the files ingested from a data directory: {file path: size, mtime and checksum}
+     - used to report the files changed since their ingestion
+    The checksum is optional (record(checksum=True), e.g. right after ingesting the file): files recorded without it
+     (e.g. ingested before the first incremental run) are never read
+    A file is unchanged if its size and mtime are the same as recorded (the file is not opened),
+     or if only its mtime changed but its checksum is recorded and the same (e.g. copied or touched) - the checksum
+     of the file is only computed in that case
+    """
+
+    def __init__(self, data_dir, state_file):
+        self.data_dir = os.path.abspath(data_dir)
+        self.state_file = state_file
+        self._files = {}
+        if os.path.exists(state_file):
+            with open(state_file) as f:
+                state = json.load(f)
+            if state.get('data_dir') == self.data_dir:
+                self._files = state['files']
+
+    def is_recorded(self, fpath):
+        return os.path.abspath(fpath) in self._files
+
+    def is_unchanged(self, fpath):
+        fpath = os.path.abspath(fpath)
+        entry = self._files.get(fpath)
+        if entry is None:
+            return False
+        stat = os.stat(fpath)
+        if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            return True
+        if (entry['size'] == stat.st_size and entry.get('checksum') is not None
+                and entry['checksum'] == get_file_checksum(fpath)):
+            entry['mtime'] = stat.st_mtime_ns
+            return True
+        return False
+
+    def record(self, fpath, checksum=False):
+        fpath = os.path.abspath(fpath)
+        stat = os.stat(fpath)
+        self._files[fpath] = dict(size=stat.st_size, mtime=stat.st_mtime_ns,
+                                  checksum=get_file_checksum(fpath) if checksum else None)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
+        tmp_file = f'{self.state_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(dict(data_dir=self.data_dir, files=self._files), f)
+        os.replace(tmp_file, self.state_file)
+
+
+def get_ingest_state(data_dir, state_file=None):
+    data_dir = os.path.abspath(data_dir)
+    return IngestState(data_dir, state_file or os.path.join(
+        cache_path, f'ingest_state_{hashlib.md5(data_dir.encode()).hexdigest()}.json'))
+
+
+def get_files_to_ingest(fnames, ingest_state, get_session_id):
+    """
+    Incremental ingestion - select the files to ingest, without opening the others:
+     + files of sessions not in the database are ingested (all session ids are fetched at once)
+     + files of sessions already ingested are skipped - if unchanged since their ingestion (see IngestState),
+        or not yet recorded (e.g. ingested before the first incremental run, then recorded without their checksum)
+     + files changed since their session was ingested are skipped with a warning - delete the session to re-ingest
+    get_session_id(fname): the session_id of the session of a file, from its name
+    Return the files to ingest
+    """
+    ingested_session_ids = set(acquisition.Session.fetch('session_id'))
+    fnames_to_ingest = []
+    for fname in fnames:
+        if get_session_id(fname) not in ingested_session_ids:
+            fnames_to_ingest.append(fname)
+        elif ingest_state.is_unchanged(fname):
+            continue
+        elif ingest_state.is_recorded(fname):
+            print(f'Changed since ingested, skipped: {fname} - delete its session to re-ingest it', file=sys.stderr)
+        else:
+            ingest_state.record(fname)
+    ingest_state.save()
+    return fnames_to_ingest
+
+
 def get_brain_hemisphere(brain_region):
     # hemisphere: left-hemisphere is ipsi, so anything contra is right
     if re.search('Contra\s?', brain_region) is not None:
@@ -60,10 +249,322 @@ def get_brain_hemisphere(brain_region):
     return brain_region, hemi
 
 
-def split_list(arr, size):
-    slice_from = 0
-    while len(arr) > slice_from:
-        slice_to = slice_from + size
-        yield arr[slice_from:slice_to]
-        slice_from = slice_to
-        
\ No newline at end of file
+def _init_worker_connection():
+    # forked workers inherit the parent's database socket - give each worker process its own connection
+    dj.conn().connect()
+
+
+def _call_and_catch(func, item):
+    try:
+        func(item)
+    except Exception:
+        return traceback.format_exc()
+
+
+def run_in_process_pool(func, items, workers=1, on_success=None):
+    """
+    Call func(item) for each item, in a pool of "workers" processes (each with its own database connection),
+     or serially in this process if workers <= 1
+    on_success(item), if given, is called in this process as soon as an item completes without error
+    A failing item does not abort the run - return {item: error traceback} of the failed items
+    """
+    failures = {}
+    if workers <= 1:
+        for item in items:
+            error = _call_and_catch(func, item)
+            if error:
+                print(f'Failed: {item}\n{error}', file=sys.stderr)
+                failures[item] = error
+            elif on_success is not None:
+                on_success(item)
+        return failures
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker_connection) as executor:
+        futures = {executor.submit(_call_and_catch, func, item): item for item in items}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                error = future.result()
+            except Exception:  # the worker process itself died (e.g. out of memory)
+                error = traceback.format_exc()
+            if error:
+                print(f'Failed: {item}\n{error}', file=sys.stderr)
+                failures[item] = error
+            elif on_success is not None:
+                on_success(item)
+    return failures
+
+
+def split_by_offsets(values, offsets):
+    """
+    Split a concatenated array into the list of its per-item arrays (views), given the (item count + 1) offsets
+    """
+    return [values[start:stop] for start, stop in zip(offsets[:-1], offsets[1:])]
+        
+
+
+# ============== MAT-file cache ==============
+# Process-wide cache of the variables (or fields) parsed from .mat files, shared by all importers reading the same file
+# Entries are keyed by file path and variable, and validated against the file's modification time
+# Least-recently-used entries are evicted once the cache exceeds its memory cap
+# (in MB, set with dj.config['custom']['matfile_cache_size'] - 0 disables caching)
+matfile_cache_size = dj.config['custom'].get('matfile_cache_size', 2048)
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache bounded by the (estimated) total size in bytes of its values
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key: (value, nbytes)
+        self._nbytes = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value, nbytes=None):
+        nbytes = get_nbytes(value) if nbytes is None else nbytes
+        with self._lock:
+            self.pop(key)
+            if nbytes > self.max_bytes:  # never cache a value larger than the whole cache
+                return
+            self._entries[key] = (value, nbytes)
+            self._nbytes += nbytes
+            while self._nbytes > self.max_bytes:
+                _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+                self._nbytes -= evicted_nbytes
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            value, nbytes = self._entries.pop(key)
+            self._nbytes -= nbytes
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+
+def get_nbytes(obj):
+    """
+    Estimate the in-memory size of the data held by obj (numpy arrays, MATLAB structs and python containers)
+    """
+    if isinstance(obj, np.ndarray):
+        if obj.dtype == object:
+            return obj.nbytes + sum(get_nbytes(o) for o in obj.flat)
+        return obj.nbytes
+    if hasattr(obj, '_fieldnames'):  # scipy.io mat_struct
+        return sum(get_nbytes(getattr(obj, f)) for f in obj._fieldnames)
+    if isinstance(obj, dict):
+        return sum(get_nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(get_nbytes(v) for v in obj)
+    if isinstance(obj, (str, bytes)):
+        return len(obj)
+    return 8
+
+
+_matfile_cache = LRUCache(matfile_cache_size * 1024 ** 2)
+
+
+def load_matfile_fields(fpath, variable, fields):
+    """
+    Load only the requested fields of the MATLAB struct "variable" of a .mat file
+     + fields: '.'-separated paths in the struct, e.g. 'recording_data.Vm' - for a struct array (e.g. 'unit'),
+        the value is a list with the field of each element
+     + v7.3 (HDF5) files: only the datasets of the requested fields are read (via h5py)
+     + older (v5) files cannot be partially decoded below the variable level - only the variable is read (the other
+        variables of the file are skipped), once through the shared MAT-file cache, and the requested fields are
+        picked from it
+    Return {field: value}
+    """
+    fpath = os.path.abspath(fpath)
+    if not h5.is_hdf5(fpath):
+        struct = _load_matfile_variable(fpath, variable)
+        return {field: _get_mat_field(struct, field.split('.')) for field in fields}
+
+    mtime = os.stat(fpath).st_mtime_ns
+    cache_key = (fpath, variable, tuple(fields))
+    cached = _matfile_cache.get(cache_key)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with h5.File(fpath, 'r') as f:
+        values = {field: _get_h5_field(f, f[variable], field.split('.')) for field in fields}
+    _matfile_cache.put(cache_key, (mtime, values), get_nbytes(values))
+    return values
+
+
+def _load_matfile_variable(fpath, variable):
+    # only this variable is decoded and cached
+    mtime = os.stat(fpath).st_mtime_ns
+    cache_key = (fpath, variable)
+    cached = _matfile_cache.get(cache_key)
+    if cached is not None and cached[0] == mtime:
+        return cached[1][variable]
+
+    mat = sio.loadmat(fpath, struct_as_record=False, squeeze_me=True, variable_names=[variable])
+    _matfile_cache.put(cache_key, (mtime, mat), get_nbytes(mat))
+    return mat[variable]
+
+
+def _get_mat_field(obj, field_parts):
+    if not field_parts:
+        return obj
+    if isinstance(obj, np.ndarray) and obj.dtype == object:  # struct array
+        return [_get_mat_field(o, field_parts) for o in obj]
+    return _get_mat_field(getattr(obj, field_parts[0]), field_parts[1:])
+
+
+def _get_h5_field(h5file, node, field_parts):
+    if (isinstance(node, h5.Dataset) and h5.check_dtype(ref=node.dtype) is not None
+            and node.attrs.get('MATLAB_class', b'') != b'cell'):  # field of a struct array
+        return [_get_h5_field(h5file, h5file[ref], field_parts) for ref in node[()].flat]
+    if not field_parts:
+        return _read_h5_value(h5file, node)
+    return _get_h5_field(h5file, node[field_parts[0]], field_parts[1:])
+
+
+def _read_h5_value(h5file, node):
+    # mimic the output of scipy.io.loadmat(struct_as_record=False, squeeze_me=True)
+    if isinstance(node, h5.Group):
+        return {k: _read_h5_value(h5file, node[k]) for k in node}
+    if node.attrs.get('MATLAB_empty', 0):
+        return np.array([])
+    data = node[()]
+    if h5.check_dtype(ref=node.dtype) is not None:  # cell array
+        return np.array([_read_h5_value(h5file, h5file[ref]) for ref in data.flat], dtype=object)
+    if node.attrs.get('MATLAB_class', b'') == b'char':
+        return ''.join(chr(c) for c in data.T.flatten())
+    data = np.squeeze(data.T)  # MATLAB arrays are stored column-major
+    return data.item() if data.ndim == 0 else data
+
+
+def clear_matfile_cache():
+    _matfile_cache.clear()
+
+
+# ============== Content hash ==============
+def get_content_hash(queries):
+    """
+    Hash of the content of the rows of "queries" (e.g. to detect data deleted and re-ingested)
+    Each row is hashed by the database server (MD5 of the MD5 of each of its non-blob attributes and of the length
+     of each of its blobs - NULL hashed as such), only the 32-character row digests are fetched
+    The blobs (e.g. the signals) are not read: a blob changed to a value of the same length is not detected
+    """
+    content_hash = hashlib.md5()
+    for query in queries:
+        attributes = ', '.join(f"COALESCE(LENGTH(`{attr}`), 'NULL')" if query.heading.attributes[attr].is_blob
+                               else f"COALESCE(MD5(`{attr}`), 'NULL')" for attr in query.heading.names)
+        row_hashes = query.proj(row_hash=f"MD5(CONCAT_WS('|', {attributes}))").fetch(
+            'row_hash', order_by=query.primary_key)
+        content_hash.update(query.full_table_name.encode())
+        content_hash.update(''.join(row_hashes).encode())
+    return content_hash.hexdigest()
+
+
+# ============== Batched insert ==============
+# Rows are inserted with multi-row inserts of at most a byte budget (estimated), as large as the server allows:
+# a fraction of its max_allowed_packet - binary values can take up to twice their size once escaped in the query
+# (set the budget in MB with dj.config['custom']['insert_batch_size'] - default: half of max_allowed_packet)
+insert_batch_size = dj.config['custom'].get('insert_batch_size')
+row_overhead = 64  # bytes per attribute, for the SQL syntax and the blob headers
+
+_max_allowed_packet = None
+
+
+def get_insert_budget():
+    """
+    Byte budget of one multi-row insert
+    """
+    if insert_batch_size:
+        return int(insert_batch_size * 1024 ** 2)
+    global _max_allowed_packet
+    if _max_allowed_packet is None:  # once per process
+        _max_allowed_packet = int(dj.conn().query('SELECT @@max_allowed_packet').fetchone()[0])
+    return _max_allowed_packet // 2
+
+
+def get_row_nbytes(row):
+    """
+    Estimate the size of a row (dict, tuple or list) in the query of an insert
+    """
+    return get_nbytes(row) + row_overhead * len(row)
+
+
+class BatchInserter:
+    """
+    Accumulate the rows of a table, inserted with one multi-row insert each time the next row would exceed the byte
+     budget - a row larger than the budget is inserted alone
+    The remaining rows are inserted by flush(), or on exit of a "with" block (not on error)
+    e.g.
+        with BatchInserter(self.Unit) as inserter:
+            for unit in units:
+                inserter.add(dict(key, unit_id=...))
+    """
+
+    def __init__(self, table, max_bytes=None, **kwargs):
+        self.table = table
+        self.max_bytes = max_bytes or get_insert_budget()
+        self.kwargs = kwargs  # of table.insert(), e.g. allow_direct_insert=True
+        self._rows = []
+        self._nbytes = 0
+
+    def add(self, row):
+        nbytes = get_row_nbytes(row)
+        if self._rows and self._nbytes + nbytes > self.max_bytes:
+            self.flush()
+        self._rows.append(row)
+        self._nbytes += nbytes
+
+    def extend(self, rows):
+        for row in rows:
+            self.add(row)
+
+    def flush(self):
+        if self._rows:
+            self.table.insert(self._rows, **self.kwargs)
+        self._rows = []
+        self._nbytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.flush()
+
+
+def insert_in_batches(table, rows, max_bytes=None, **kwargs):
+    """
+    Insert rows (any iterable, consumed as it is inserted) into table with multi-row inserts of at most "max_bytes"
+     (default: see get_insert_budget)
+    """
+    with BatchInserter(table, max_bytes, **kwargs) as inserter:
+        inserter.extend(rows)
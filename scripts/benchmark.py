@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+'''
+End-to-end benchmark of the pipeline, on a dataset generated with scripts/generate_synthetic_data.py.
+Times each stage against a throwaway database (e.g. a local MySQL, see docker-compose.yml):
+ + ingest: whole-cell and extracellular files (ingest_wholecell.py, ingest_extracellular.py)
+ + populate: each table of populate.populated_tables, one after another in dependency order
+ + export: all sessions to NWB (datajoint_to_nwb.py)
+The pipeline is declared with its own schema prefix (--database-prefix) - ALL schemas with this prefix are dropped
+ first, so that each run starts from an empty pipeline.
+The results (duration, rows/items and errors of each stage, peak memory, the parameters of the synthetic dataset
+ and of the machine) are written as JSON, to size hardware and compare runs.
+e.g.
+    python scripts/generate_synthetic_data.py ./data/synthetic --cells 8 --probe-sessions 4
+    python scripts/benchmark.py ./data/synthetic --workers 4 --output benchmark.json
+'''
+import os
+import sys
+import json
+import glob
+import time
+import argparse
+import platform
+import resource
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import datajoint as dj
+
+
+def drop_schemas(prefix):
+    connection = dj.conn()
+    schema_names = [name for name, in connection.query(
+        'SHOW DATABASES LIKE %s', args=(prefix.replace('_', r'\_') + '%',)).fetchall()]
+    # schemas reference one another - drop them regardless of the order of their foreign keys
+    connection.query('SET FOREIGN_KEY_CHECKS=0')
+    try:
+        for schema_name in schema_names:
+            print(f'Drop schema: {schema_name}')
+            connection.query(f'DROP DATABASE `{schema_name}`')
+    finally:
+        connection.query('SET FOREIGN_KEY_CHECKS=1')
+
+
+def run_stage(results, stage, func):
+    """
+    Time func() - which returns a dict of stage metrics (e.g. "errors") - and append the stage to results
+    """
+    print(f'======== {stage} ========')
+    start = time.perf_counter()
+    metrics = func()
+    duration = time.perf_counter() - start
+    results['stages'].append(dict(
+        stage=stage, duration=duration, **metrics,
+        peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        children_peak_rss_mb=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024))
+    print(f'{stage}: {duration:.2f} s - {metrics}')
+
+
+def populate_table(populate, table_name, workers):
+    if workers <= 1:
+        return populate.populate_table(table_name)
+    # all workers on this table - keys are reserved in the jobs table
+    with ProcessPoolExecutor(max_workers=workers, initializer=populate.init_worker) as executor:
+        return [error for errors in executor.map(populate.populate_table, [table_name] * workers)
+                for error in errors]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark ingest, populate and NWB export on a synthetic dataset')
+    parser.add_argument('data_dir', help='directory written by generate_synthetic_data.py')
+    parser.add_argument('--database-prefix', default='inagaki2018_benchmark_',
+                        help='schema prefix of the benchmarked pipeline - its schemas are DROPPED first '
+                             '(default: inagaki2018_benchmark_)')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes per stage (default: 1)')
+    parser.add_argument('--output', default='benchmark.json', help='JSON file of the results (default: benchmark.json)')
+    parser.add_argument('--nwb-dir', default=None,
+                        help='directory of the exported NWB files (default: "nwb" in data_dir)')
+    parser.add_argument('--skip-export', action='store_true', help='do not benchmark the NWB export')
+    parser.add_argument('--profile', default=None, metavar='DIR',
+                        help='also profile each make() call (see pipeline.profiling) into this directory')
+    args = parser.parse_args()
+
+    if args.database_prefix == dj.config.get('custom', {}).get('database.prefix'):
+        parser.error('--database-prefix is the prefix of the pipeline in dj_local_conf.json - its schemas would be dropped')
+
+    drop_schemas(args.database_prefix)
+
+    # the pipeline reads its schema prefix and data directories from dj.config on import
+    dj.config['custom'] = dict(dj.config.get('custom', {}),
+                               **{'database.prefix': args.database_prefix,
+                                  'intracellular_directory': os.path.join(args.data_dir, 'WholeCellData'),
+                                  'extracellular_directory': os.path.join(args.data_dir, 'SiliconProbeData')})
+    from pipeline import acquisition, utilities, profiling
+    import ingest_wholecell
+    import ingest_extracellular
+    import populate
+
+    dataset_file = os.path.join(args.data_dir, 'synthetic_dataset.json')
+    results = dict(started=datetime.now().isoformat(),
+                   workers=args.workers,
+                   database_prefix=args.database_prefix,
+                   dataset=json.load(open(dataset_file)) if os.path.exists(dataset_file) else None,
+                   machine=dict(python=platform.python_version(), platform=platform.platform(),
+                                cpu_count=os.cpu_count(), datajoint=dj.__version__, numpy=np.__version__),
+                   stages=[])
+
+    if args.profile:
+        profiling.enable(args.profile)  # before the worker processes are forked - they inherit the profiling
+
+    # ==================== Ingest ====================
+    def ingest(ingest_script, fnames):
+        ingest_script.load_meta_data()  # parsed once, before the worker processes are forked
+        failures = utilities.run_in_process_pool(ingest_script.ingest_file, fnames, workers=args.workers)
+        return dict(items=len(fnames), errors=len(failures))
+
+    run_stage(results, 'ingest_wholecell', lambda: ingest(
+        ingest_wholecell, glob.glob(os.path.join(ingest_wholecell.path, 'Data', '*.mat'))))
+    run_stage(results, 'ingest_extracellular', lambda: ingest(
+        ingest_extracellular,
+        [fname for dir_files in os.walk(ingest_extracellular.path) if len(dir_files[1]) == 0
+         for fname in glob.glob(os.path.join(dir_files[0], '*.mat'))]))
+
+    # ==================== Populate ====================
+    def populate_stage(table_name):
+        errors = populate_table(populate, table_name, args.workers)
+        return dict(rows=sum(len(table()) for table in populate.get_group_tables(table_name)), errors=len(errors))
+
+    for table_name in populate.get_populate_order(
+            populate.get_upstream_groups(populate.get_upstream_tables(populate.populated_tables))):
+        run_stage(results, f'populate {table_name}', lambda: populate_stage(table_name))
+
+    # ==================== NWB export ====================
+    if not args.skip_export:
+        import datajoint_to_nwb
+
+        def export():
+            failures = datajoint_to_nwb.export_all_sessions(args.nwb_dir or os.path.join(args.data_dir, 'nwb'),
+                                                             workers=args.workers, force=True)
+            return dict(items=len(acquisition.Session()), errors=len(failures))
+
+        run_stage(results, 'export_nwb', export)
+
+    results['total_duration'] = sum(stage['duration'] for stage in results['stages'])
+    if args.profile:
+        results['profile'] = profiling.write_report(args.profile)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, default=str)
+    print(f'\nTotal: {results["total_duration"]:.2f} s - results written to: {args.output}')
+    if any(stage['errors'] for stage in results['stages']):
+        print('Errors in: ' + ', '.join(stage['stage'] for stage in results['stages'] if stage['errors']),
+              file=sys.stderr)
+        sys.exit(1)
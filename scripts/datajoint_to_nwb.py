@@ -2,19 +2,22 @@
 import os
 
 import sys
+import json
+import argparse
+from functools import partial
 from datetime import datetime
 from dateutil.tz import tzlocal
 import pytz
-import re
 import numpy as np
-import pandas as pd
 import warnings
 import tqdm
 
 from pipeline import (reference, subject, acquisition, stimulation, analysis,
-                      intracellular, extracellular, behavior, utilities)
+                      intracellular, extracellular, behavior, utilities, signal_store)
 import pynwb
 from pynwb import NWBFile, NWBHDF5IO
+from hdmf.data_utils import AbstractDataChunkIterator, DataChunk
+from hdmf.backends.hdf5.h5_utils import H5DataIO
 
 warnings.filterwarnings('ignore', module='pynwb')
 
@@ -25,6 +28,9 @@ institution = 'Janelia Research Campus'
 hardware_filter = 'Bandpass filtered 300-6K Hz'
 related_publications = 'doi:10.1523/JNEUROSCI.3152-17.2018; doi:10.25378/janelia.7489253'
 ecephys_fs = 25000
+# streaming export - continuous signals are written in chunks of "stream_chunk_size" samples, gzip compressed
+stream_chunk_size = 2 ** 20
+stream_compression_opts = 4
 
 # experiment description and keywords - from the abstract
 experiment_description = 'Extracellular electrophysiology recordings with optogenetic perturbations performed on mouse anterior lateral motor cortex (ALM) in delay response task.'
@@ -32,12 +38,85 @@ keywords = ['motor planning', 'premotor cortex', 'preparatory activity',
             'short-term memory', 'extracellular electrophysiology', 'intracellular electrophysiology']
 
 
-def export_to_nwb(session_key, nwb_output_dir=default_nwb_output_dir, save=False, overwrite=True):
+class SignalChunkIterator(AbstractDataChunkIterator):
+    """
+    Iterate over a continuous signal in slices of "chunk_size" samples, as DataChunks for HDF5 writes
+     - a memory-mapped signal is only read from disk one slice at a time
+    """
+
+    def __init__(self, signal, chunk_size=stream_chunk_size):
+        self.signal = signal
+        self.chunk_size = int(chunk_size)
+        self._chunk_start = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._chunk_start >= len(self.signal):
+            raise StopIteration
+        chunk_stop = min(self._chunk_start + self.chunk_size, len(self.signal))
+        chunk = DataChunk(data=np.asarray(self.signal[self._chunk_start:chunk_stop]),
+                          selection=np.s_[self._chunk_start:chunk_stop])
+        self._chunk_start = chunk_stop
+        return chunk
+
+    next = __next__
+
+    def recommended_chunk_shape(self):
+        return (min(self.chunk_size, len(self.signal)),) + tuple(np.shape(self.signal)[1:])
+
+    def recommended_data_shape(self):
+        return np.shape(self.signal)
+
+    @property
+    def dtype(self):
+        return np.dtype(self.signal.dtype)
+
+    @property
+    def maxshape(self):
+        return np.shape(self.signal)
+
+
+def stream_signal(signal, stream=True):
+    """
+    With "stream", wrap a continuous signal for a chunked, compressed write: the signal is read and written
+     "stream_chunk_size" samples at a time - from disk, for a signal in the signal store (see pipeline.signal_store)
+    Otherwise return the signal as is
+    """
+    if signal is None:
+        return signal
+    if not stream:
+        return np.asanyarray(signal)
+    if not hasattr(signal, 'shape'):  # keep memory-mapped or lazily decoded signals as they are
+        signal = np.asanyarray(signal)
+    if not len(signal):
+        return signal
+    iterator = SignalChunkIterator(signal)
+    return H5DataIO(data=iterator, chunks=iterator.recommended_chunk_shape(),
+                    compression='gzip', compression_opts=stream_compression_opts)
+
+
+def to_float(values):
+    # convert a fetched column (e.g. with Decimal or None) to float, None to np.nan since nwb fields does not take None
+    return np.array([np.nan if v is None else float(v) for v in values])
+
+
+def get_session_identifier(this_session):
+    return '_'.join([this_session['subject_id'],
+                     this_session['session_time'].strftime('%Y-%m-%d'),
+                     this_session['session_id']])
+
+
+def export_to_nwb(session_key, nwb_output_dir=default_nwb_output_dir, save=False, overwrite=True, stream=False):
+    """
+    Build the NWBFile of this session, and write it to "nwb_output_dir" if "save"
+    With "stream", the continuous signals (membrane potential, current injection, photostim) are written
+     in compressed chunks, read from the signal store in slices (see stream_signal) - only use with "save"
+    """
     this_session = (acquisition.Session & session_key).fetch1()
 
-    identifier = '_'.join([this_session['subject_id'],
-                           this_session['session_time'].strftime('%Y-%m-%d'),
-                           this_session['session_id']])
+    identifier = get_session_identifier(this_session)
 
     # =============== General ====================
     # -- NWB file - a NWB2.0 file for each session
@@ -84,7 +163,7 @@ def export_to_nwb(session_key, nwb_output_dir=default_nwb_output_dir, save=False
                                                                unit='mV',
                                                                conversion=1e-3,
                                                                gain=1.0,
-                                                               data=mp,
+                                                               data=stream_signal(signal_store.get(mp), stream),
                                                                starting_time=mp_start_time,
                                                                rate=mp_fs))
         # acquisition - current injection
@@ -95,7 +174,7 @@ def export_to_nwb(session_key, nwb_output_dir=default_nwb_output_dir, save=False
                                                                           electrode=ic_electrode,
                                                                           conversion=1e-9,
                                                                           gain=1.0,
-                                                                          data=current_injection,
+                                                                          data=stream_signal(signal_store.get(current_injection), stream),
                                                                           starting_time=ci_start_time,
                                                                           rate=ci_fs))
 
@@ -107,7 +186,7 @@ def export_to_nwb(session_key, nwb_output_dir=default_nwb_output_dir, save=False
                                                                        unit='mV',
                                                                        conversion=1e-3,
                                                                        gain=1.0,
-                                                                       data=mp_wo_spike,
+                                                                       data=stream_signal(signal_store.get(mp_wo_spike), stream),
                                                                        starting_time=mp_start_time,
                                                                        rate=mp_fs))
 
@@ -150,29 +229,28 @@ def export_to_nwb(session_key, nwb_output_dir=default_nwb_output_dir, save=False
                              spike_width=unit['unit_spike_width'],
                              cell_type=unit['unit_cell_type'],
                              spike_times=unit['spike_times'],
-                             waveform_mean=unit['spike_waveform'])
+                             waveform_mean=unit['waveform_mean'],
+                             waveform_sd=unit['waveform_std'])
 
     # =============== Behavior ====================
     # Note: for this study, raw behavioral data were not available, only trialized data were provided
     # here, we reconstruct raw behavioral data by concatenation
     trial_seg_setting = (analysis.TrialSegmentationSetting & 'trial_seg_setting=0').fetch1()
-    seg_behav_query = (behavior.TrialSegmentedLickTrace * acquisition.TrialSet.Trial
-                       * (analysis.RealignedEvent.RealignedEventTime & 'trial_event="trial_start"')
-                       & session_key & trial_seg_setting)
+    seg_behav_query = behavior.TrialSegmentedLickTrace & session_key & trial_seg_setting
 
     if seg_behav_query:
         behav_acq = pynwb.behavior.BehavioralTimeSeries(name='lick_times')
         nwbfile.add_acquisition(behav_acq)
-        seg_behav = pd.DataFrame(seg_behav_query.fetch('start_time', 'realigned_event_time',
-                                                       'segmented_lick_left_on',
-                                                       'segmented_lick_left_off',
-                                                       'segmented_lick_right_on',
-                                                       'segmented_lick_right_off')).T
-        seg_behav.columns = ['start_time', 'realigned_event_time', 'segmented_lick_left_on',
-                             'segmented_lick_left_off', 'segmented_lick_right_on', 'segmented_lick_right_off']
+        seg_behav = seg_behav_query.fetch1()
+        # segmented lick times are with respect to the event - shift each trial back by (trial start + event time)
+        trial_keys, trial_starts, _, event_times = analysis.get_trials_event_time(trial_seg_setting['event'],
+                                                                                  session_key)
+        trial_ids = np.array([k['trial_id'] for k in trial_keys])
+        trial_idx = np.searchsorted(trial_ids, seg_behav['trial_ids'])
+        trial_shifts = trial_starts[trial_idx] + event_times[trial_idx]
         for behav_name in ['lick_left_on', 'lick_left_off', 'lick_right_on', 'lick_right_off']:
-            lick_times = np.hstack(r['segmented_'+behav_name] - r.realigned_event_time + r.start_time
-                                   for _, r in seg_behav.iterrows())
+            lick_times = (seg_behav['segmented_' + behav_name]
+                          + np.repeat(trial_shifts, np.diff(seg_behav['segmented_' + behav_name + '_offsets'])))
             behav_acq.create_timeseries(
                 name=behav_name,
                 unit='a.u.',
@@ -202,7 +280,7 @@ def export_to_nwb(session_key, nwb_output_dir=default_nwb_output_dir, save=False
                 site=stim_site,
                 resolution=0.0,
                 conversion=1e-3,
-                data=photostim['photostim_timeseries'],
+                data=stream_signal(signal_store.get(photostim['photostim_timeseries']), stream),
                 starting_time=photostim['photostim_start_time'],
                 rate=photostim['photostim_sampling_rate']))
 
@@ -212,55 +290,49 @@ def export_to_nwb(session_key, nwb_output_dir=default_nwb_output_dir, save=False
     # Other trial-related information needs to be added in to the trial-table as additional columns (with column name
     # and column description)
     if acquisition.TrialSet & session_key:
-        # Get trial descriptors from TrialSet.Trial and TrialStimInfo - remove '_trial' prefix (if any)
-        trial_columns = [{'name': tag.replace('trial_', ''),
-                          'description': re.search(
-                              f'(?<={tag})(.*)#(.*)',
-                              str((acquisition.TrialSet.Trial
-                                   * stimulation.TrialPhotoStimParam).heading)).groups()[-1].strip()}
-                         for tag in (acquisition.TrialSet.Trial * stimulation.TrialPhotoStimParam).heading.names
-                         if tag not in (acquisition.TrialSet.Trial
-                                        & stimulation.TrialPhotoStimParam).primary_key + ['start_time', 'stop_time']]
+        # Build the trial-table column by column: one fetch per table, pivoted on trial_id
+        trials = (acquisition.TrialSet.Trial & session_key).fetch(order_by='trial_id')
+        trial_ids = trials['trial_id'].astype(int)
+        trial_columns = {'start_time': ('Start time of epoch, in seconds', to_float(trials['start_time'])),
+                         'stop_time': ('Stop time of epoch, in seconds', to_float(trials['stop_time']))}
+
+        # Trial descriptors from TrialSet.Trial and TrialPhotoStimParam - remove '_trial' prefix (if any)
+        # trials without photostim parameters get '' (or NaN for numeric attributes)
+        trial_photostims = (stimulation.TrialPhotoStimParam & session_key).fetch()
+        photostim_idx = np.searchsorted(trial_ids, trial_photostims['trial_id'])
+        for attr in acquisition.TrialSet.Trial.heading.secondary_attributes:
+            if attr not in ('start_time', 'stop_time'):
+                values = trials[attr]
+                if acquisition.TrialSet.Trial.heading.attributes[attr].numeric and values.dtype == object:
+                    values = to_float(values)  # e.g. Decimal or None
+                trial_columns[attr.replace('trial_', '')] = (
+                    acquisition.TrialSet.Trial.heading.attributes[attr].comment or attr, values)
+        for attr in stimulation.TrialPhotoStimParam.heading.secondary_attributes:
+            if stimulation.TrialPhotoStimParam.heading.attributes[attr].numeric:
+                values = np.full(len(trial_ids), np.nan)
+                values[photostim_idx] = to_float(trial_photostims[attr])
+            else:
+                values = np.full(len(trial_ids), '', dtype=object)
+                values[photostim_idx] = trial_photostims[attr]
+            trial_columns[attr.replace('trial_', '')] = (
+                stimulation.TrialPhotoStimParam.heading.attributes[attr].comment or attr, values)
 
         # Trial Events - discard 'trial_start' and 'trial_stop' as we already have start_time and stop_time
         # also add `_time` suffix to all events
-        trial_events = set(((acquisition.TrialSet.EventTime & session_key)
-                            - [{'trial_event': 'trial_start'}, {'trial_event': 'trial_stop'}]).fetch('trial_event'))
-        event_names = [{'name': e + '_time', 'description': d + ' - (s) relative to trial start time'}
-                       for e, d in zip(*(reference.ExperimentalEvent & [{'event': k}
-                                                                        for k in trial_events]).fetch('event',
-                                                                                                      'description'))]
-        # Add new table columns to nwb trial-table for trial-label
-        for c in trial_columns + event_names:
-            nwbfile.add_trial_column(**c)
-
-        photostim_tag_default = {tag: '' for tag in stimulation.TrialPhotoStimParam.heading.names
-                                 if tag not in stimulation.TrialPhotoStimParam.primary_key}
-
-        # Add entry to the trial-table
-        for trial in (acquisition.TrialSet.Trial & session_key).fetch(as_dict=True):
-            events = dict(zip(*(acquisition.TrialSet.EventTime & trial
-                                & [{'trial_event': e} for e in trial_events]).fetch('trial_event', 'event_time')))
-
-            trial_tag_value = ({**trial, **events, **(stimulation.TrialPhotoStimParam & trial).fetch1()}
-                               if (stimulation.TrialPhotoStimParam & trial)
-                               else {**trial, **events, **photostim_tag_default})
-
-            trial_tag_value['id'] = trial_tag_value['trial_id']  # rename 'trial_id' to 'id'
-            [trial_tag_value.pop(k) for k in acquisition.TrialSet.Trial.primary_key]
-
-            # convert None to np.nan since nwb fields does not take None
-            for k, v in trial_tag_value.items():
-                trial_tag_value[k] = v if v is not None else np.nan
-
-            trial_tag_value['delay_duration'] = float(trial_tag_value['delay_duration'])  # convert Decimal to float
-
-            # Final tweaks: i) add '_time' suffix and ii) remove 'trial_' prefix
-            events = {k + '_time': trial_tag_value.pop(k) for k in events}
-            trial_attrs = {k.replace('trial_', ''): trial_tag_value.pop(k)
-                           for k in [n for n in trial_tag_value if n.startswith('trial_')]}
-
-            nwbfile.add_trial(**trial_tag_value, **events, **trial_attrs)
+        session_event_times = analysis.get_session_event_times(session_key)
+        event_trial_idx = np.searchsorted(session_event_times.trial_ids, trial_ids)
+        event_descriptions = dict(zip(*reference.ExperimentalEvent.fetch('event', 'description')))
+        for e_idx, event in enumerate(session_event_times.events):
+            if event in ('trial_start', 'trial_stop'):
+                continue
+            trial_columns[event + '_time'] = (event_descriptions[event] + ' - (s) relative to trial start time',
+                                              session_event_times.event_times[event_trial_idx, e_idx])
+
+        # Add all trials to the nwb trial-table at once
+        nwbfile.trials = pynwb.epoch.TimeIntervals(
+            name='trials', description='experimental trials', id=list(trial_ids),
+            columns=[pynwb.core.VectorData(name=name, description=description, data=list(values))
+                     for name, (description, values) in trial_columns.items()])
 
     # =============== Write NWB 2.0 file ===============
     if save:
@@ -269,20 +341,126 @@ def export_to_nwb(session_key, nwb_output_dir=default_nwb_output_dir, save=False
             os.makedirs(nwb_output_dir)
         if not overwrite and os.path.exists(os.path.join(nwb_output_dir, save_file_name)):
             return nwbfile
-        with NWBHDF5IO(os.path.join(nwb_output_dir, save_file_name), mode = 'w') as io:
+        # write to a temporary file first - an interrupted export does not leave a truncated NWB file behind
+        tmp_file_name = os.path.join(nwb_output_dir, f'{save_file_name}.{os.getpid()}.tmp')
+        with NWBHDF5IO(tmp_file_name, mode = 'w') as io:
             io.write(nwbfile)
-            print(f'Write NWB 2.0 file: {save_file_name}')
+        os.replace(tmp_file_name, os.path.join(nwb_output_dir, save_file_name))
+        print(f'Write NWB 2.0 file: {save_file_name}')
 
     return nwbfile
 
 
 # ============================== EXPORT ALL ==========================================
+# The tables (restricted by session) whose rows go into the NWB file of a session
+export_source_tables = [acquisition.Session, acquisition.Session.Experimenter,
+                        subject.Subject, subject.Subject.Allele,
+                        intracellular.Cell, intracellular.MembranePotential, intracellular.CurrentInjection,
+                        extracellular.ProbeInsertion, extracellular.UnitSpikeTimes,
+                        behavior.TrialSegmentedLickTrace & 'trial_seg_setting=0',
+                        stimulation.PhotoStimulation,
+                        acquisition.TrialSet.Trial, acquisition.TrialSet.EventTime, stimulation.TrialPhotoStimParam]
+
+
+def get_export_source_queries(session_key):
+    """
+    The rows exported to the NWB file of this session: those of export_source_tables,
+     and the lookup rows they reference (brain locations, probe channels, photostim device/protocol, events)
+    """
+    cells = intracellular.Cell & session_key
+    probe_insertions = extracellular.ProbeInsertion & session_key
+    photostims = stimulation.PhotoStimulation & session_key
+    return [table & session_key for table in export_source_tables] + [
+        reference.BrainLocation & cells,
+        reference.BrainLocation & probe_insertions,
+        reference.Probe.Channel & probe_insertions,
+        reference.ActionLocation & photostims,
+        stimulation.PhotoStimDevice & photostims,
+        stimulation.PhotoStimProtocol & photostims,
+        reference.ExperimentalEvent & (acquisition.TrialSet.EventTime & session_key).proj(event='trial_event')]
+
+
+def get_session_content_hash(session_key):
+    """
+    Hash of the content of all the rows exported to the NWB file of this session (see utilities.get_content_hash)
+    The blobs (e.g. the signals) are not read: a blob changed to a value of the same length is not detected -
+     re-export with "force"
+    """
+    return utilities.get_content_hash(get_export_source_queries(session_key))
+
+
+def load_export_manifest(manifest_file):
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def save_export_manifest(manifest, manifest_file):
+    tmp_manifest_file = f'{manifest_file}.tmp'
+    with open(tmp_manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_manifest_file, manifest_file)
+
+
+def export_session(session, nwb_output_dir):
+    export_to_nwb(dict(zip(acquisition.Session.primary_key, session)),
+                  nwb_output_dir=nwb_output_dir, save=True, stream=True)
+
+
+def export_all_sessions(nwb_output_dir=default_nwb_output_dir, workers=1, manifest_file=None, force=False):
+    """
+    Export all sessions to NWB files in "nwb_output_dir", over a pool of "workers" processes
+    The manifest (default: export_manifest.json in "nwb_output_dir") records the content hash of each exported
+     session (see get_session_content_hash), updated as each export completes - sessions whose content is unchanged
+     and whose NWB file exists are skipped (unless "force"), so an interrupted export resumes where it stopped
+    Return {session: error traceback} of the sessions that failed to export
+    """
+    os.makedirs(nwb_output_dir, exist_ok=True)
+    manifest_file = manifest_file or os.path.join(nwb_output_dir, 'export_manifest.json')
+    manifest = load_export_manifest(manifest_file)
+
+    sessions, identifiers, content_hashes = [], {}, {}
+    for this_session in acquisition.Session.fetch(as_dict=True):
+        session = tuple(this_session[k] for k in acquisition.Session.primary_key)
+        identifiers[session] = get_session_identifier(this_session)
+        content_hashes[session] = get_session_content_hash(this_session)
+        exported = manifest.get(identifiers[session], {})
+        if (force or exported.get('content_hash') != content_hashes[session]
+                or not os.path.exists(os.path.join(nwb_output_dir, identifiers[session] + '.nwb'))):
+            sessions.append(session)
+    print(f'{len(sessions)} sessions to export - {len(identifiers) - len(sessions)} sessions unchanged')
+
+    def on_success(session):
+        manifest[identifiers[session]] = {'content_hash': content_hashes[session],
+                                          'nwb_file': identifiers[session] + '.nwb',
+                                          'export_time': datetime.now().isoformat()}
+        save_export_manifest(manifest, manifest_file)
+
+    return utilities.run_in_process_pool(partial(export_session, nwb_output_dir=nwb_output_dir),
+                                         sessions, workers=workers, on_success=on_success)
 
-if __name__ == '__main__':
-    if len(sys.argv) > 1:
-        nwb_outdir = sys.argv[1]
-    else:
-        nwb_outdir = default_nwb_output_dir
 
-    for skey in acquisition.Session.fetch('KEY'):
-        export_to_nwb(skey, nwb_output_dir=nwb_outdir, save=True)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export all sessions to NWB 2.0 files')
+    parser.add_argument('nwb_output_dir', nargs='?', default=default_nwb_output_dir,
+                        help=f'output directory of the NWB files (default: {default_nwb_output_dir})')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes, each exporting one session at a time (default: 1)')
+    parser.add_argument('--manifest', default=None,
+                        help='path of the export manifest (default: export_manifest.json in the output directory)')
+    parser.add_argument('--force', action='store_true',
+                        help='re-export all sessions, including the unchanged ones')
+    parser.add_argument('--failure-log', default=None,
+                        help='path of a JSON file to write the errors of the sessions that failed to export')
+    args = parser.parse_args()
+
+    failures = export_all_sessions(args.nwb_output_dir, workers=args.workers,
+                                   manifest_file=args.manifest, force=args.force)
+
+    if failures:
+        print('Failed sessions:\n\t' + '\n\t'.join(str(s) for s in failures), file=sys.stderr)
+        if args.failure_log:
+            with open(args.failure_log, 'w') as f:
+                json.dump({str(s): e for s, e in failures.items()}, f, indent=2)
+        sys.exit(1)
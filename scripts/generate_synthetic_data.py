@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+'''
+Generate a synthetic dataset with the layout of the original data downloads, to benchmark the pipeline without them:
+ + WholeCellData: "Data/cell_<N>_<regular|EPSP>.mat" files (MATLAB struct "wholeCell") and the cell list
+    "SI_table_1_wc_cell_list.xlsx"
+ + SiliconProbeData: "<subject>_<date>_units.mat" files (MATLAB struct array "unit" and "trial_info") in the task
+    directories, and the metadata sheets of each task
+The MAT structs and metadata sheets have the fields and layout read by scripts/ingest_wholecell.py,
+ scripts/ingest_extracellular.py and the make() of the imported tables.
+The values are random (seeded) - realistic in size and structure, not in content.
+The parameters of the dataset are written to "synthetic_dataset.json" in the output directory.
+e.g.
+    python scripts/generate_synthetic_data.py ./data/synthetic --cells 8 --probe-sessions 4 --units 40 --trials 200
+'''
+import os
+import json
+import argparse
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import scipy.io as sio
+
+# ================== Task structure ==================
+sample_duration = 1.3  # (s)
+cue_duration = 0.1  # (s)
+wholecell_delay_duration = 1.2  # (s)
+min_trial_duration = 5  # (s) sample + longest delay + cue + response
+lick_interval = 0.15  # (s)
+photostim_duration = 1  # (s) from the delay start
+photostim_freq = 40  # (Hz)
+
+# trial type: (side of the licks, are there licks, probability) - see trial_type_and_response_dict of the ingest scripts
+wholecell_trial_types = {1: ('right', True, .35), 2: ('left', True, .35), 3: ('left', True, .08),
+                         4: ('right', True, .08), 5: ('right', True, .02), 6: ('left', True, .02),
+                         7: ('right', True, .02), 8: ('left', True, .02), 9: ('right', False, .02),
+                         10: ('left', False, .02), 11: ('right', False, .02)}
+# extracellular "Trial_types_of_response_vector" - 0 (photo-tagging) is not generated
+probe_trial_types = {1: ('right', True, .35), 2: ('left', True, .35), 3: ('left', True, .08),
+                     4: ('right', True, .08), 5: ('right', False, .03), 6: ('left', False, .03),
+                     7: ('right', True, .02), 8: ('left', True, .02), 9: ('right', True, .02),
+                     10: ('left', True, .02)}
+
+wholecell_xlsx = 'SI_table_1_wc_cell_list.xlsx'
+wholecell_capacity = 79  # rows read from the cell list
+
+# extracellular tasks: directory, metadata sheet, delay duration (None: random delay), sheet layout
+#  (the header row and the columns read by the ingest script - see ingest_extracellular.py, and its number of rows)
+xlsx_header = ['Session', 'Animal ID', 'Genotype', 'Date of birth', 'Session date']
+csv_header = ['Session', 'Animal ID', 'Genotype', 'Date of birth', 'Sex', 'Session date']
+probe_tasks = [
+    dict(task_dir='FixedDelayTask', sheet='SI_table_2_bilateral_perturb.xlsx', delay_duration=2,
+         header_row=2, columns=[0, 15, 16, 17, 18], header=xlsx_header, capacity=20),
+    dict(task_dir='RandomDelayTask', sheet='SI_table_3_random_delay_perturb.xlsx', delay_duration=None,
+         header_row=5, columns=[0, 15, 16, 17, 18], header=xlsx_header, capacity=23),
+    dict(task_dir='RandomDelayTask', sheet='SI_table_3_random_delay_perturb.xlsx', delay_duration=None,
+         header_row=42, columns=[0, 5, 6, 7, 8], header=xlsx_header, capacity=11),
+    dict(task_dir='TactileTask', sheet='Whisker_taskTavle_for_paper.csv', delay_duration=1.2,
+         header_row=1, columns=[0, 5, 6, 7, 8, 9], header=csv_header, capacity=30),
+    dict(task_dir='Sound task 1.2s', sheet='OppositeTask12_for_paper.csv', delay_duration=1.2,
+         header_row=1, columns=[0, 5, 6, 7, 8, 9], header=csv_header, capacity=37)]
+random_delay_durations = [0.3, 0.6, 1.2, 1.8, 2.4]  # (s)
+probe_capacity = sum(task['capacity'] for task in probe_tasks)
+
+genotypes = ['C57BL6', 'GAD2-Cre x Ai32', 'Olig3-Cre x Ai35D']
+date_of_birth = datetime(2018, 1, 1)
+first_session_time = datetime(2018, 6, 1)
+
+
+def to_date_number(date):
+    # dates are read by utilities.parse_date - e.g. 20180601
+    return int(date.strftime('%Y%m%d'))
+
+
+def to_struct_array(fields, n):
+    # a 1-D struct array - each field holds one value per element
+    struct = np.zeros(n, dtype=[(k, object) for k in fields])
+    for k, values in fields.items():
+        for idx, v in enumerate(values):
+            struct[k][idx] = v
+    return struct
+
+
+# ========================== BEHAVIOR ==========================
+def make_behavior(rng, trial_count, trial_duration, delay_durations, trial_types):
+    """
+    Event times (s, with respect to the trial start) and lick times of each trial
+     + trial_types: {trial type: (side of the licks, are there licks, probability)}
+    """
+    trial_type_vector = rng.choice(list(trial_types), trial_count, p=[v[2] for v in trial_types.values()])
+    sampling_start = 0.5 + rng.uniform(0, 0.1, trial_count)
+    delay_start = sampling_start + sample_duration
+    cue_start = delay_start + delay_durations
+    cue_end = cue_start + cue_duration
+
+    licks = {'left': [], 'right': []}
+    first_lick = np.full(trial_count, np.nan)
+    for tr_idx, tr_type in enumerate(trial_type_vector):
+        lick_side, has_licks, _ = trial_types[tr_type]
+        lick_count = rng.randint(3, 10) if has_licks else 0
+        lick_times = cue_start[tr_idx] + rng.uniform(0.1, 0.4) + np.arange(lick_count) * lick_interval
+        lick_times = lick_times[lick_times < trial_duration - lick_interval]
+        if lick_times.size:
+            first_lick[tr_idx] = lick_times[0]
+        licks[lick_side].append(lick_times)
+        licks['left' if lick_side == 'right' else 'right'].append(np.array([]))
+
+    return dict(trial_type_vector=trial_type_vector, sampling_start=sampling_start, delay_start=delay_start,
+                cue_start=cue_start, cue_end=cue_end, first_lick=first_lick, licks=licks)
+
+
+def make_spike_times(rng, duration, firing_rate):
+    return np.sort(rng.uniform(0, duration, rng.poisson(firing_rate * duration)))
+
+
+# ========================== WHOLE-CELL ==========================
+def make_wholecell_mat(rng, cell_id, is_epsp, trial_count, trial_duration, fs, firing_rate):
+    sample_count = int(trial_count * trial_duration * fs)
+    trial_onset_bin = (np.arange(trial_count) * trial_duration * fs).astype(int)
+    behav = make_behavior(rng, trial_count, trial_duration,
+                          np.full(trial_count, wholecell_delay_duration), wholecell_trial_types)
+    aom_on_or_off = (rng.uniform(size=trial_count) < 0.25).astype(int)
+
+    # -- membrane potential, spikes
+    vm_wo_spike = -65 + np.cumsum(rng.randn(sample_count)) * 0.01 + rng.randn(sample_count) * 0.5
+    spike_peak_bin = (make_spike_times(rng, sample_count / fs, firing_rate) * fs).astype(int)
+    vm = vm_wo_spike.copy()
+    vm[spike_peak_bin] += 80
+
+    # -- current injection, at the end of the trial (EPSP cells only)
+    injected_current = -100. if is_epsp else 0.
+    output_700b = rng.randn(sample_count) * 2
+    if is_epsp:
+        injection_onset_bin = trial_onset_bin + int((trial_duration - 0.5) * fs)
+        for onset in injection_onset_bin:
+            output_700b[onset:onset + int(0.2 * fs)] += injected_current
+    else:
+        injection_onset_bin = np.full(trial_count, np.nan)
+
+    # -- photostim (AOM command), from the delay start
+    aom = np.zeros(sample_count)
+    stim_t = np.arange(int(photostim_duration * fs)) / fs
+    for tr_idx in np.where(aom_on_or_off)[0]:
+        onset = trial_onset_bin[tr_idx] + int(behav['delay_start'][tr_idx] * fs)
+        aom[onset:onset + len(stim_t)] = 2.5 * (1 - np.cos(2 * np.pi * photostim_freq * stim_t))
+
+    behav_timing = to_struct_array(dict(
+        cue_start=behav['cue_start'], cue_end=behav['cue_end'], sampling_start=behav['sampling_start'],
+        delay_start=behav['delay_start'], end_time=np.full(trial_count, trial_duration),
+        lickL_on_time=behav['licks']['left'], lickL_off_time=[t + 0.05 for t in behav['licks']['left']],
+        lickR_on_time=behav['licks']['right'], lickR_off_time=[t + 0.05 for t in behav['licks']['right']]),
+        trial_count)
+
+    return dict(cell_id=cell_id,
+                Pyr_or_GABA='GABA' if rng.uniform() < 0.2 else 'Pyr',
+                recording_data=dict(Vm=vm, Vm_wo_spike=vm_wo_spike, sample_rate=float(fs),
+                                    Output_700B=output_700b, spike_peak_bin=spike_peak_bin, AOM=aom),
+                behavioral_data=dict(behav_timing=behav_timing, trial_onset_bin=trial_onset_bin,
+                                     trial_type_vector=behav['trial_type_vector'],
+                                     AOM_on_or_off=aom_on_or_off,
+                                     tail_current_injection_onset_bin=injection_onset_bin),
+                meta_data=dict(injected_current=injected_current))
+
+
+def generate_wholecell(rng, output_dir, cells, trials, trial_duration, fs, firing_rate, epsp_fraction):
+    data_dir = os.path.join(output_dir, 'WholeCellData')
+    os.makedirs(os.path.join(data_dir, 'Data'), exist_ok=True)
+
+    meta_rows = []
+    for cell_idx in range(cells):
+        cell_id = cell_idx + 1
+        is_epsp = cell_idx < round(cells * epsp_fraction)
+        fname = f'cell_{cell_id}_{"EPSP" if is_epsp else "regular"}.mat'
+        print(f'Writing: {fname}')
+        sio.savemat(os.path.join(data_dir, 'Data', fname),
+                    {'wholeCell': make_wholecell_mat(rng, cell_id, is_epsp, trials, trial_duration,
+                                                     fs, firing_rate)},
+                    long_field_names=True)
+        meta_rows.append([f'Cell {cell_id}', 'Auditory task', round(rng.uniform(300, 900), 1),
+                          trials // 2, trials // 2, 0.8, 0.5, 0.5,
+                          f'ANM8{cell_id:05d}', genotypes[cell_idx % len(genotypes)],
+                          to_date_number(date_of_birth),
+                          to_date_number(first_session_time + timedelta(days=cell_idx)),
+                          'Yes' if is_epsp else 'No', 'No'])
+
+    # header row, units row (skipped by the ingest script), one row per cell
+    header = ['Cell', 'Experiment type', 'Depth', 'Correct contra trials', 'Correct ipsi trials', 'Performance',
+              'Delay selectivity (SR)', 'Delay selectivity (Vm)', 'Animal ID', 'Genotype', 'Date of birth',
+              'Session date', 'Current injection', 'From Guo, Inagaki 2017']
+    units = ['', '', 'um', '', '', '', '', '', '', '', '', '', '', '']
+    pd.DataFrame([units] + meta_rows, columns=header).to_excel(
+        os.path.join(data_dir, wholecell_xlsx), index=False)
+
+
+# ========================== EXTRACELLULAR ==========================
+def make_probe_mat(rng, trial_count, trial_duration, fs, delay_duration, unit_count, firing_rate, waveform_samples):
+    if delay_duration is None:  # random delay task
+        delay_durations = rng.choice(random_delay_durations, trial_count)
+    else:
+        delay_durations = np.full(trial_count, float(delay_duration))
+    behav = make_behavior(rng, trial_count, trial_duration, delay_durations, probe_trial_types)
+    stim_trial_vector = (rng.uniform(size=trial_count) < 0.25).astype(int)
+    stim_powers = rng.choice([1.5, 3, 5], trial_count)
+    trial_types = np.array([f'{"R" if probe_trial_types[tr_type][0] == "right" else "L"}'
+                            + (f'_s_{int(power)}mW_early_delay' if stim else '_nostim')
+                            for tr_type, stim, power in zip(behav['trial_type_vector'], stim_trial_vector,
+                                                            stim_powers)], dtype=object)
+    bad_trial_count = int(trial_count * 0.05)  # bad trials at the start and the end of the session
+    trial_range = np.array([bad_trial_count, trial_count - 1 - bad_trial_count])
+
+    behavior = dict(Sample_start=behav['sampling_start'], Delay_start=behav['delay_start'],
+                    Cue_start=behav['cue_start'], First_lick=behav['first_lick'],
+                    stim_trial_vector=stim_trial_vector,
+                    Trial_types_of_response_vector=behav['trial_type_vector'])
+    trial_info = dict(Trial_types=trial_types, Trial_range_to_analyze=trial_range)
+    meta_data = dict(parameters=dict(Sample_Rate=float(fs)))
+
+    # spike times with respect to the start of their trial
+    spike_times, spike_trial_idx, spike_shapes = [], [], []
+    unit_waveform = -np.exp(-((np.arange(waveform_samples) - waveform_samples / 3) / 3) ** 2)
+    for _ in range(unit_count):
+        session_spike_times = make_spike_times(rng, trial_count * trial_duration, rng.uniform(0.5, 2) * firing_rate)
+        trial_idx = (session_spike_times // trial_duration).astype(int)
+        spike_times.append(session_spike_times - trial_idx * trial_duration)
+        spike_trial_idx.append(trial_idx + 1)  # trial-number starts from 1
+        amplitude = rng.uniform(50, 200)
+        spike_shapes.append(dict(SpikeShape=amplitude * unit_waveform
+                                 + rng.randn(len(session_spike_times), waveform_samples) * amplitude * 0.1))
+
+    units = to_struct_array(dict(
+        channel=rng.randint(1, 65, unit_count),
+        SpikeWidth=rng.uniform(0.2, 0.8, unit_count),
+        Depth=rng.uniform(100, 1200, unit_count),
+        SpikeTimes=spike_times,
+        Trial_idx_of_spike=spike_trial_idx,
+        Spike_shpe_info=spike_shapes,
+        Trial_info=[trial_info] * unit_count,
+        Meta_data=[meta_data] * unit_count,
+        Behavior=[behavior] * unit_count), unit_count)
+
+    onsets = (np.arange(trial_count) * trial_duration * fs).astype(int)
+    trial_info = to_struct_array(dict(onset=onsets, offset=onsets + int(trial_duration * fs) - 1), trial_count)
+    return {'unit': units, 'trial_info': trial_info}
+
+
+def write_metadata_sheet(fpath, tasks_rows):
+    """
+    Write the rows of one or more tasks into one metadata sheet, at the header row and columns read by the ingest script
+    """
+    row_count = max(task['header_row'] + 1 + task['capacity'] for task, _ in tasks_rows)
+    col_count = max(task['columns'][-1] + 1 for task, _ in tasks_rows)
+    grid = [[None] * col_count for _ in range(row_count)]
+    grid[0][0] = 'Synthetic dataset'
+    for task, rows in tasks_rows:
+        for row_idx, row in enumerate([task['header']] + rows):
+            for col, value in zip(task['columns'], row):
+                grid[task['header_row'] + row_idx][col] = value
+
+    if fpath.endswith('.csv'):
+        pd.DataFrame(grid).to_csv(fpath, index=False, header=False)
+    else:
+        pd.DataFrame(grid).to_excel(fpath, index=False, header=False)
+
+
+def generate_extracellular(rng, output_dir, sessions, units, trials, trial_duration, fs, firing_rate,
+                           waveform_samples):
+    data_dir = os.path.join(output_dir, 'SiliconProbeData')
+    # fill the tasks in order, up to the number of rows read from each metadata sheet
+    tasks_rows = [(task, []) for task in probe_tasks]
+    for sess_idx in range(sessions):
+        task_idx = np.searchsorted(np.cumsum([task['capacity'] for task in probe_tasks]), sess_idx, side='right')
+        task, rows = tasks_rows[task_idx]
+        subject_id = f'ANM9{sess_idx + 1:05d}'
+        session_time = first_session_time + timedelta(days=sess_idx)
+        session_name = f'{subject_id}_{session_time.strftime("%Y%m%d")}'
+        row = [session_name, subject_id, genotypes[sess_idx % len(genotypes)], to_date_number(date_of_birth)]
+        if 'Sex' in task['header']:
+            row.append('Male' if sess_idx % 2 else 'Female')
+        row.append(to_date_number(session_time))
+        rows.append(row)
+
+        os.makedirs(os.path.join(data_dir, task['task_dir']), exist_ok=True)
+        fname = f'{session_name}_units.mat'
+        print(f'Writing: {os.path.join(task["task_dir"], fname)}')
+        sio.savemat(os.path.join(data_dir, task['task_dir'], fname),
+                    make_probe_mat(rng, trials, trial_duration, fs, task['delay_duration'], units,
+                                   firing_rate, waveform_samples),
+                    long_field_names=True)
+
+    # all metadata sheets are read by the ingest script - write them even if empty
+    sheets = {}
+    for task, rows in tasks_rows:
+        sheets.setdefault(os.path.join(task['task_dir'], task['sheet']), []).append((task, rows))
+    for sheet, sheet_tasks_rows in sheets.items():
+        os.makedirs(os.path.join(data_dir, os.path.dirname(sheet)), exist_ok=True)
+        write_metadata_sheet(os.path.join(data_dir, sheet), sheet_tasks_rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic WholeCellData/SiliconProbeData dataset')
+    parser.add_argument('output_dir', help='directory to write "WholeCellData" and "SiliconProbeData" to')
+    parser.add_argument('--cells', type=int, default=4,
+                        help=f'number of whole-cell sessions, one cell each (default: 4, max: {wholecell_capacity})')
+    parser.add_argument('--epsp-fraction', type=float, default=0.5,
+                        help='fraction of the whole-cell sessions with current injection (default: 0.5)')
+    parser.add_argument('--probe-sessions', type=int, default=2,
+                        help=f'number of extracellular sessions (default: 2, max: {probe_capacity})')
+    parser.add_argument('--units', type=int, default=20, help='number of units per probe session (default: 20)')
+    parser.add_argument('--trials', type=int, default=100, help='number of trials per session (default: 100)')
+    parser.add_argument('--trial-duration', type=float, default=6,
+                        help='(s) duration of each trial - the recording of a session is trials x trial duration '
+                             f'long (default: 6, min: {min_trial_duration})')
+    parser.add_argument('--sampling-rate', type=float, default=20000,
+                        help='(Hz) sampling rate of the whole-cell signals (default: 20000)')
+    parser.add_argument('--probe-sampling-rate', type=float, default=19531.25,
+                        help='(Hz) sampling rate of the extracellular recordings (default: 19531.25)')
+    parser.add_argument('--firing-rate', type=float, default=10, help='(Hz) mean firing rate (default: 10)')
+    parser.add_argument('--waveform-samples', type=int, default=32,
+                        help='number of samples of each spike waveform (default: 32)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default: 0)')
+    args = parser.parse_args()
+    if not 0 <= args.cells <= wholecell_capacity:
+        parser.error(f'--cells must be between 0 and {wholecell_capacity}')
+    if not 0 <= args.probe_sessions <= probe_capacity:
+        parser.error(f'--probe-sessions must be between 0 and {probe_capacity}')
+    if args.trial_duration < min_trial_duration:
+        parser.error(f'--trial-duration must be at least {min_trial_duration} s')
+
+    rng = np.random.RandomState(args.seed)
+    generate_wholecell(rng, args.output_dir, args.cells, args.trials, args.trial_duration, args.sampling_rate,
+                       args.firing_rate, args.epsp_fraction)
+    generate_extracellular(rng, args.output_dir, args.probe_sessions, args.units, args.trials, args.trial_duration,
+                           args.probe_sampling_rate, args.firing_rate, args.waveform_samples)
+
+    with open(os.path.join(args.output_dir, 'synthetic_dataset.json'), 'w') as f:
+        json.dump(dict(vars(args), generated=datetime.now().isoformat()), f, indent=2)
+    print(f'\nSynthetic dataset written to: {args.output_dir}')
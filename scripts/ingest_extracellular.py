@@ -2,13 +2,16 @@
 
 import os
 import re
+import sys
+import json
+import argparse
 from datetime import datetime
+from functools import lru_cache
 
 import numpy as np
 from decimal import Decimal
 import scipy.io as sio
 import pandas as pd
-from tqdm import tqdm
 import glob
 from decimal import Decimal
 import datajoint as dj
@@ -18,48 +21,52 @@ from pipeline import (reference, subject, acquisition, stimulation, analysis,
 from pipeline import extracellular_path as path
 
 # ================== Dataset ==================
-# Fixex-delay
-fixed_delay_xlsx = pd.read_excel(
-    os.path.join(path, 'FixedDelayTask', 'SI_table_2_bilateral_perturb.xlsx'),
-    index_col =0, usecols='A, P, Q, R, S', skiprows=2, nrows=20)
-fixed_delay_xlsx.columns = ['subject_id', 'genotype', 'date_of_birth', 'session_time']
-fixed_delay_xlsx['sex'] = 'Unknown'
-fixed_delay_xlsx['sess_type'] = 'Auditory task'
-fixed_delay_xlsx['delay_duration'] = 2
-# Random-long-delay
-random_long_delay_xlsx = pd.read_excel(
-    os.path.join(path, 'RandomDelayTask', 'SI_table_3_random_delay_perturb.xlsx'),
-    index_col =0, usecols='A, P, Q, R, S', skiprows=5, nrows=23)
-random_long_delay_xlsx.columns = ['subject_id', 'genotype', 'date_of_birth', 'session_time']
-random_long_delay_xlsx['sex'] = 'Unknown'
-random_long_delay_xlsx['sess_type'] = 'Auditory task'
-random_long_delay_xlsx['delay_duration'] = np.nan
-# Random-short-delay
-random_short_delay_xlsx = pd.read_excel(
-    os.path.join(path, 'RandomDelayTask', 'SI_table_3_random_delay_perturb.xlsx'),
-    index_col =0, usecols='A, F, G, H, I', skiprows=42, nrows=11)
-random_short_delay_xlsx.columns = ['subject_id', 'genotype', 'date_of_birth', 'session_time']
-random_short_delay_xlsx['sex'] = 'Unknown'
-random_short_delay_xlsx['sess_type'] = 'Auditory task'
-random_short_delay_xlsx['delay_duration'] = np.nan
-# Tactile-task
-tactile_xlsx = pd.read_csv(
-    os.path.join(path, 'TactileTask', 'Whisker_taskTavle_for_paper.csv'),
-    index_col =0, usecols= [0, 5, 6, 7, 8, 9], skiprows=1, nrows=30)
-tactile_xlsx.columns = ['subject_id', 'genotype', 'date_of_birth', 'sex', 'session_time']
-tactile_xlsx = tactile_xlsx.reindex(columns=['subject_id', 'genotype', 'date_of_birth', 'session_time', 'sex'])
-tactile_xlsx['sess_type'] = 'Tactile task'
-tactile_xlsx['delay_duration'] = 1.2
-# Sound-task 1.2s
-sound12_xlsx = pd.read_csv(
-    os.path.join(path, 'Sound task 1.2s', 'OppositeTask12_for_paper.csv'),
-    index_col =0, usecols= [0, 5, 6, 7, 8, 9], skiprows=1, nrows=37)
-sound12_xlsx.columns = ['subject_id', 'genotype', 'date_of_birth', 'sex', 'session_time']
-sound12_xlsx = sound12_xlsx.reindex(columns=['subject_id', 'genotype', 'date_of_birth', 'session_time', 'sex'])
-sound12_xlsx['sess_type'] = 'Auditory task'
-sound12_xlsx['delay_duration'] = 1.2
-# concat all 5
-meta_data = pd.concat([fixed_delay_xlsx, random_long_delay_xlsx, random_short_delay_xlsx, tactile_xlsx, sound12_xlsx])
+@lru_cache(maxsize=None)
+def load_meta_data():
+    # parsed on first use only - an incremental run with no file to ingest does not read the sheets
+    # Fixex-delay
+    fixed_delay_xlsx = pd.read_excel(
+        os.path.join(path, 'FixedDelayTask', 'SI_table_2_bilateral_perturb.xlsx'),
+        index_col =0, usecols='A, P, Q, R, S', skiprows=2, nrows=20)
+    fixed_delay_xlsx.columns = ['subject_id', 'genotype', 'date_of_birth', 'session_time']
+    fixed_delay_xlsx['sex'] = 'Unknown'
+    fixed_delay_xlsx['sess_type'] = 'Auditory task'
+    fixed_delay_xlsx['delay_duration'] = 2
+    # Random-long-delay
+    random_long_delay_xlsx = pd.read_excel(
+        os.path.join(path, 'RandomDelayTask', 'SI_table_3_random_delay_perturb.xlsx'),
+        index_col =0, usecols='A, P, Q, R, S', skiprows=5, nrows=23)
+    random_long_delay_xlsx.columns = ['subject_id', 'genotype', 'date_of_birth', 'session_time']
+    random_long_delay_xlsx['sex'] = 'Unknown'
+    random_long_delay_xlsx['sess_type'] = 'Auditory task'
+    random_long_delay_xlsx['delay_duration'] = np.nan
+    # Random-short-delay
+    random_short_delay_xlsx = pd.read_excel(
+        os.path.join(path, 'RandomDelayTask', 'SI_table_3_random_delay_perturb.xlsx'),
+        index_col =0, usecols='A, F, G, H, I', skiprows=42, nrows=11)
+    random_short_delay_xlsx.columns = ['subject_id', 'genotype', 'date_of_birth', 'session_time']
+    random_short_delay_xlsx['sex'] = 'Unknown'
+    random_short_delay_xlsx['sess_type'] = 'Auditory task'
+    random_short_delay_xlsx['delay_duration'] = np.nan
+    # Tactile-task
+    tactile_xlsx = pd.read_csv(
+        os.path.join(path, 'TactileTask', 'Whisker_taskTavle_for_paper.csv'),
+        index_col =0, usecols= [0, 5, 6, 7, 8, 9], skiprows=1, nrows=30)
+    tactile_xlsx.columns = ['subject_id', 'genotype', 'date_of_birth', 'sex', 'session_time']
+    tactile_xlsx = tactile_xlsx.reindex(columns=['subject_id', 'genotype', 'date_of_birth', 'session_time', 'sex'])
+    tactile_xlsx['sess_type'] = 'Tactile task'
+    tactile_xlsx['delay_duration'] = 1.2
+    # Sound-task 1.2s
+    sound12_xlsx = pd.read_csv(
+        os.path.join(path, 'Sound task 1.2s', 'OppositeTask12_for_paper.csv'),
+        index_col =0, usecols= [0, 5, 6, 7, 8, 9], skiprows=1, nrows=37)
+    sound12_xlsx.columns = ['subject_id', 'genotype', 'date_of_birth', 'sex', 'session_time']
+    sound12_xlsx = sound12_xlsx.reindex(columns=['subject_id', 'genotype', 'date_of_birth', 'session_time', 'sex'])
+    sound12_xlsx['sess_type'] = 'Auditory task'
+    sound12_xlsx['delay_duration'] = 1.2
+    # concat all 5
+    return pd.concat([fixed_delay_xlsx, random_long_delay_xlsx, random_short_delay_xlsx, tactile_xlsx, sound12_xlsx])
+
 
 trial_type_and_response_dict = {1: ('lick right', 'correct'),
                                 2: ('lick left', 'correct'),
@@ -73,16 +80,24 @@ trial_type_and_response_dict = {1: ('lick right', 'correct'),
                                 10: ('lick left', 'early lick'),
                                 0: ('photo-tagging', 'N/A')}
 
-# ========================== METADATA ==========================
-# ==================== subject ====================
-fnames = np.hstack(glob.glob(os.path.join(dir_files[0], '*.mat'))
-                   for dir_files in os.walk(path) if len(dir_files[1]) == 0)
 
-for fname in fnames:
+def get_session_id(fname):
+    return '_'.join(re.sub('_units.mat|_JRC_units', '', os.path.split(fname)[-1]).split('_')[:2])
+
+
+def ingest_file(fname):
+    # one transaction per file - a failing file leaves nothing partially ingested
+    with dj.conn().transaction:
+        ingest_units_mat(fname)
+
+
+# ========================== METADATA ==========================
+def ingest_units_mat(fname):
+    # ==================== subject ====================
     mat = sio.loadmat(fname, struct_as_record=False, squeeze_me=True)
     mat_units = mat['unit']
     mat_trial_info = mat.get('trial_info')
-    this_sess = meta_data.loc[re.sub('_units.mat|_JRC_units', '', os.path.split(fname)[-1])]
+    this_sess = load_meta_data().loc[re.sub('_units.mat|_JRC_units', '', os.path.split(fname)[-1])]
     print(f'\nReading: {this_sess.name}')
 
     subject_info = dict(subject_id=this_sess.subject_id.lower(),
@@ -95,11 +110,11 @@ for fname in fnames:
     regex_str = '|'.join([re.escape(alias) for alias in allele_dict.keys()])
     alleles = [allele_dict[s.lower()] for s in re.findall(regex_str, this_sess.genotype, re.I)]
 
-    with subject.Subject.connection.transaction:
-        if subject_info not in subject.Subject.proj():
-            subject.Subject.insert1(subject_info, ignore_extra_fields=True)
-            subject.Subject.Allele.insert((dict(subject_info, allele=k)
-                                           for k in alleles), ignore_extra_fields = True)
+    # skip_duplicates - the same subject/probe may be inserted concurrently by another worker
+    if subject_info not in subject.Subject.proj():
+        subject.Subject.insert1(subject_info, ignore_extra_fields=True, skip_duplicates=True)
+        subject.Subject.Allele.insert((dict(subject_info, allele=k)
+                                       for k in alleles), ignore_extra_fields = True, skip_duplicates=True)
 
     # ==================== session ====================
     # -- session_time
@@ -117,72 +132,87 @@ for fname in fnames:
     # no experimenter info
     acquisition.ExperimentType.insert(zip(experiment_types), skip_duplicates=True)
 
-    with acquisition.Session.connection.transaction:
-        if session_info not in acquisition.Session.proj():
-            acquisition.Session.insert1(session_info, ignore_extra_fields=True)
-            acquisition.Session.Experimenter.insert((dict(session_info, experimenter=k)
-                                                     for k in experimenters),
-                                                    ignore_extra_fields=True)
-            acquisition.Session.ExperimentType.insert((dict(session_info, experiment_type=k)
-                                                       for k in experiment_types),
-                                                      ignore_extra_fields=True)
-        print(f'\nCreating Session - Subject: {subject_info["subject_id"]} - Date: {session_info["session_time"]}')
+    if session_info not in acquisition.Session.proj():
+        acquisition.Session.insert1(session_info, ignore_extra_fields=True)
+        acquisition.Session.Experimenter.insert((dict(session_info, experimenter=k)
+                                                 for k in experimenters),
+                                                ignore_extra_fields=True)
+        acquisition.Session.ExperimentType.insert((dict(session_info, experiment_type=k)
+                                                   for k in experiment_types),
+                                                  ignore_extra_fields=True)
+    print(f'\nCreating Session - Subject: {subject_info["subject_id"]} - Date: {session_info["session_time"]}')
 
     # ==================== Trials ====================
     # Trial Info for all units are the same -> pick unit[0] to extract trial info
     unit_0 = mat_units[0]
     trial_key = dict(session_info, trial_counts=len(unit_0.Trial_info.Trial_types))
 
-    with acquisition.TrialSet.connection.transaction:
-        if trial_key not in acquisition.TrialSet.proj():
-            fs = unit_0.Meta_data.parameters.Sample_Rate
-            # handle different fieldnames "Sampling_start" vs "Sample_start"
-            if 'Sample_start' not in unit_0.Behavior._fieldnames and 'Sampling_start' in unit_0.Behavior._fieldnames:
-                unit_0.Behavior.Sample_start = unit_0.Behavior.Sampling_start
-            if unit_0.Behavior.stim_trial_vector.size == 0:
-                unit_0.Behavior.stim_trial_vector = [True if re.search('_s_', str(tr_type)) else False
-                                                     for tr_type in unit_0.Trial_info.Trial_types]
-            # compute delay_duration
-            delay_dur = np.nanmedian(unit_0.Behavior.Cue_start - unit_0.Behavior.Delay_start)
-
-            print('\nInsert trial information')
-            acquisition.TrialSet.insert1(trial_key, allow_direct_insert=True, ignore_extra_fields = True)
-
-            for tr_idx, (stim_trial, trial_type_of_response, trial_type,
-                         first_lick, cue_start, delay_start, sample_start) in tqdm(
-                enumerate(zip(unit_0.Behavior.stim_trial_vector, unit_0.Behavior.Trial_types_of_response_vector,
-                              unit_0.Trial_info.Trial_types, unit_0.Behavior.First_lick, unit_0.Behavior.Cue_start,
-                              unit_0.Behavior.Delay_start, unit_0.Behavior.Sample_start))):
-
-                trial_key['trial_id'] = tr_idx + 1  # trial-number starts from 1
-                trial_key['start_time'] = mat_trial_info[tr_idx].onset / fs if mat_trial_info is not None else None  # hard-coded here, no trial-start times found in data for 2018 paper
-                trial_key['stop_time'] = mat_trial_info[tr_idx].offset / fs if mat_trial_info is not None else None  # hard-coded here, no trial-end times found in data
-                trial_key['trial_stim_present'] = bool(stim_trial != 0)
-                trial_key['trial_is_good'] = bool(unit_0.Trial_info.Trial_range_to_analyze[0]
-                                                  <= tr_idx <= unit_0.Trial_info.Trial_range_to_analyze[-1])
-                trial_key['trial_type'], trial_key['trial_response'] = trial_type_and_response_dict[trial_type_of_response]
-                trial_key['delay_duration'] = Decimal(cue_start - delay_start).quantize(Decimal('0.1'))
-                acquisition.TrialSet.Trial.insert1(trial_key, ignore_extra_fields=True, skip_duplicates=True,
-                                                   allow_direct_insert=True)
-
-                # ======== Now add trial event timing to the EventTime part table ====
-                events_time = dict(trial_start=0,
-                                   trial_stop=(trial_key['stop_time'] - trial_key['start_time']
-                                               if mat_trial_info is not None else None),
-                                   first_lick=first_lick,
-                                   cue_start=cue_start,
-                                   delay_start=delay_start,
-                                   sampling_start=sample_start)
-                # -- events timing
-                acquisition.TrialSet.EventTime.insert((dict(trial_key, trial_event=k, event_time=e)
-                                                       for k, e in events_time.items()),
-                                                      ignore_extra_fields = True, skip_duplicates = True,
-                                                      allow_direct_insert = True)
-                # ======== Now add trial stimulation descriptors to the TrialPhotoStimInfo table ====
-                trial_key['photo_stim_period'] = 'early delay'  # TODO: hardcoded here because this info is not available from data
-                trial_key['photo_stim_power'] = (re.search('(?<=_)\d+(?=mW_)', str(trial_type)).group()  # str() to safeguard against np.array([]) (probably typo)
-                                                 if re.search('(?<=_)\d+(?=mW_)', str(trial_type)) else None)
-                stimulation.TrialPhotoStimParam.insert1(trial_key, ignore_extra_fields=True, allow_direct_insert=True)
+    if trial_key not in acquisition.TrialSet.proj():
+        fs = unit_0.Meta_data.parameters.Sample_Rate
+        # handle different fieldnames "Sampling_start" vs "Sample_start"
+        if 'Sample_start' not in unit_0.Behavior._fieldnames and 'Sampling_start' in unit_0.Behavior._fieldnames:
+            unit_0.Behavior.Sample_start = unit_0.Behavior.Sampling_start
+        if unit_0.Behavior.stim_trial_vector.size == 0:
+            unit_0.Behavior.stim_trial_vector = [True if re.search('_s_', str(tr_type)) else False
+                                                 for tr_type in unit_0.Trial_info.Trial_types]
+        # compute delay_duration
+        delay_dur = np.nanmedian(unit_0.Behavior.Cue_start - unit_0.Behavior.Delay_start)
+
+        print('\nInsert trial information')
+        acquisition.TrialSet.insert1(trial_key, allow_direct_insert=True, ignore_extra_fields = True)
+
+        # ---- build the trial, event-time and photostim columns for the whole session at once ----
+        unit_behav = unit_0.Behavior
+        trial_count = trial_key['trial_counts']
+        trial_idx = np.arange(trial_count)
+        trial_ids = trial_idx + 1  # trial-number starts from 1
+        if mat_trial_info is not None:
+            start_times = np.array([tr.onset for tr in mat_trial_info]) / fs
+            stop_times = np.array([tr.offset for tr in mat_trial_info]) / fs
+            trial_stops = stop_times - start_times
+        else:  # no trial-start/end times found in data for 2018 paper
+            start_times = stop_times = trial_stops = np.full(trial_count, None)
+        trial_types, trial_responses = zip(*(trial_type_and_response_dict[tr_type_of_response]
+                                             for tr_type_of_response in unit_behav.Trial_types_of_response_vector))
+        trial_range = unit_0.Trial_info.Trial_range_to_analyze
+        is_good = np.logical_and(trial_idx >= trial_range[0], trial_idx <= trial_range[-1])
+        stim_present = np.asarray(unit_behav.stim_trial_vector) != 0
+        delay_durations = np.round(unit_behav.Cue_start - unit_behav.Delay_start, 1)
+
+        utilities.insert_in_batches(
+            acquisition.TrialSet.Trial,
+            (dict(session_info, trial_id=tr_id, start_time=start, stop_time=stop,
+                  trial_stim_present=bool(stim), trial_is_good=bool(good),
+                  trial_type=tr_type, trial_response=tr_response, delay_duration=delay)
+             for tr_id, start, stop, stim, good, tr_type, tr_response, delay in zip(
+                trial_ids, start_times, stop_times, stim_present, is_good,
+                trial_types, trial_responses, delay_durations)),
+            ignore_extra_fields=True, skip_duplicates=True, allow_direct_insert=True)
+
+        # ======== Now add trial event timing to the EventTime part table ====
+        events_time = dict(trial_start=np.zeros(trial_count),
+                           trial_stop=trial_stops,
+                           first_lick=unit_behav.First_lick,
+                           cue_start=unit_behav.Cue_start,
+                           delay_start=unit_behav.Delay_start,
+                           sampling_start=unit_behav.Sample_start)
+        utilities.insert_in_batches(
+            acquisition.TrialSet.EventTime,
+            (dict(session_info, trial_id=tr_id, trial_event=event, event_time=event_times[tr_idx])
+             for event, event_times in events_time.items() for tr_idx, tr_id in enumerate(trial_ids)),
+            ignore_extra_fields=True, skip_duplicates=True, allow_direct_insert=True)
+
+        # ======== Now add trial stimulation descriptors to the TrialPhotoStimInfo table ====
+        # str() to safeguard against np.array([]) (probably typo)
+        photo_stim_powers = pd.Series(unit_0.Trial_info.Trial_types).astype(str).str.extract(
+            r'(?<=_)(\d+)(?=mW_)', expand=False).astype(float)
+        utilities.insert_in_batches(
+            stimulation.TrialPhotoStimParam,
+            (dict(session_info, trial_id=tr_id,
+                  photo_stim_period='early delay',  # TODO: hardcoded here because this info is not available from data
+                  photo_stim_power=None if np.isnan(power) else power)
+             for tr_id, power in zip(trial_ids, photo_stim_powers)),
+            ignore_extra_fields=True, allow_direct_insert=True)
 
     # ==================== Extracellular ====================
     # no info about Probe or recording location from data, all hardcoded from paper
@@ -190,12 +220,11 @@ for fname in fnames:
     chn_per_shank = 32
     probe_name = 'A2x32-8mm-25-250-165'
     # -- Probe
-    with reference.Probe.connection.transaction:
-        if {'probe_name': probe_name, 'channel_counts': channel_counts} not in reference.Probe.proj():
-            reference.Probe.insert1({'probe_name': probe_name, 'channel_counts': channel_counts})
-            reference.Probe.Channel.insert({'probe_name': probe_name, 'channel_counts': channel_counts,
-                                            'channel_id': ch_idx, 'shank_id': int(ch_idx <= chn_per_shank) + 1}
-                                           for ch_idx in np.arange(channel_counts) + 1)
+    if {'probe_name': probe_name, 'channel_counts': channel_counts} not in reference.Probe.proj():
+        reference.Probe.insert1({'probe_name': probe_name, 'channel_counts': channel_counts}, skip_duplicates=True)
+        reference.Probe.Channel.insert(({'probe_name': probe_name, 'channel_counts': channel_counts,
+                                         'channel_id': ch_idx, 'shank_id': int(ch_idx <= chn_per_shank) + 1}
+                                        for ch_idx in np.arange(channel_counts) + 1), skip_duplicates=True)
 
     brain_region = 'ALM'
     hemisphere = 'left'
@@ -254,3 +283,42 @@ for fname in fnames:
                                              , ignore_extra_fields=True)
 
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ingest the extracellular dataset (SiliconProbeData)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes, each ingesting one file at a time (default: 1)')
+    parser.add_argument('--failure-log', default=None,
+                        help='path of a JSON file to write the errors of the files that failed to ingest')
+    parser.add_argument('--incremental', action='store_true',
+                        help='skip the files ingested by a previous incremental run and unchanged since, '
+                             'and the files of sessions already ingested - without opening them')
+    parser.add_argument('--state-file', default=None,
+                        help='state file of the incremental ingestion (default: in the "cache_directory")')
+    args = parser.parse_args()
+
+    fnames = np.hstack(glob.glob(os.path.join(dir_files[0], '*.mat'))
+                       for dir_files in os.walk(path) if len(dir_files[1]) == 0)
+
+    on_success = None
+    if args.incremental:
+        ingest_state = utilities.get_ingest_state(path, args.state_file)
+        fnames_to_ingest = utilities.get_files_to_ingest(fnames, ingest_state, get_session_id)
+        print(f'{len(fnames_to_ingest)} files to ingest - {len(fnames) - len(fnames_to_ingest)} files skipped')
+        fnames = fnames_to_ingest
+
+        def on_success(fname):
+            ingest_state.record(fname, checksum=True)
+            ingest_state.save()
+
+    if len(fnames):
+        load_meta_data()  # parsed once, before the worker processes are forked
+
+    failures = utilities.run_in_process_pool(ingest_file, fnames, workers=args.workers, on_success=on_success)
+
+    print(f'\nIngested {len(fnames) - len(failures)}/{len(fnames)} files')
+    if failures:
+        print('Failed files:\n\t' + '\n\t'.join(failures), file=sys.stderr)
+        if args.failure_log:
+            with open(args.failure_log, 'w') as f:
+                json.dump(failures, f, indent=2)
+        sys.exit(1)
@@ -2,34 +2,44 @@
 
 import os
 import re
+import sys
+import json
+import argparse
 from datetime import datetime
+from functools import lru_cache
 
 import numpy as np
 from decimal import Decimal
 import scipy.io as sio
 import pandas as pd
-from tqdm import tqdm
 import uuid
 import datajoint as dj
 import glob
 
 from pipeline import (reference, subject, acquisition, stimulation, analysis,
-                      intracellular, extracellular, behavior, utilities)
+                      intracellular, extracellular, behavior, utilities, signal_store)
 from pipeline import intracellular_path as path
 
 # ================== Dataset ==================
 xlsname = 'SI_table_1_wc_cell_list.xlsx'
-meta_data = pd.read_excel(os.path.join(path, xlsname),
-                          index_col =0,
-                          usecols='A:N',
-                          skiprows=[1],
-                          nrows=79)
-meta_data.columns = ['experiment_type', 'depth_um',
-                     'correct_contra_trial_count', 'correct_ipsi_trial_count',
-                     'performance',
-                     'delay_selectivity_SR', 'delay_selectivity_Vm',
-                     'subject_id', 'genotype', 'date_of_birth', 'session_time',
-                     'current_injection', 'from_guo_inagaki_2017']
+
+
+@lru_cache(maxsize=None)
+def load_meta_data():
+    # parsed on first use only - an incremental run with no file to ingest does not read the sheet
+    meta_data = pd.read_excel(os.path.join(path, xlsname),
+                              index_col =0,
+                              usecols='A:N',
+                              skiprows=[1],
+                              nrows=79)
+    meta_data.columns = ['experiment_type', 'depth_um',
+                         'correct_contra_trial_count', 'correct_ipsi_trial_count',
+                         'performance',
+                         'delay_selectivity_SR', 'delay_selectivity_Vm',
+                         'subject_id', 'genotype', 'date_of_birth', 'session_time',
+                         'current_injection', 'from_guo_inagaki_2017']
+    return meta_data
+
 
 trial_type_and_response_dict = {1: ('lick right', 'correct'),
                                 2: ('lick left', 'correct'),
@@ -43,12 +53,23 @@ trial_type_and_response_dict = {1: ('lick right', 'correct'),
                                 10: ('lick left', 'no response'),
                                 11: ('N/A', 'N/A')}
 
+
+def get_session_id(fname):
+    return os.path.split(fname)[-1].replace('.mat', '')
+
+
+def ingest_file(fname):
+    # one transaction per file - a failing file leaves nothing partially ingested
+    with dj.conn().transaction:
+        ingest_wholecell_mat(fname)
+
+
 # ========================== METADATA ==========================
-# ==================== subject ====================
-for fname in glob.glob(os.path.join(path, 'Data', '*.mat')):
+def ingest_wholecell_mat(fname):
+    # ==================== subject ====================
     mat_data = sio.loadmat(fname, struct_as_record = False, squeeze_me = True)['wholeCell']
-    fname = (os.path.split(fname)[-1]).replace('.mat', '')
-    this_sess = meta_data.loc[f'Cell {mat_data.cell_id}']
+    fname = get_session_id(fname)
+    this_sess = load_meta_data().loc[f'Cell {mat_data.cell_id}']
     print(f'\nReading: {fname}')
 
     subject_info = dict(subject_id=this_sess.subject_id.lower(),
@@ -61,11 +82,11 @@ for fname in glob.glob(os.path.join(path, 'Data', '*.mat')):
     regex_str = '|'.join([re.escape(alias) for alias in allele_dict.keys()])
     alleles = [allele_dict[s.lower()] for s in re.findall(regex_str, this_sess.genotype, re.I)]
 
-    with subject.Subject.connection.transaction:
-        if subject_info not in subject.Subject.proj():
-            subject.Subject.insert1(subject_info, ignore_extra_fields=True)
-            subject.Subject.Allele.insert((dict(subject_info, allele = k)
-                                           for k in alleles), ignore_extra_fields = True)
+    # skip_duplicates - the same subject may be inserted concurrently by another worker
+    if subject_info not in subject.Subject.proj():
+        subject.Subject.insert1(subject_info, ignore_extra_fields=True, skip_duplicates=True)
+        subject.Subject.Allele.insert((dict(subject_info, allele = k)
+                                       for k in alleles), ignore_extra_fields = True, skip_duplicates=True)
 
     # ==================== session ====================
     # -- session_time
@@ -85,14 +106,13 @@ for fname in glob.glob(os.path.join(path, 'Data', '*.mat')):
     # no experimenter info
     acquisition.ExperimentType.insert(zip(experiment_types), skip_duplicates=True)
 
-    with acquisition.Session.connection.transaction:
-        if session_info not in acquisition.Session.proj():
-            acquisition.Session.insert1(session_info, ignore_extra_fields=True)
-            acquisition.Session.Experimenter.insert((dict(session_info, experimenter=k)
-                                                     for k in experimenters), ignore_extra_fields=True)
-            acquisition.Session.ExperimentType.insert((dict(session_info, experiment_type=k)
-                                                       for k in experiment_types), ignore_extra_fields=True)
-        print(f'\nCreating Session - Subject: {subject_info["subject_id"]} - Date: {session_info["session_time"]}')
+    if session_info not in acquisition.Session.proj():
+        acquisition.Session.insert1(session_info, ignore_extra_fields=True)
+        acquisition.Session.Experimenter.insert((dict(session_info, experimenter=k)
+                                                 for k in experimenters), ignore_extra_fields=True)
+        acquisition.Session.ExperimentType.insert((dict(session_info, experiment_type=k)
+                                                   for k in experiment_types), ignore_extra_fields=True)
+    print(f'\nCreating Session - Subject: {subject_info["subject_id"]} - Date: {session_info["session_time"]}')
 
     # ==================== Intracellular ====================
     # no info on recording device, brain location of cell available from data, hard-coded from the paper
@@ -118,41 +138,51 @@ for fname in glob.glob(os.path.join(path, 'Data', '*.mat')):
     fs = mat_data.recording_data.sample_rate
     trial_key = dict(session_info, trial_counts=len(mat_data.behavioral_data.behav_timing))
 
-    with acquisition.TrialSet.connection.transaction:
-        if trial_key not in acquisition.TrialSet.proj():
-            print('\nInsert trial information')
-            acquisition.TrialSet.insert1(trial_key, allow_direct_insert = True, ignore_extra_fields = True)
-
-            for tr_idx, events_time in tqdm(enumerate(mat_data.behavioral_data.behav_timing)):
-                trial_key['trial_id'] = tr_idx + 1  # trial-number starts from 1
-                trial_key['start_time'] = mat_data.behavioral_data.trial_onset_bin[tr_idx] / fs
-                trial_key['stop_time'] = min(trial_key['start_time'] + events_time.end_time,
-                                             (len(mat_data.recording_data.Vm) - 1) / fs)
-                trial_key['trial_stim_present'] = bool(mat_data.behavioral_data.AOM_on_or_off[tr_idx])
-                trial_key['trial_is_good'] = True  # no info of trial good/bad status, assuming all trials are good
-                trial_key['trial_type'], trial_key['trial_response'] = trial_type_and_response_dict[
-                    mat_data.behavioral_data.trial_type_vector[tr_idx]]
-                trial_key['delay_duration'] = 1.2  # hard-coded here (the same for whole cell)
-                acquisition.TrialSet.Trial.insert1(trial_key, ignore_extra_fields = True, skip_duplicates = True,
-                                                   allow_direct_insert = True)
-
-                # ======== Now add trial event timing to the EventTime part table ====
-                events = dict(
-                    events_time.__dict__,
-                    trial_start = 0,
-                    trial_stop = trial_key['stop_time'] - trial_key['start_time'],
-                    first_lick = min([np.array(getattr(events_time, l)).flatten()[
-                                          0]  # events_time(l) could be empty ([]), a single time (float) or multiple times (array)
-                                      if np.array(getattr(events_time, l)).flatten().size > 0 else np.nan
-                                      for l in ('lickL_on_time', 'lickR_on_time')]),
-                    current_injection_start = mat_data.behavioral_data.tail_current_injection_onset_bin[tr_idx] / fs)
-                # -- events timing
-                acquisition.TrialSet.EventTime.insert((dict(trial_key, trial_event = k, event_time = events[k])
-                                                       for k in ['trial_start', 'trial_stop', 'cue_start',
-                                                                 'cue_end', 'sampling_start', 'delay_start',
-                                                                 'current_injection_start', 'first_lick']),
-                                                      ignore_extra_fields = True, skip_duplicates = True,
-                                                      allow_direct_insert = True)
+    if trial_key not in acquisition.TrialSet.proj():
+        print('\nInsert trial information')
+        acquisition.TrialSet.insert1(trial_key, allow_direct_insert = True, ignore_extra_fields = True)
+
+        # ---- build the trial and event-time columns for the whole session at once ----
+        behav_data = mat_data.behavioral_data
+        behav_timing = behav_data.behav_timing
+        trial_ids = np.arange(len(behav_timing)) + 1  # trial-number starts from 1
+        start_times = behav_data.trial_onset_bin / fs
+        stop_times = np.minimum(start_times + np.array([tr.end_time for tr in behav_timing]),
+                                (len(mat_data.recording_data.Vm) - 1) / fs)
+        trial_types, trial_responses = zip(*(trial_type_and_response_dict[tr_type]
+                                             for tr_type in behav_data.trial_type_vector))
+
+        utilities.insert_in_batches(
+            acquisition.TrialSet.Trial,
+            (dict(session_info, trial_id=tr_id, start_time=start, stop_time=stop,
+                  trial_stim_present=bool(aom_on),
+                  trial_is_good=True,  # no info of trial good/bad status, assuming all trials are good
+                  trial_type=tr_type, trial_response=tr_response,
+                  delay_duration=1.2)  # hard-coded here (the same for whole cell)
+             for tr_id, start, stop, aom_on, tr_type, tr_response in zip(
+                trial_ids, start_times, stop_times, behav_data.AOM_on_or_off, trial_types, trial_responses)),
+            ignore_extra_fields=True, skip_duplicates=True, allow_direct_insert=True)
+
+        # ======== Now add trial event timing to the EventTime part table ====
+        def first_time(t):  # t could be empty ([]), a single time (float) or multiple times (array)
+            t = np.array(t).flatten()
+            return t[0] if t.size > 0 else np.nan
+
+        events = {e: np.array([getattr(tr, e) for tr in behav_timing], dtype=float)
+                  for e in ('cue_start', 'cue_end', 'sampling_start', 'delay_start')}
+        events.update(
+            trial_start=np.zeros(len(trial_ids)),
+            trial_stop=stop_times - start_times,
+            first_lick=np.fmin(*(np.array([first_time(getattr(tr, l)) for tr in behav_timing])
+                                 for l in ('lickL_on_time', 'lickR_on_time'))),
+            current_injection_start=behav_data.tail_current_injection_onset_bin / fs)
+        utilities.insert_in_batches(
+            acquisition.TrialSet.EventTime,
+            (dict(session_info, trial_id=tr_id, trial_event=k, event_time=events[k][tr_idx])
+             for k in ['trial_start', 'trial_stop', 'cue_start', 'cue_end', 'sampling_start', 'delay_start',
+                       'current_injection_start', 'first_lick']
+             for tr_idx, tr_id in enumerate(trial_ids)),
+            ignore_extra_fields=True, skip_duplicates=True, allow_direct_insert=True)
 
     # ==================== photostim ====================
     # no info on photostim available from data, all photostim info here are hard-coded from the paper
@@ -197,7 +227,48 @@ for fname in glob.glob(os.path.join(path, 'Data', '*.mat')):
         stimulation.PhotoStimulation.insert1({**photo_stimulation,
                                               **action_location,
                                               **(dict(photostim_start_time=0,
-                                                      photostim_timeseries=mat_data.recording_data.AOM,
+                                                      photostim_timeseries=signal_store.put(
+                                                          mat_data.recording_data.AOM, 'photostim_timeseries'),
                                                       photostim_sampling_rate=mat_data.recording_data.sample_rate)
                                                  if mat_data.recording_data.AOM.size > 0 else dict())},
                                              ignore_extra_fields=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ingest the whole-cell dataset (WholeCellData)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes, each ingesting one file at a time (default: 1)')
+    parser.add_argument('--failure-log', default=None,
+                        help='path of a JSON file to write the errors of the files that failed to ingest')
+    parser.add_argument('--incremental', action='store_true',
+                        help='skip the files ingested by a previous incremental run and unchanged since, '
+                             'and the files of sessions already ingested - without opening them')
+    parser.add_argument('--state-file', default=None,
+                        help='state file of the incremental ingestion (default: in the "cache_directory")')
+    args = parser.parse_args()
+
+    fnames = glob.glob(os.path.join(path, 'Data', '*.mat'))
+
+    on_success = None
+    if args.incremental:
+        ingest_state = utilities.get_ingest_state(path, args.state_file)
+        fnames_to_ingest = utilities.get_files_to_ingest(fnames, ingest_state, get_session_id)
+        print(f'{len(fnames_to_ingest)} files to ingest - {len(fnames) - len(fnames_to_ingest)} files skipped')
+        fnames = fnames_to_ingest
+
+        def on_success(fname):
+            ingest_state.record(fname, checksum=True)
+            ingest_state.save()
+
+    if len(fnames):
+        load_meta_data()  # parsed once, before the worker processes are forked
+
+    failures = utilities.run_in_process_pool(ingest_file, fnames, workers=args.workers, on_success=on_success)
+
+    print(f'\nIngested {len(fnames) - len(failures)}/{len(fnames)} files')
+    if failures:
+        print('Failed files:\n\t' + '\n\t'.join(failures), file=sys.stderr)
+        if args.failure_log:
+            with open(args.failure_log, 'w') as f:
+                json.dump(failures, f, indent=2)
+        sys.exit(1)
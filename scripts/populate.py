@@ -1,21 +1,246 @@
+#!/usr/bin/env python3
+'''
+Populate all imported/computed tables of the pipeline.
+The order is derived from the dependency graph of the schemas: with --workers N, the tables are populated by N worker
+ processes (each with its own database connection, keys reserved in the jobs table), and a table is populated as soon
+ as its upstream tables are being populated - its keys become available as upstream keys complete.
+ The importers of the same data files are populated together, key by key (e.g. cell by cell), in one process - each
+ file is parsed once and shared by the importers through the MAT-file cache (see utilities.load_matfile_fields).
+ The free workers are spread over all the tables ready to populate. A table is done once a pass started after all its
+ upstream tables were done has returned (its remaining keys are then reserved by the passes still running), and these
+ passes have returned.
+'''
+import os
+import sys
+import time
+import random
+import argparse
+import importlib
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import datajoint as dj
+
 from pipeline import (reference, subject, acquisition, stimulation, analysis,
-                      intracellular, extracellular, behavior, utilities)
+                      intracellular, extracellular, behavior, utilities, profiling)
 
 settings = dict(reserve_jobs=True, suppress_errors=True)
 
-# ====================== Starting import and compute procedure ======================
-print('======== Populate() Intracellular Routine =====')
-intracellular.MembranePotential.populate(**settings)
-intracellular.CurrentInjection.populate(**settings)
-intracellular.CellSpikeTimes.populate(**settings)
+# the tables to populate, and the maximum number of worker processes per table (default: all workers)
+populated_tables = [intracellular.MembranePotential,
+                    intracellular.CurrentInjection,
+                    intracellular.CellSpikeTimes,
+                    behavior.LickTimes,
+                    behavior.TrialSegmentedLickTrace,
+                    intracellular.TrialSegmentedMembranePotential,
+                    intracellular.TrialSegmentedCurrentInjection,
+                    intracellular.TrialSegmentedCellSpikeTimes,
+                    stimulation.TrialSegmentedPhotoStimulus,
+                    analysis.RealignedEvent,
+                    extracellular.UnitSpikeTimes,
+                    extracellular.CompactTrialSegmentedUnitSpikeTimes,
+                    extracellular.UnitPSTH]
+table_worker_limits = {}
+
+# importers of the same data file, populated together key by key in one process: group name -> (key table, tables)
+populate_groups = {'intracellular.Cell': (intracellular.Cell, [intracellular.MembranePotential,
+                                                               intracellular.CurrentInjection,
+                                                               intracellular.CellSpikeTimes,
+                                                               behavior.LickTimes])}
+
+# seconds to wait before another pass over a table whose upstream tables are still being populated
+poll_interval = 10
+
+
+def get_table_name(table):
+    return f'{table.__module__.split(".")[-1]}.{table.__name__}'
+
+
+def get_table(table_name):
+    module_name, class_name = table_name.split('.')
+    return getattr(importlib.import_module(f'pipeline.{module_name}'), class_name)
+
+
+def get_group_tables(name):
+    """
+    The tables populated under "name" - a table name, or a group name of populate_groups
+    """
+    if name in populate_groups:
+        return populate_groups[name][1]
+    return [get_table(name)]
+
+
+def get_upstream_groups(upstream):
+    """
+    {table name: names of its upstream tables} -> the same with the tables of a group replaced by the group
+    """
+    group_names = {get_table_name(table): group_name
+                   for group_name, (_, tables) in populate_groups.items() for table in tables}
+    grouped = {}
+    for table_name, up in upstream.items():
+        name = group_names.get(table_name, table_name)
+        grouped.setdefault(name, set()).update(group_names.get(u, u) for u in up)
+    return {name: up - {name} for name, up in grouped.items()}
+
+
+def get_upstream_tables(tables):
+    """
+    From the dependency graph of the schemas: {table name: names of the tables in "tables" it depends on}
+     (depending on a part table counts as depending on its master)
+    """
+    full_names = {t.full_table_name: get_table_name(t) for t in tables}
+    dependencies = dj.conn().dependencies
+    dependencies.load()
+    upstream = {}
+    for table in tables:
+        ancestors = set(dependencies.ancestors(table.full_table_name)) - {table.full_table_name}
+        upstream[get_table_name(table)] = {name for full_name, name in full_names.items()
+                                           if full_name != table.full_table_name
+                                           and any(a == full_name or a.startswith(full_name[:-1] + '__')
+                                                   for a in ancestors)}
+    return upstream
+
+
+def get_populate_order(upstream):
+    """
+    Topological order of the tables in "upstream" ({table name: names of its upstream tables}):
+     a table after all its upstream tables
+    """
+    ordered_tables = []
+    while len(ordered_tables) < len(upstream):
+        ordered_tables.extend(sorted(name for name, up in upstream.items()
+                                     if name not in ordered_tables and up <= set(ordered_tables)))
+    return ordered_tables
+
+
+def init_worker():
+    # forked workers inherit the parent's database socket - give each worker process its own connection
+    dj.conn().connect()
+
+
+def populate_group(group_name):
+    """
+    Populate the tables of a group of populate_groups key by key (in random order): all its tables for a key, then
+     the next key - the data file of a key is parsed once, and shared by the tables through the MAT-file cache
+    """
+    key_table, tables = populate_groups[group_name]
+    keys = key_table.fetch('KEY')
+    random.shuffle(keys)
+    errors = []
+    for key in keys:
+        for table in tables:
+            errors.extend(table.populate(key, **settings) or [])
+    return errors
+
+
+def populate_table(table_name):
+    """
+    One populate() pass over a table, or a group of populate_groups, in a worker process
+    Return the list of populate errors, or the traceback of a failed pass
+    """
+    try:
+        if table_name in populate_groups:
+            return populate_group(table_name)
+        return get_table(table_name).populate(order='random', **settings)
+    except Exception:
+        return [traceback.format_exc()]
+
+
+def populate_all(workers=1):
+    upstream = get_upstream_groups(get_upstream_tables(populated_tables))
+    ordered_tables = get_populate_order(upstream)
+
+    errors = {}
+    if workers <= 1:
+        for table_name in ordered_tables:
+            print(f'======== Populate() {table_name} ========')
+            errors[table_name] = populate_table(table_name)
+        return errors
+
+    done = set()
+    final_returned = set()  # tables of which a pass started after all upstream were done has returned
+    running = {}  # future -> (table name, all upstream done at submission)
+    next_poll = {}  # table name -> time of its next overlapping pass
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        while len(done) < len(ordered_tables):
+            running_counts = {name: 0 for name in ordered_tables}
+            for table_name, _ in running.values():
+                running_counts[table_name] += 1
+            # tables with all upstream done (critical path) - until one of their passes returns: all their keys
+            # are then populated or reserved by the passes still running
+            final_tables = [name for name in ordered_tables
+                            if name not in done and name not in final_returned and upstream[name] <= done]
+            # one overlapping pass at a time, every poll_interval, over tables whose upstream tables are running
+            now = time.monotonic()
+            overlap_tables = [name for name in ordered_tables
+                              if name not in done and not upstream[name] <= done and not running_counts[name]
+                              and next_poll.get(name, 0) <= now
+                              and all(up in done or running_counts[up] for up in upstream[name])]
+
+            # spread the free workers over the tables, one pass per table per round
+            submitted = True
+            while len(running) < workers and submitted:
+                submitted = False
+                for table_name, is_final in [(name, True) for name in final_tables] + [
+                        (name, False) for name in overlap_tables]:
+                    if len(running) >= workers or running_counts[table_name] >= (
+                            table_worker_limits.get(table_name, workers) if is_final else 1):
+                        continue
+                    running[executor.submit(populate_table, table_name)] = (table_name, is_final)
+                    running_counts[table_name] += 1
+                    submitted = True
+                    print(f'Populating {table_name} ({running_counts[table_name]} workers)')
+
+            # wait for a pass to return, or for the next overlapping pass to be due
+            timeout = max(min(next_poll.values()) - time.monotonic(), 0) if next_poll else None
+            if running:
+                finished, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            else:
+                time.sleep(timeout or 0)
+                finished = set()
+            now = time.monotonic()
+            next_poll = {name: t for name, t in next_poll.items() if t > now}
+            for future in finished:
+                table_name, is_final = running.pop(future)
+                errors.setdefault(table_name, []).extend(future.result() or [])
+                if is_final:
+                    final_returned.add(table_name)
+                else:
+                    next_poll[table_name] = now + poll_interval
+            # done once a final pass has returned and no pass over the table is running
+            for table_name in final_returned - done:
+                if all(name != table_name for name, _ in running.values()):
+                    done.add(table_name)
+                    next_poll.pop(table_name, None)
+                    print(f'Done {table_name}')
+    return errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Populate all imported/computed tables of the pipeline')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes (default: 1 - populate table by table in this process)')
+    parser.add_argument('--table-workers', nargs='*', default=[], metavar='TABLE=N',
+                        help='maximum number of worker processes for a table, e.g. extracellular.UnitSpikeTimes=2')
+    parser.add_argument('--profile', default=None, metavar='DIR',
+                        help='profile each make() call (see pipeline.profiling) and write a report to this directory')
+    args = parser.parse_args()
+    for table_limit in args.table_workers:
+        table_name, limit = table_limit.split('=')
+        table_worker_limits[table_name] = int(limit)
 
-intracellular.TrialSegmentedMembranePotential.populate(**settings)
-intracellular.TrialSegmentedCurrentInjection.populate(**settings)
-intracellular.TrialSegmentedCellSpikeTimes.populate(**settings)
+    if args.profile:
+        profiling.enable(args.profile)  # before the worker processes are forked - they inherit the profiling
 
-behavior.TrialSegmentedLickTrace.populate(**settings)
+    errors = {table_name: table_errors for table_name, table_errors in populate_all(args.workers).items()
+              if table_errors}
 
-print('======== Populate() Extracellular Routine =====')
-analysis.RealignedEvent.populate(**settings)
-extracellular.UnitSpikeTimes.populate(**settings)
-extracellular.TrialSegmentedUnitSpikeTimes.populate(**settings)
+    if args.profile:
+        profiling.write_report(args.profile)
+        print(f'Profiling report: {os.path.join(args.profile, "report.json")}')
+    if errors:
+        for table_name, table_errors in errors.items():
+            print(f'{table_name}: {len(table_errors)} error(s)', file=sys.stderr)
+            for error in table_errors:
+                print(f'\t{error}', file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,53 @@
+'''
+The tests run against a database (dj.config / DJ_HOST, DJ_USER, DJ_PASS - e.g. the MySQL of docker-compose.yml),
+ on a synthetic dataset (scripts/generate_synthetic_data.py) ingested into a throwaway pipeline: all schemas with
+ the prefix "inagaki2018_test_" are dropped first. Skipped if datajoint is not installed or the database is not
+ reachable.
+'''
+import os
+import sys
+import glob
+
+import numpy as np
+import pytest
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [root_dir, os.path.join(root_dir, 'scripts')]
+
+database_prefix = 'inagaki2018_test_'
+
+
+@pytest.fixture(scope='session')
+def data_dir(tmp_path_factory):
+    import generate_synthetic_data
+
+    data_dir = str(tmp_path_factory.mktemp('synthetic'))
+    generate_synthetic_data.generate_wholecell(np.random.RandomState(0), data_dir, cells=1, trials=10,
+                                               trial_duration=5, fs=2000, firing_rate=10, epsp_fraction=1)
+    return data_dir
+
+
+@pytest.fixture(scope='session')
+def pipeline(data_dir, tmp_path_factory):
+    """
+    A pipeline declared with the test schema prefix, with the synthetic whole-cell data ingested
+    """
+    dj = pytest.importorskip('datajoint')
+    try:
+        dj.conn()
+    except Exception as e:
+        pytest.skip(f'database not reachable: {e}')
+    import benchmark
+
+    benchmark.drop_schemas(database_prefix)
+    dj.config['custom'] = dict(dj.config.get('custom', {}),
+                               **{'database.prefix': database_prefix,
+                                  'intracellular_directory': os.path.join(data_dir, 'WholeCellData'),
+                                  'extracellular_directory': os.path.join(data_dir, 'SiliconProbeData'),
+                                  'cache_directory': str(tmp_path_factory.mktemp('cache'))})
+    import ingest_wholecell
+
+    for fname in glob.glob(os.path.join(ingest_wholecell.path, 'Data', '*.mat')):
+        ingest_wholecell.ingest_file(fname)
+    yield
+    benchmark.drop_schemas(database_prefix)
@@ -0,0 +1,27 @@
+import numpy as np
+
+
+def test_session_event_times_cache_detects_reingest(pipeline):
+    import datajoint as dj
+    from pipeline import acquisition, analysis
+
+    session_key = acquisition.Session.fetch('KEY', limit=1)[0]
+    session_event_times = analysis.get_session_event_times(session_key)
+    assert analysis.get_session_event_times(session_key) is session_event_times
+
+    # an event time re-ingested by another process: same row count, without this process' insert hook
+    event_row = (acquisition.TrialSet.EventTime & session_key & 'event_time is not NULL').fetch(
+        as_dict=True, limit=1)[0]
+    event_key = {k: event_row[k] for k in acquisition.TrialSet.EventTime.primary_key}
+    try:
+        (acquisition.TrialSet.EventTime & event_key).delete_quick()
+        dj.Part.insert(acquisition.TrialSet.EventTime(), [dict(event_row, event_time=event_row['event_time'] + 1)])
+
+        reingested = analysis.get_session_event_times(session_key)
+        assert reingested is not session_event_times
+        tr_idx = list(reingested.trial_ids).index(event_row['trial_id'])
+        e_idx = reingested.events.index(event_row['trial_event'])
+        assert np.isclose(reingested.event_times[tr_idx, e_idx], event_row['event_time'] + 1)
+    finally:
+        (acquisition.TrialSet.EventTime & event_key).delete_quick()
+        acquisition.TrialSet.EventTime.insert1(event_row)
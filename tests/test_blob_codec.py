@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+
+@pytest.fixture(scope='module')
+def blob_table(pipeline):
+    import datajoint as dj
+    from conftest import database_prefix
+
+    schema = dj.schema(database_prefix + 'blob_codec')
+
+    @schema
+    class Blob(dj.Manual):
+        definition = """
+        blob_id: int
+        ---
+        value: longblob
+        """
+
+    yield Blob
+    schema.drop(force=True)
+
+
+@pytest.mark.parametrize('codec', ['float32', 'int16'])
+def test_encoded_insert_fetch_round_trip(blob_table, codec):
+    from pipeline import blob_codec
+
+    signal = np.sin(np.linspace(0, 10, 1000))
+    signal[10] = np.nan
+    blob_id = len(blob_table())
+    blob_table.insert1(dict(blob_id=blob_id, value=blob_codec.encode(signal, codec)))
+
+    decoded = blob_codec.decode((blob_table & dict(blob_id=blob_id)).fetch1('value'))
+    assert decoded.dtype == np.float32 and decoded.shape == signal.shape
+    assert np.isnan(decoded[10])
+    np.testing.assert_allclose(decoded[~np.isnan(signal)], signal[~np.isnan(signal)], atol=1e-3)
+
+
+def test_signal_store_reference_round_trip(blob_table, tmp_path, monkeypatch):
+    from pipeline import signal_store
+
+    monkeypatch.setattr(signal_store, 'store_path', str(tmp_path))
+    signal = np.arange(1000, dtype=float)
+    blob_id = len(blob_table())
+    blob_table.insert1(dict(blob_id=blob_id, value=signal_store.put(signal)))
+
+    stored = signal_store.get((blob_table & dict(blob_id=blob_id)).fetch1('value'))
+    assert isinstance(stored, np.memmap)
+    np.testing.assert_array_equal(stored[10:20], signal[10:20])
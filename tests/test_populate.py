@@ -0,0 +1,14 @@
+def test_file_importers_share_parsed_files(pipeline):
+    from pipeline import utilities
+    import populate
+
+    utilities.clear_matfile_cache()
+    hits = utilities._matfile_cache.hits
+
+    populate.populate_all(workers=1)
+
+    # one whole-cell file read by 4 importers (membrane potential, current injection, spike times, lick times):
+    #  parsed by the first, served from the MAT-file cache to the others
+    for table in populate.get_group_tables('intracellular.Cell'):
+        assert len(table()) == 1
+    assert utilities._matfile_cache.hits - hits >= 3